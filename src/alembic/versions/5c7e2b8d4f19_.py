@@ -0,0 +1,31 @@
+"""unique service names per challenge
+
+Revision ID: 5c7e2b8d4f19
+Revises: a93d5e1f7c20
+Create Date: 2026-10-18 14:41:09.562803
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c7e2b8d4f19'
+down_revision: Union[str, None] = 'a93d5e1f7c20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Updates used to match on image, so a renamed image left a second row behind.
+    op.execute(
+        'DELETE FROM services a USING services b '
+        'WHERE a.challenge_id = b.challenge_id AND a.name = b.name AND a.id < b.id'
+    )
+    op.create_index('ix_services_challenge_id_name', 'services', ['challenge_id', 'name'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_services_challenge_id_name', table_name='services')
@@ -0,0 +1,26 @@
+"""add services.depends_on
+
+Revision ID: 8f3c2a1d9b47
+Revises: 21053d267b30
+Create Date: 2026-10-18 09:12:40.118302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f3c2a1d9b47'
+down_revision: Union[str, None] = '21053d267b30'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('services', sa.Column('depends_on', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('services', 'depends_on')
@@ -0,0 +1,60 @@
+"""store service and connection settings as jsonb, index joins
+
+Revision ID: a93d5e1f7c20
+Revises: f6b91c2e7d08
+Create Date: 2026-10-18 14:02:37.118540
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a93d5e1f7c20'
+down_revision: Union[str, None] = 'f6b91c2e7d08'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+JSON_COLUMNS = [
+    ('services', 'ports', False),
+    ('services', 'environment', False),
+    ('services', 'cap_add', False),
+    ('services', 'depends_on', True),
+    ('challenges', 'connection_info', True),
+]
+
+
+def upgrade() -> None:
+    for table, column, nullable in JSON_COLUMNS:
+        op.alter_column(
+            table,
+            column,
+            existing_type=sa.String(),
+            existing_nullable=nullable,
+            type_=postgresql.JSONB(astext_type=sa.Text()),
+            postgresql_using=f'{column}::jsonb',
+        )
+    # Earlier releases could record the same join twice; keep the first one.
+    op.execute(
+        'DELETE FROM joins a USING joins b '
+        'WHERE a.challenge_id = b.challenge_id AND a.user_id = b.user_id AND a.id > b.id'
+    )
+    op.create_index('ix_joins_challenge_id_user_id', 'joins', ['challenge_id', 'user_id'], unique=True)
+    op.create_index(op.f('ix_joins_user_id'), 'joins', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_joins_user_id'), table_name='joins')
+    op.drop_index('ix_joins_challenge_id_user_id', table_name='joins')
+    for table, column, nullable in JSON_COLUMNS:
+        op.alter_column(
+            table,
+            column,
+            existing_type=postgresql.JSONB(astext_type=sa.Text()),
+            existing_nullable=nullable,
+            type_=sa.String(),
+            postgresql_using=f'{column}::text',
+        )
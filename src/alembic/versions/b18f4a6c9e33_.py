@@ -0,0 +1,26 @@
+"""add challenges.stop_grace
+
+Revision ID: b18f4a6c9e33
+Revises: 5c7e2b8d4f19
+Create Date: 2026-10-18 15:10:22.407915
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b18f4a6c9e33'
+down_revision: Union[str, None] = '5c7e2b8d4f19'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('challenges', sa.Column('stop_grace', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('challenges', 'stop_grace')
@@ -0,0 +1,29 @@
+"""add challenges.warm_pool_size
+
+Revision ID: c41e7b09d2a5
+Revises: 8f3c2a1d9b47
+Create Date: 2026-10-18 10:03:17.542980
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c41e7b09d2a5'
+down_revision: Union[str, None] = '8f3c2a1d9b47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'challenges',
+        sa.Column('warm_pool_size', sa.Integer(), server_default='0', nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('challenges', 'warm_pool_size')
@@ -0,0 +1,53 @@
+"""add per-player instances
+
+Revision ID: d2e8c5a1f604
+Revises: b18f4a6c9e33
+Create Date: 2026-10-18 16:05:44.281930
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2e8c5a1f604'
+down_revision: Union[str, None] = 'b18f4a6c9e33'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+instance_scope = sa.Enum('shared', 'player', name='instance_scope')
+
+
+def upgrade() -> None:
+    instance_scope.create(op.get_bind(), checkfirst=True)
+    op.add_column(
+        'challenges',
+        sa.Column('instance_scope', instance_scope, server_default='shared', nullable=True),
+    )
+    op.create_table('instances',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('challenge_id', sa.Integer(), nullable=False),
+    sa.Column('owner_id', sa.String(), nullable=False),
+    sa.Column('connection_info', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['challenge_id'], ['challenges.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_index(op.f('ix_instances_id'), 'instances', ['id'], unique=False)
+    op.create_index(op.f('ix_instances_owner_id'), 'instances', ['owner_id'], unique=False)
+    op.create_index('ix_instances_challenge_id_owner_id', 'instances', ['challenge_id', 'owner_id'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_instances_challenge_id_owner_id', table_name='instances')
+    op.drop_index(op.f('ix_instances_owner_id'), table_name='instances')
+    op.drop_index(op.f('ix_instances_id'), table_name='instances')
+    op.drop_table('instances')
+    op.drop_column('challenges', 'instance_scope')
+    instance_scope.drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,26 @@
+"""index joins.joined_at
+
+Revision ID: e27d4f8a1c63
+Revises: c41e7b09d2a5
+Create Date: 2026-10-18 12:41:05.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e27d4f8a1c63'
+down_revision: Union[str, None] = 'c41e7b09d2a5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(op.f('ix_joins_joined_at'), 'joins', ['joined_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_joins_joined_at'), table_name='joins')
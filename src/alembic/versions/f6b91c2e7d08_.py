@@ -0,0 +1,28 @@
+"""add challenges.lifetime and challenges.max_lifetime
+
+Revision ID: f6b91c2e7d08
+Revises: e27d4f8a1c63
+Create Date: 2026-10-18 13:26:48.902311
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f6b91c2e7d08'
+down_revision: Union[str, None] = 'e27d4f8a1c63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('challenges', sa.Column('lifetime', sa.Integer(), nullable=True))
+    op.add_column('challenges', sa.Column('max_lifetime', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('challenges', 'max_lifetime')
+    op.drop_column('challenges', 'lifetime')
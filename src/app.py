@@ -1,7 +1,10 @@
 import os
 import alembic.command
 import alembic.config
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from sqladmin import Admin, ModelView
 from fastapi.staticfiles import StaticFiles
 from config import config
@@ -9,13 +12,23 @@ from fastapi.middleware.cors import CORSMiddleware
 from logging import getLogger
 from utils.api import APIResponse
 from utils.dbadmin import MyAuth
+from utils.docker import init_client_pool
+from utils.gate_keeper import UserCache
+from utils.cluster_metrics import ClusterCollector
+from utils.queues import broker_client
+from utils import metrics
+from services.auth.protocols import BaseService
 from repository.schema import *
-from repository import engine
-from cron import scheduler
+from repository import engine, RedisStorage
+from repository.cache import CatalogueCache
+import cron
+from worker import clean_instance, refill_warm_pool
 from contextlib import asynccontextmanager
 import logging
 import alembic
+import hmac
 import threading
+import time
 
 from views import view
 
@@ -56,19 +69,48 @@ class UserAdmin(ModelView, model=User):
     column_searchable_list = ("display_name", "email")
     column_filters = ("is_admin",)
 
+    async def after_model_change(self, data, model, is_created, request):
+        UserCache.publish(next(RedisStorage.get()), model.id)
+
+    async def after_model_delete(self, model, request):
+        UserCache.publish(next(RedisStorage.get()), model.id)
+
 
 class ChallengeAdmin(ModelView, model=Challenge):
-    column_list = ("id", "title", "services", "connection_info", "players")
+    column_list = (
+        "id",
+        "title",
+        "services",
+        "connection_info",
+        "players",
+        "warm_pool_size",
+        "lifetime",
+        "max_lifetime",
+        "stop_grace",
+        "instance_scope",
+    )
     column_labels = {
         "id": "Challenge ID",
         "title": "Challenge Title",
         "services": "Associated Services",
         "connection_info": "Connection Information",
         "players": "Players",
+        "warm_pool_size": "Warm Pool Size",
+        "lifetime": "Join Lifetime (s)",
+        "max_lifetime": "Max Join Lifetime (s)",
+        "stop_grace": "Stop Grace Period (s)",
+        "instance_scope": "Instance Scope",
     }
     column_searchable_list = ("title",)
     column_filters = ("services",)
 
+    async def after_model_change(self, data, model, is_created, request):
+        CatalogueCache(next(RedisStorage.get())).invalidate(challenge_id=model.id)
+        refill_warm_pool.delay(model.id)
+
+    async def after_model_delete(self, model, request):
+        CatalogueCache(next(RedisStorage.get())).invalidate(challenge_id=model.id)
+
 
 class ServiceAdmin(ModelView, model=Service):
     column_list = (
@@ -82,6 +124,7 @@ class ServiceAdmin(ModelView, model=Service):
         "ports",
         "environment",
         "cap_add",
+        "depends_on",
     )
     column_labels = {
         "id": "Service ID",
@@ -94,16 +137,48 @@ class ServiceAdmin(ModelView, model=Service):
         "ports": "Ports",
         "environment": "Environment Variables",
         "cap_add": "Capabilities Added",
+        "depends_on": "Depends On",
     }
     column_searchable_list = ("name", "challenge")
     column_filters = ("privileged", "cpu", "memory")
 
+    async def after_model_change(self, data, model, is_created, request):
+        CatalogueCache(next(RedisStorage.get())).invalidate(
+            challenge_id=model.challenge_id
+        )
+
+    async def after_model_delete(self, model, request):
+        CatalogueCache(next(RedisStorage.get())).invalidate(
+            challenge_id=model.challenge_id
+        )
+
+
+class InstanceAdmin(ModelView, model=Instance):
+    can_create = False
+    can_edit = False
+    column_list = ("id", "name", "challenge", "owner", "connection_info", "created_at")
+    column_labels = {
+        "id": "Instance ID",
+        "name": "Instance Name",
+        "challenge": "Challenge",
+        "owner": "Owner",
+        "connection_info": "Connection Information",
+        "created_at": "Created At",
+    }
+    column_searchable_list = ("name",)
+    column_default_sort = ("id", True)
+
+    async def after_model_delete(self, model, request):
+        # The row is gone already; tear the containers down by name.
+        clean_instance.delay(model.id, name=model.name)
+
 
 admin = Admin(app, engine, authentication_backend=MyAuth(os.urandom(64).hex()))
 
 admin.add_view(UserAdmin)
 admin.add_view(ChallengeAdmin)
 admin.add_view(ServiceAdmin)
+admin.add_view(InstanceAdmin)
 
 configs = {
     "host": config["HOST"],
@@ -113,6 +188,11 @@ configs = {
 }
 
 
+app.add_event_handler("startup", init_client_pool)
+app.add_event_handler("startup", UserCache.start_listener)
+app.add_event_handler("shutdown", BaseService.close)
+
+
 @app.exception_handler(Exception)
 async def exception_handler(request, exc):
     log.error(exc)
@@ -123,14 +203,47 @@ async def exception_handler(request, exc):
     )
 
 
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    started = time.monotonic()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # Labelled by route template so ids in paths do not multiply series.
+        route = getattr(request.scope.get("route"), "path", "other")
+        metrics.HTTP_REQUEST_SECONDS.labels(
+            request.method, route, status_code
+        ).observe(time.monotonic() - started)
+
+
+metrics_registry = metrics.registry()
+metrics_registry.register(
+    ClusterCollector(next(RedisStorage.get()), broker_client())
+)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def export_metrics(authorization: str = Header(None)):
+    token = config["METRICS"]["TOKEN"]
+    if token and not hmac.compare_digest(authorization or "", f"Bearer {token}"):
+        return APIResponse.as_json(code=401, status="Invalid metrics token")
+    return Response(
+        await run_in_threadpool(generate_latest, metrics_registry),
+        media_type=CONTENT_TYPE_LATEST,
+    )
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     alembic.command.upgrade(alembic.config.Config("alembic.ini"), "head")
     yield
-    scheduler.shutdown()
+    cron.shutdown()
 
 
-scheduler.start()
+cron.start()
 file_handler = logging.FileHandler("/tmp/app.log")
 file_handler.setFormatter(
     logging.Formatter(
@@ -140,4 +253,4 @@ file_handler.setFormatter(
 file_handler.setLevel(logging.DEBUG)
 logging.basicConfig(level=logging.DEBUG, handlers=[file_handler])
 
-__all__ = ["app", "scheduler", "lifespan"]
+__all__ = ["app", "lifespan"]
@@ -0,0 +1,60 @@
+"""Per-task Docker client overhead: fresh client vs. the process-wide pool.
+
+Run from ``src`` against a reachable daemon::
+
+    PYTHONPATH=./ python -m bench.docker_client --iterations 200
+"""
+from argparse import ArgumentParser
+from docker import DockerClient
+from config import config
+from utils.docker import DockerHandler, client_pool
+import statistics
+import time
+
+
+def fresh_handler():
+    client = DockerClient(base_url=config["DOCKER"]["HOST"])
+    if config["DOCKER"]["REGISTRY"] and config["DOCKER"]["USERNAME"]:
+        client.login(
+            username=config["DOCKER"]["USERNAME"],
+            password=config["DOCKER"]["PASSWORD"],
+            registry=config["DOCKER"]["REGISTRY"],
+        )
+    client.ping()
+    client.containers.list(limit=1)
+    client.close()
+
+
+def pooled_handler():
+    DockerHandler()._client.containers.list(limit=1)
+
+
+def measure(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        started_at = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started_at) * 1000)
+    samples.sort()
+    return {
+        "mean": statistics.mean(samples),
+        "p50": samples[len(samples) // 2],
+        "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+    }
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+    client_pool.reset()
+    for name, fn in (("fresh client", fresh_handler), ("pooled client", pooled_handler)):
+        result = measure(fn, args.iterations)
+        print(
+            f"{name:>14}: mean {result['mean']:.2f} ms, "
+            f"p50 {result['p50']:.2f} ms, p99 {result['p99']:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
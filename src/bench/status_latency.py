@@ -0,0 +1,87 @@
+"""Status endpoint latency under concurrent polling.
+
+Every poller behaves like an open challenge tab: it requests
+``/api/challenge/{id}/status`` and sleeps ``--interval`` seconds. Optional
+``--listers`` keep hitting the challenge list at the same time, which is what
+used to stall the event loop while the handlers blocked on Postgres.
+
+Run from ``src`` against a running API::
+
+    PYTHONPATH=./ python -m bench.status_latency --token $TOKEN --pollers 200
+"""
+from argparse import ArgumentParser
+import asyncio
+import statistics
+import time
+import httpx
+
+
+async def poll(client, path, interval, deadline, samples, errors):
+    while time.monotonic() < deadline:
+        started_at = time.perf_counter()
+        try:
+            response = await client.get(path)
+            response.raise_for_status()
+            samples.append((time.perf_counter() - started_at) * 1000)
+        except httpx.HTTPError:
+            errors.append(path)
+        await asyncio.sleep(interval)
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.pollers + args.listers)
+    async with httpx.AsyncClient(
+        base_url=args.url,
+        headers={"Authorization": f"Bearer {args.token}"},
+        limits=limits,
+        timeout=30,
+    ) as client:
+        deadline = time.monotonic() + args.duration
+        samples, errors = [], []
+        tasks = [
+            poll(
+                client,
+                f"/api/challenge/{args.challenge}/status",
+                args.interval,
+                deadline,
+                samples,
+                errors,
+            )
+            for _ in range(args.pollers)
+        ]
+        tasks += [
+            poll(client, "/api/challenge/list?page=1", 0, deadline, [], errors)
+            for _ in range(args.listers)
+        ]
+        await asyncio.gather(*tasks)
+    samples.sort()
+    if not samples:
+        print(f"no successful requests, {len(errors)} errors")
+        return
+    print(
+        f"{len(samples)} requests, {len(errors)} errors: "
+        f"mean {statistics.mean(samples):.2f} ms, "
+        f"p50 {percentile(samples, 0.5):.2f} ms, "
+        f"p95 {percentile(samples, 0.95):.2f} ms, "
+        f"p99 {percentile(samples, 0.99):.2f} ms"
+    )
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--token", required=True)
+    parser.add_argument("--challenge", type=int, default=1)
+    parser.add_argument("--pollers", type=int, default=100)
+    parser.add_argument("--listers", type=int, default=0)
+    parser.add_argument("--interval", type=float, default=2.0)
+    parser.add_argument("--duration", type=float, default=30.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
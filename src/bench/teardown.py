@@ -0,0 +1,80 @@
+"""Teardown time of multi-service instances: one-by-one vs. labelled, parallel.
+
+Each instance is a network plus ``--services`` containers running ``sleep``,
+which ignores SIGTERM as PID 1 just like many challenge images, so every stop
+waits out its grace period. Run from ``src`` against a reachable daemon::
+
+    PYTHONPATH=./ python -m bench.teardown --services 5 --grace 3
+"""
+from argparse import ArgumentParser
+from utils.docker import DockerHandler, instance_labels
+from utils.teardown import teardown_instance
+from uuid import uuid4
+import statistics
+import time
+
+
+def create_instance(docker: DockerHandler, image: str, services: int) -> str:
+    instance = f"bench-teardown-{uuid4().hex[:8]}"
+    network = docker.create_challenge_network(
+        f"{instance}-network", labels=instance_labels(instance)
+    )
+    for i in range(services):
+        container = docker.create_container(
+            image,
+            command=["sleep", "3600"],
+            name=f"{instance}-service{i}",
+            network=network.name,
+            labels=instance_labels(instance, service=f"service{i}"),
+            detach=True,
+        )
+        container.start()
+    return instance
+
+
+def sequential(docker: DockerHandler, instance: str, services: int, grace: int):
+    """The previous teardown: look up, stop and remove each container in turn."""
+    for i in range(services):
+        container = docker.get_container(f"{instance}-service{i}")
+        if container:
+            container.stop()
+            container.remove()
+    docker.remove_network(f"{instance}-network")
+
+
+def parallel(docker: DockerHandler, instance: str, services: int, grace: int):
+    teardown_instance(docker, instance, grace=grace)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--services", type=int, default=5)
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--grace", type=int, default=3)
+    parser.add_argument("--image", default="alpine:3")
+    parser.add_argument(
+        "--skip-sequential",
+        action="store_true",
+        help="only measure the labelled teardown (sequential waits 10s per container)",
+    )
+    args = parser.parse_args()
+    docker = DockerHandler()
+    docker.pull_image(args.image)
+    strategies = [("parallel", parallel)]
+    if not args.skip_sequential:
+        strategies.insert(0, ("sequential", sequential))
+    for name, fn in strategies:
+        samples = []
+        for _ in range(args.instances):
+            instance = create_instance(docker, args.image, args.services)
+            started_at = time.perf_counter()
+            fn(docker, instance, args.services, args.grace)
+            samples.append(time.perf_counter() - started_at)
+        print(
+            f"{name:>10}: {args.services} services, mean {statistics.mean(samples):.2f} s, "
+            f"max {max(samples):.2f} s over {len(samples)} instances"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,151 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
+from repository.cache import CatalogueCache
 from repository.challenge import ChallengeRepository
-from repository import Storage
-from worker import clean_challenge
+from repository import Storage, RedisStorage
+from utils.expiry import JoinExpiry, JoinReaper
+from utils.leader import LeaderLease
+from utils.state import InstanceState
+from utils.admission import AdmissionQueue
+from worker import (
+    admit_queued,
+    clean_challenges,
+    reconcile,
+    refill_warm_pool,
+    release_instances,
+)
+from config import config
+from datetime import datetime
+from typing import Optional
 import logging
+import time
 
 log = logging.getLogger(__name__)
 
+# Built by start(), so importing this module touches no Redis.
+leader: Optional[LeaderLease] = None
+reaper: Optional[JoinReaper] = None
+scheduler = BackgroundScheduler()
+
+
+def challenge_repository(storage) -> ChallengeRepository:
+    return ChallengeRepository(storage, CatalogueCache(next(RedisStorage.get())))
+
+
+def finish_expired(expired: dict, started_at: float, source: str):
+    state = InstanceState(next(RedisStorage.get()))
+    for chall_id, result in expired.items():
+        state.set_players(chall_id, result["remaining"])
+    emptied = [x for x, result in expired.items() if result["remaining"] == 0]
+    if emptied:
+        clean_challenges.delay(emptied)
+    pairs = [(x, user) for x, result in expired.items() for user in result["users"]]
+    if pairs:
+        release_instances.delay(pairs)
+    log.info(
+        "%s removed %d joins from %d challenges, %d emptied in %.3fs",
+        source,
+        sum(len(x["users"]) for x in expired.values()),
+        len(expired),
+        len(emptied),
+        time.monotonic() - started_at,
+    )
+
+
+def expire_due_joins(due: list):
+    started_at = time.monotonic()
+    storage = next(Storage.get())
+    expired = challenge_repository(storage).remove_joins(due)
+    finish_expired(expired, started_at, "Join reaper")
+
 
 def delete_joined_users():
+    """Backstop for joins the reaper never saw (e.g. from before it ran)."""
+    started_at = time.monotonic()
     storage = next(Storage.get())
-    challenge_repo = ChallengeRepository(storage)
-    need_removes = challenge_repo.fetch_user_join(15)
-    log.info(f"Need remove: {need_removes}")
-    for need_remove in need_removes:
-        remain_players = challenge_repo.remove_user(
-            need_remove["challenge_id"], need_remove["user_id"]
-        )
-        if len(remain_players) == 0:
-            clean_challenge.delay(need_remove["challenge_id"])
-            log.debug(f"Challenge {need_remove['challenge_id']} cleaned")
-        log.info(
-            f"User {need_remove['user_id']} removed from {need_remove['challenge_id']}"
-        )
+    expired = challenge_repository(storage).expire_joins(
+        datetime.now(),
+        int(config["JOINS"]["LIFETIME"]),
+        int(config["JOINS"]["MAX_LIFETIME"]),
+    )
+    expiry = JoinExpiry(next(RedisStorage.get()))
+    for chall_id, result in expired.items():
+        expiry.remove(chall_id, *result["users"])
+    finish_expired(expired, started_at, "Join sweep")
 
 
-scheduler = BackgroundScheduler()
-# crate job run every 30 minutes
-scheduler.add_job(
-    delete_joined_users,
-    trigger=IntervalTrigger(minutes=15),
-    id="delete_joined_users",
-    name="Delete joined users",
-)
+def refill_warm_pools():
+    storage = next(Storage.get())
+    challenge_repo = challenge_repository(storage)
+    for challenge in challenge_repo.list_warm_pooled():
+        refill_warm_pool.delay(challenge.id)
+
+
+def reconcile_instances():
+    reconcile.delay()
+
+
+def admit_queued_starts():
+    if AdmissionQueue(next(RedisStorage.get())).length():
+        admit_queued.delay()
+
+
+def renew_leader():
+    """Keep the lease, and run the join reaper only while holding it."""
+    if leader.acquire():
+        reaper.start()
+    else:
+        reaper.stop()
+
+
+def start():
+    """Join the leader election and schedule the jobs.
+
+    Every uvicorn worker calls this; only the lease holder runs the jobs
+    and the join reaper.
+    """
+    global leader, reaper
+    store = next(RedisStorage.get())
+    leader = LeaderLease(store, "cron", int(config["CRON"]["LEADER_TTL"]))
+    reaper = JoinReaper(store, expire_due_joins)
+    scheduler.add_job(
+        renew_leader,
+        trigger=IntervalTrigger(seconds=max(1, int(config["CRON"]["LEADER_TTL"]) // 3)),
+        next_run_time=datetime.now(),
+        id="renew_leader",
+        name="Renew cron leader lease",
+    )
+    scheduler.add_job(
+        leader.only(delete_joined_users),
+        trigger=IntervalTrigger(seconds=int(config["CRON"]["SWEEP_INTERVAL"])),
+        id="delete_joined_users",
+        name="Delete joined users",
+    )
+    scheduler.add_job(
+        leader.only(refill_warm_pools),
+        trigger=IntervalTrigger(seconds=int(config["WARM_POOL"]["REFILL_INTERVAL"])),
+        id="refill_warm_pools",
+        name="Refill warm pools",
+    )
+    scheduler.add_job(
+        leader.only(reconcile_instances),
+        trigger=IntervalTrigger(seconds=int(config["RECONCILE"]["INTERVAL"])),
+        id="reconcile_instances",
+        name="Reconcile instances",
+    )
+    scheduler.add_job(
+        leader.only(admit_queued_starts),
+        trigger=IntervalTrigger(seconds=int(config["ADMISSION"]["INTERVAL"])),
+        id="admit_queued_starts",
+        name="Admit queued starts",
+    )
+    scheduler.start()
+
+
+def shutdown():
+    scheduler.shutdown()
+    if reaper:
+        reaper.stop()
+    if leader:
+        leader.release()
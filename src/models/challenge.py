@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional, Union
+from typing import List, Literal, Optional, Union
 
 
 class QueryChallengeModel(BaseModel):
@@ -16,9 +16,17 @@ class ServiceConfig(BaseModel):
     privileged: Optional[bool] = False
     environment: Optional[List[str]] = []
     cap_add: Optional[List[str]] = []
+    depends_on: Optional[List[str]] = []
 
 
 class ChallengeConfig(BaseModel):
     title: str
     visible: Optional[bool] = True
+    # Seconds a join lasts, and how far extensions may push it from the start
+    lifetime: Optional[int] = None
+    max_lifetime: Optional[int] = None
+    # Seconds containers get to exit on SIGTERM before they are killed
+    stop_grace: Optional[int] = None
+    # "player" gives every player an isolated instance of their own
+    instance_scope: Literal["shared", "player"] = "shared"
     services: List[ServiceConfig]
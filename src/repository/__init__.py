@@ -1,7 +1,9 @@
 import redis
+import redis.asyncio as aioredis
 from config import config
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from fastapi import HTTPException
 
 engine = create_engine(config["DATABASE_URL"])
@@ -14,6 +16,22 @@ redis_pool: redis.ConnectionPool = redis.ConnectionPool(
     db=0,
 )
 
+async_engine = create_async_engine(
+    config["ASYNC_DATABASE_URL"],
+    pool_size=int(config["DATABASE_POOL_SIZE"]),
+    pool_pre_ping=True,
+)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
+async_redis_pool: aioredis.ConnectionPool = aioredis.ConnectionPool(
+    host=config["REDIS_HOST"],
+    port=int(config["REDIS_PORT"]),
+    max_connections=config["MAX_CONNECTIONS_REDIS"],
+    db=0,
+)
+
 
 class Storage:
     @staticmethod
@@ -35,3 +53,23 @@ class RedisStorage:
             yield r
         except:
             pass
+
+
+class AsyncStorage:
+    @staticmethod
+    async def get():
+        async with AsyncSessionLocal() as db:
+            try:
+                yield db
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=str(e))
+
+
+class AsyncRedisStorage:
+    @staticmethod
+    def client() -> aioredis.Redis:
+        return aioredis.Redis(connection_pool=async_redis_pool)
+
+    @staticmethod
+    async def get():
+        yield AsyncRedisStorage.client()
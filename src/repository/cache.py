@@ -0,0 +1,183 @@
+from collections import OrderedDict
+from typing import Callable, Optional
+from redis import RedisError
+from redis.asyncio import Redis as AsyncRedis
+from config import config
+from fastapi import Depends
+from repository import AsyncRedisStorage
+import json
+import threading
+import time
+
+VERSIONS_KEY = "catalogue:versions"
+
+
+class _CatalogueCacheBase:
+    """Versions, local LRU and counters shared by the sync and async cache.
+
+    Every cached key embeds a version read from the ``catalogue:versions``
+    hash: ``list`` for the paginated catalogue, ``c:{id}`` for a single
+    challenge and ``u:{uid}`` for the challenges a user joined. Writers bump
+    the versions they affect, so readers stop seeing stale entries and old
+    keys simply expire.
+
+    Each process also remembers the versions it read for ``CACHE.LOCAL_TTL``
+    seconds, so a local hit costs no round trip at all. The process that
+    bumps a version sees it at once; the others within ``LOCAL_TTL``.
+
+    With no Redis store (or when Redis is unreachable) every read goes
+    straight to the loader.
+    """
+
+    _local = OrderedDict()
+    _versions = OrderedDict()
+    _local_lock = threading.Lock()
+    _stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+    def __init__(self, store):
+        self._store = store
+        self._ttl = int(config["CACHE"]["TTL"])
+        self._local_ttl = float(config["CACHE"]["LOCAL_TTL"])
+        self._local_size = int(config["CACHE"]["LOCAL_SIZE"])
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._local_lock:
+            stats = dict(cls._stats)
+        lookups = sum(stats.values())
+        stats["hit_ratio"] = (
+            round((stats["local_hits"] + stats["redis_hits"]) / lookups, 3)
+            if lookups
+            else None
+        )
+        return stats
+
+    @staticmethod
+    def _bumped_fields(challenge_ids=(), user_ids=()) -> list:
+        fields = ["list"]
+        fields += [f"c:{x}" for x in dict.fromkeys(challenge_ids)]
+        fields += [f"u:{x}" for x in dict.fromkeys(user_ids)]
+        return fields
+
+    def _version_bump(self, fields: list):
+        pipe = self._store.pipeline(transaction=False)
+        for field in fields:
+            pipe.hincrby(VERSIONS_KEY, field)
+        return pipe
+
+    def _local_get(self, key: str):
+        with self._local_lock:
+            entry = self._local.get(key)
+            if not entry or entry[0] < time.monotonic():
+                return False, None
+            self._local.move_to_end(key)
+            return True, entry[1]
+
+    def _local_put(self, key: str, value) -> None:
+        self._remember(self._local, key, value)
+
+    def _local_version(self, field: str) -> Optional[int]:
+        with self._local_lock:
+            entry = self._versions.get(field)
+            if not entry or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+    def _remember_versions(self, versions) -> None:
+        for field, version in versions:
+            self._remember(self._versions, field, int(version))
+
+    def _remember(self, entries: OrderedDict, key: str, value) -> None:
+        with self._local_lock:
+            entries[key] = (time.monotonic() + self._local_ttl, value)
+            entries.move_to_end(key)
+            while len(entries) > self._local_size:
+                entries.popitem(last=False)
+
+    @classmethod
+    def _count(cls, name: str) -> None:
+        with cls._local_lock:
+            cls._stats[name] += 1
+
+
+class CatalogueCache(_CatalogueCacheBase):
+    """Invalidation for writers outside the API: the worker, cron and admin."""
+
+    def invalidate(self, challenge_id: int = None, user_id: str = None) -> None:
+        self.invalidate_many(
+            [] if challenge_id is None else [challenge_id],
+            [] if user_id is None else [user_id],
+        )
+
+    def invalidate_many(self, challenge_ids=(), user_ids=()) -> None:
+        if not self._store:
+            return
+        fields = self._bumped_fields(challenge_ids, user_ids)
+        try:
+            versions = self._version_bump(fields).execute()
+        except RedisError:
+            return
+        self._remember_versions(zip(fields, versions))
+
+
+class AsyncCatalogueCache(_CatalogueCacheBase):
+    """Catalogue snapshots in Redis plus a small in-process LRU, with
+    awaitable loaders; the API reads through it.
+    """
+
+    def __init__(self, store: Optional[AsyncRedis] = Depends(AsyncRedisStorage.get)):
+        super().__init__(store)
+
+    async def list_page(self, page: int, loader: Callable) -> dict:
+        return await self._get("list", f"list:{page}", loader)
+
+    async def challenge(self, chall_id: int, loader: Callable) -> Optional[dict]:
+        return await self._get(f"c:{chall_id}", f"challenge:{chall_id}", loader)
+
+    async def joined(self, user_id: str, loader: Callable) -> list:
+        return await self._get(f"u:{user_id}", f"joined:{user_id}", loader)
+
+    async def invalidate(self, challenge_id: int = None, user_id: str = None) -> None:
+        if not self._store:
+            return
+        fields = self._bumped_fields(
+            [] if challenge_id is None else [challenge_id],
+            [] if user_id is None else [user_id],
+        )
+        try:
+            versions = await self._version_bump(fields).execute()
+        except RedisError:
+            return
+        self._remember_versions(zip(fields, versions))
+
+    async def _version(self, field: str) -> int:
+        version = self._local_version(field)
+        if version is None:
+            version = int(await self._store.hget(VERSIONS_KEY, field) or 0)
+            self._remember_versions([(field, version)])
+        return version
+
+    async def _get(self, version_field: str, name: str, loader: Callable):
+        if not self._store:
+            return await loader()
+        try:
+            key = f"catalogue:{name}:{await self._version(version_field)}"
+            found, value = self._local_get(key)
+            if found:
+                self._count("local_hits")
+                return value
+            raw = await self._store.get(key)
+        except RedisError:
+            return await loader()
+        if raw is not None:
+            self._count("redis_hits")
+            value = json.loads(raw)
+        else:
+            self._count("misses")
+            value = await loader()
+            try:
+                await self._store.set(key, json.dumps(value), ex=self._ttl)
+            except RedisError:
+                pass
+        self._local_put(key, value)
+        return value
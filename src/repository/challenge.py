@@ -1,98 +1,276 @@
-from repository import Storage
-from sqlalchemy.orm import Session
+from repository import AsyncStorage
+from repository.cache import CatalogueCache, AsyncCatalogueCache
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import Depends
-from repository.schema import Challenge, Service, User
-from models.challenge import ChallengeConfig, QueryChallengeModel
-from sqlalchemy import and_
+from repository.schema import Challenge, Service, User, joins
+from models.challenge import ChallengeConfig, QueryChallengeModel, ServiceConfig
+from sqlalchemy import and_, case, delete, exists, func, insert, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.sql import text
-from json import dumps
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
 from logging import getLogger
 
 log = getLogger(__name__)
 
+PAGE_SIZE = 50
+
+
+def service_values(service: ServiceConfig, challenge_id: int) -> dict:
+    return dict(
+        challenge_id=challenge_id,
+        image=service.image,
+        name=service.name,
+        privileged=service.privileged,
+        cpu=str(service.cpu),
+        memory=service.memory,
+        ports=service.ports or [],
+        environment=service.environment or [],
+        cap_add=service.cap_add or [],
+        depends_on=service.depends_on or [],
+    )
+
+
+def insert_challenge_statement(challCfg: ChallengeConfig):
+    return (
+        insert(Challenge)
+        .values(
+            title=challCfg.title,
+            visible=challCfg.visible,
+            lifetime=challCfg.lifetime,
+            max_lifetime=challCfg.max_lifetime,
+            stop_grace=challCfg.stop_grace,
+            instance_scope=challCfg.instance_scope,
+        )
+        .returning(Challenge.id)
+    )
+
+
+def update_challenge_statement(challCfg: ChallengeConfig):
+    return (
+        update(Challenge)
+        .where(Challenge.title == challCfg.title)
+        .values(
+            lifetime=challCfg.lifetime,
+            max_lifetime=challCfg.max_lifetime,
+            stop_grace=challCfg.stop_grace,
+            instance_scope=challCfg.instance_scope,
+        )
+        .returning(Challenge.id)
+    )
+
+
+def upsert_services_statement(dialect: str, chall_id: int, services: List[ServiceConfig]):
+    """One multi-row INSERT of ``services`` that updates rows sharing a name.
+
+    Rows are keyed on ``(challenge_id, name)``; ``dialect`` picks the
+    ``ON CONFLICT`` flavour (PostgreSQL in production, SQLite in tests).
+    """
+    rows = [service_values(x, chall_id) for x in services]
+    stmt = (pg_insert if dialect == "postgresql" else sqlite_insert)(Service).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[Service.challenge_id, Service.name],
+        set_={
+            key: stmt.excluded[key]
+            for key in rows[0]
+            if key not in ("challenge_id", "name")
+        },
+    )
+
+
+def prune_services_statement(chall_id: int, services: List[ServiceConfig]):
+    """Delete the services of ``chall_id`` no longer in ``services``."""
+    return delete(Service).where(
+        Service.challenge_id == chall_id,
+        Service.name.notin_([x.name for x in services]),
+    )
+
+
+def apply_status(challenge: Challenge, connection_info: dict = None) -> None:
+    if connection_info:
+        challenge.connection_info = connection_info
+        challenge.status = "running"
+    else:
+        challenge.connection_info = None
+        challenge.status = "stop"
+
+
+def list_statement(page: int, user_id: str = None):
+    """One page of visible challenges with player counts and the total.
+
+    Each row carries the challenge, its ``player_count``, whether
+    ``user_id`` has ``joined`` it and the ``total`` of visible challenges.
+    """
+    return (
+        select(
+            Challenge,
+            func.count(joins.c.user_id).label("player_count"),
+            func.coalesce(
+                func.max(case((joins.c.user_id == user_id, 1), else_=0)), 0
+            ).label("joined"),
+            func.count().over().label("total"),
+        )
+        .outerjoin(joins, joins.c.challenge_id == Challenge.id)
+        .where(Challenge.visible == True)
+        .group_by(Challenge.id)
+        .order_by(Challenge.id)
+        .limit(PAGE_SIZE)
+        .offset((page - 1) * PAGE_SIZE)
+    )
+
+
+def detail_statement(chall_id: int):
+    return (
+        select(Challenge)
+        .options(selectinload(Challenge.services), selectinload(Challenge.players))
+        .where(Challenge.id == chall_id)
+        .execution_options(populate_existing=True)
+    )
+
+
+def joined_statement(user_id: str):
+    return select(joins.c.challenge_id).where(joins.c.user_id == user_id)
+
+
+def is_joined_statement(chall_id: int, user_id: str):
+    return select(
+        exists().where(
+            and_(joins.c.challenge_id == chall_id, joins.c.user_id == user_id)
+        )
+    )
+
+
+def catalogue_page(rows, total: int) -> dict:
+    return {
+        "total": total,
+        "data": [
+            {
+                "id": x.Challenge.id,
+                "title": x.Challenge.title,
+                "instance_scope": x.Challenge.instance_scope,
+                "connection_info": x.Challenge.connection_info,
+                "player_count": x.player_count,
+            }
+            for x in rows
+        ],
+    }
+
+
+def challenge_detail(challenge: Optional[Challenge]) -> Optional[dict]:
+    if not challenge:
+        return None
+    return {
+        "id": challenge.id,
+        "title": challenge.title,
+        "status": challenge.status,
+        "instance_scope": challenge.instance_scope,
+        "connection_info": challenge.connection_info,
+        "services": [
+            {
+                "name": x.name,
+                "image": x.image,
+                "ports": x.ports,
+            }
+            for x in challenge.services
+        ],
+        "players": [
+            {"id": x.id, "display_name": x.display_name} for x in challenge.players
+        ],
+    }
+
+
+def outlived_join_clause(dialect: str, now: datetime, lifetime: int, max_lifetime: int):
+    """Joins older than their challenge's maximum lifetime.
+
+    ``lifetime`` and ``max_lifetime`` stand in for challenges that do not
+    set their own; ``dialect`` picks the date arithmetic.
+    """
+    greatest = func.greatest if dialect == "postgresql" else func.max
+    limit = (
+        select(
+            greatest(
+                func.coalesce(Challenge.max_lifetime, max_lifetime),
+                func.coalesce(Challenge.lifetime, lifetime),
+            )
+        )
+        .where(Challenge.id == joins.c.challenge_id)
+        .scalar_subquery()
+    )
+    if dialect == "postgresql":
+        return joins.c.joined_at + func.make_interval(0, 0, 0, 0, 0, 0, limit) < now
+    return func.julianday(joins.c.joined_at) + limit / 86400.0 < func.julianday(now)
+
 
 class ChallengeRepository:
-    def __init__(self, db: Session = Depends(Storage.get)):
+    def __init__(self, db: Session, cache: CatalogueCache):
         self._session = db
+        self._cache = cache
 
     def create(self, challCfg: ChallengeConfig):
         try:
-            chall = Challenge(
-                title=challCfg.title,
-                visible=challCfg.visible,
-            )
-            chall = self.add_and_refresh(chall)
-            for service in challCfg.services:
-                new_service = Service(
-                    image=service.image,
-                    name=service.name,
-                    challenge_id=chall.id,
-                    privileged=service.privileged,
-                    cpu=str(service.cpu),
-                    memory=service.memory,
-                    ports=dumps(service.ports),
-                    environment=dumps(service.environment or []),
-                    cap_add=dumps(service.cap_add or []),
-                )
-                new_service = self.add_and_refresh(new_service)
-                self._session.commit()
-            self._session.refresh(chall)
-            return chall
+            chall_id = self._session.execute(
+                insert_challenge_statement(challCfg)
+            ).scalar_one()
+            self._write_services(chall_id, challCfg.services)
+            self._session.commit()
         except Exception as e:
             self._session.rollback()
             raise Exception(e)
+        self._cache.invalidate(challenge_id=chall_id)
+        return self.find_detail(chall_id)
 
     def update(self, challCfg: ChallengeConfig):
         try:
-            chall = self.find_one(QueryChallengeModel(title=challCfg.title))
-            if not chall:
+            chall_id = self._session.execute(
+                update_challenge_statement(challCfg)
+            ).scalar_one_or_none()
+            if chall_id is None:
                 raise Exception("Challenge not found")
-            for service in challCfg.services:
-                service_db = (
-                    self._session.query(Service)
-                    .filter(
-                        and_(
-                            Service.challenge_id == chall.id,
-                            Service.image == service.image,
-                        )
-                    )
-                    .first()
-                )
-                if service_db:
-                    for key, value in service.model_dump(exclude_none=True).items():
-                        if type(value) == list:
-                            value = dumps(value)
-                        setattr(service_db, key, value)
-                    self._session.commit()
-                    self._session.refresh(service_db)
-                else:
-                    new_service = Service(
-                        image=service.image,
-                        name=service.name,
-                        challenge_id=chall.id,
-                        privileged=service.privileged,
-                        cpu=str(service.cpu),
-                        memory=service.memory,
-                        ports=dumps(service.ports),
-                        environment=dumps(service.environment or []),
-                        cap_add=dumps(service.cap_add or []),
-                    )
-                    new_service = self.add_and_refresh(new_service)
-            self._session.refresh(chall)
-            return chall
+            self._write_services(chall_id, challCfg.services, prune=True)
+            self._session.commit()
         except Exception as e:
             self._session.rollback()
             raise Exception(e)
+        self._cache.invalidate(challenge_id=chall_id)
+        return self.find_detail(chall_id)
 
-    def list(self, page: int = 1):
+    def _write_services(self, chall_id: int, services, prune: bool = False):
+        if prune:
+            self._session.execute(prune_services_statement(chall_id, services))
+        if services:
+            dialect = self._session.get_bind().dialect.name
+            self._session.execute(
+                upsert_services_statement(dialect, chall_id, services)
+            )
+
+    def list(self, page: int = 1, user_id: str = None):
+        """Return one page of visible challenges and the number of them.
+
+        See :func:`list_statement` for the columns of each row.
+        """
+        rows = self._session.execute(list_statement(page, user_id)).all()
+        if rows:
+            return rows, rows[0].total
+        return rows, self.count(visible_only=True) if page > 1 else 0
+
+    def find_detail(self, chall_id: int):
+        return self._session.execute(detail_statement(chall_id)).scalars().first()
+
+    def is_joined(self, chall_id: int, user_id: str) -> bool:
+        return self._session.execute(is_joined_statement(chall_id, user_id)).scalar()
+
+    def list_warm_pooled(self):
         return (
             self._session.query(Challenge)
-            .filter(Challenge.visible == True)
-            .limit(50)
-            .offset((page - 1) * 50)
+            .filter(Challenge.warm_pool_size > 0)
             .all()
         )
 
+    def list_all(self):
+        return self._session.query(Challenge).order_by(Challenge.id).all()
+
     def find_one(self, query: QueryChallengeModel):
         return (
             self._session.query(Challenge)
@@ -107,8 +285,11 @@ class ChallengeRepository:
             self._session.commit()
         return array
 
-    def count(self):
-        return self._session.query(Challenge).count()
+    def count(self, visible_only: bool = False):
+        query = self._session.query(Challenge)
+        if visible_only:
+            query = query.filter(Challenge.visible == True)
+        return query.count()
 
     def add_and_refresh(self, obj):
         self._session.add(obj)
@@ -117,19 +298,17 @@ class ChallengeRepository:
         return obj
 
     def change_status(self, challenge, connection_info: dict = None):
-        if connection_info:
-            challenge.connection_info = dumps(connection_info)
-            challenge.status = "running"
-        else:
-            challenge.connection_info = None
-            challenge.status = "stop"
+        apply_status(challenge, connection_info)
         challenge = self.add_and_refresh(challenge)
+        self._cache.invalidate(challenge_id=challenge.id)
         return challenge
 
     def add_user(self, challenge, user):
         try:
-            challenge.players.append(user)
+            # The user may come from the auth cache rather than this session.
+            challenge.players.append(self._session.merge(user, load=False))
             challenge = self.add_and_refresh(challenge)
+            self._cache.invalidate(challenge_id=challenge.id, user_id=user.id)
             return challenge
         except Exception as e:
             self._session.rollback()
@@ -145,25 +324,67 @@ class ChallengeRepository:
                 return []
             challenge.players.remove(user)
             challenge = self.add_and_refresh(challenge)
+            self._cache.invalidate(challenge_id=challenge_id, user_id=user_id)
             return challenge.players
         except:
             return []
 
-    def fetch_user_join(self, minutes: int):
+    def expire_joins(
+        self, now: datetime, lifetime: int, max_lifetime: int
+    ) -> Dict[int, dict]:
+        """Drop every join that outlived its challenge's maximum lifetime.
+
+        ``lifetime`` and ``max_lifetime`` stand in for challenges that do
+        not set their own. See :meth:`remove_joins` for the result.
+        """
+        dialect = self._session.get_bind().dialect.name
+        return self._delete_joins(
+            joins.delete().where(
+                outlived_join_clause(dialect, now, lifetime, max_lifetime)
+            )
+        )
+
+    def remove_joins(self, pairs: List[Tuple[int, str]]) -> Dict[int, dict]:
+        """Drop the given ``(challenge_id, user_id)`` joins in one transaction.
+
+        Returns, per affected challenge, the users that were removed and the
+        number of players left.
+        """
+        if not pairs:
+            return {}
+        return self._delete_joins(
+            joins.delete().where(
+                tuple_(joins.c.challenge_id, joins.c.user_id).in_(pairs)
+            )
+        )
+
+    def _delete_joins(self, statement) -> Dict[int, dict]:
         try:
-            results = self._session.execute(
-                text(
-                    "SELECT * FROM joins WHERE joined_at < NOW() - INTERVAL ':minutes' MINUTE"
-                ),
-                {"minutes": minutes},
-            ).fetchall()
-            log.debug(f"Results: {results}")
-            return [
-                {"challenge_id": result[1], "user_id": result[2]} for result in results
-            ]
+            removed = self._session.execute(
+                statement.returning(joins.c.challenge_id, joins.c.user_id)
+            ).all()
+            expired = {}
+            for chall_id, user_id in removed:
+                expired.setdefault(chall_id, {"users": [], "remaining": 0})
+                expired[chall_id]["users"].append(user_id)
+            if expired:
+                remaining = self._session.execute(
+                    select(joins.c.challenge_id, func.count())
+                    .where(joins.c.challenge_id.in_(expired))
+                    .group_by(joins.c.challenge_id)
+                ).all()
+                for chall_id, count in remaining:
+                    expired[chall_id]["remaining"] = count
+            self._session.commit()
         except Exception as e:
-            log.debug(f"Error: {e}")
-            return []
+            self._session.rollback()
+            raise Exception(e)
+        if expired:
+            self._cache.invalidate_many(
+                challenge_ids=expired,
+                user_ids=[x for result in expired.values() for x in result["users"]],
+            )
+        return expired
 
     def delete(self, challenge_id: int):
         try:
@@ -174,6 +395,7 @@ class ChallengeRepository:
             # Delete the challenge (cascade will handle related services and joins)
             self._session.delete(challenge)
             self._session.commit()
+            self._cache.invalidate(challenge_id=challenge_id)
             # Reset sequence if no challenges left
             if self.count() == 0:
                 self._session.execute(text("ALTER SEQUENCE challenges_id_seq RESTART WITH 1;"))
@@ -183,3 +405,162 @@ class ChallengeRepository:
             log.debug(f"Error deleting challenge: {e}")
             self._session.rollback()
             return False
+
+
+class AsyncChallengeRepository:
+    """:class:`ChallengeRepository` on an ``AsyncSession`` for the API.
+
+    Celery tasks and cron keep using the synchronous repository.
+    """
+
+    def __init__(
+        self,
+        db: AsyncSession = Depends(AsyncStorage.get),
+        cache: AsyncCatalogueCache = Depends(AsyncCatalogueCache),
+    ):
+        self._session = db
+        self._cache = cache
+
+    async def create(self, challCfg: ChallengeConfig):
+        try:
+            chall_id = (
+                await self._session.execute(insert_challenge_statement(challCfg))
+            ).scalar_one()
+            await self._write_services(chall_id, challCfg.services)
+            await self._session.commit()
+        except Exception as e:
+            await self._session.rollback()
+            raise Exception(e)
+        await self._cache.invalidate(challenge_id=chall_id)
+        return await self.find_detail(chall_id)
+
+    async def update(self, challCfg: ChallengeConfig):
+        try:
+            chall_id = (
+                await self._session.execute(update_challenge_statement(challCfg))
+            ).scalar_one_or_none()
+            if chall_id is None:
+                raise Exception("Challenge not found")
+            await self._write_services(chall_id, challCfg.services, prune=True)
+            await self._session.commit()
+        except Exception as e:
+            await self._session.rollback()
+            raise Exception(e)
+        await self._cache.invalidate(challenge_id=chall_id)
+        return await self.find_detail(chall_id)
+
+    async def _write_services(self, chall_id: int, services, prune: bool = False):
+        if prune:
+            await self._session.execute(prune_services_statement(chall_id, services))
+        if services:
+            dialect = self._session.get_bind().dialect.name
+            await self._session.execute(
+                upsert_services_statement(dialect, chall_id, services)
+            )
+
+    async def list(self, page: int = 1, user_id: str = None):
+        rows = (await self._session.execute(list_statement(page, user_id))).all()
+        if rows:
+            return rows, rows[0].total
+        return rows, await self.count(visible_only=True) if page > 1 else 0
+
+    async def list_snapshot(self, page: int = 1) -> dict:
+        async def load():
+            return catalogue_page(*await self.list(page))
+
+        return await self._cache.list_page(page, load)
+
+    async def joined_ids(self, user_id: str) -> list:
+        async def load():
+            result = await self._session.execute(joined_statement(user_id))
+            return result.scalars().all()
+
+        return await self._cache.joined(user_id, load)
+
+    async def detail_snapshot(self, chall_id: int) -> Optional[dict]:
+        async def load():
+            return challenge_detail(await self.find_detail(chall_id))
+
+        return await self._cache.challenge(chall_id, load)
+
+    async def find_detail(self, chall_id: int):
+        result = await self._session.execute(detail_statement(chall_id))
+        return result.scalars().first()
+
+    async def is_joined(self, chall_id: int, user_id: str) -> bool:
+        result = await self._session.execute(is_joined_statement(chall_id, user_id))
+        return result.scalar()
+
+    async def find_one(self, query: QueryChallengeModel):
+        result = await self._session.execute(
+            select(Challenge).filter_by(**query.model_dump(exclude_none=True))
+        )
+        return result.scalars().first()
+
+    async def count(self, visible_only: bool = False):
+        query = select(func.count()).select_from(Challenge)
+        if visible_only:
+            query = query.where(Challenge.visible == True)
+        return (await self._session.execute(query)).scalar()
+
+    async def change_status(self, challenge, connection_info: dict = None):
+        apply_status(challenge, connection_info)
+        self._session.add(challenge)
+        await self._session.commit()
+        await self._cache.invalidate(challenge_id=challenge.id)
+        return challenge
+
+    async def add_user(self, challenge, user):
+        try:
+            await self._session.execute(
+                joins.insert().values(challenge_id=challenge.id, user_id=user.id)
+            )
+            await self._session.commit()
+        except Exception as e:
+            await self._session.rollback()
+            return None
+        await self._cache.invalidate(challenge_id=challenge.id, user_id=user.id)
+        return challenge
+
+    async def remove_user(self, challenge_id, user_id):
+        """Drop ``user_id`` from the challenge and return the remaining players."""
+        try:
+            await self._session.execute(
+                joins.delete().where(
+                    and_(
+                        joins.c.challenge_id == challenge_id,
+                        joins.c.user_id == user_id,
+                    )
+                )
+            )
+            await self._session.commit()
+            await self._cache.invalidate(challenge_id=challenge_id, user_id=user_id)
+            result = await self._session.execute(
+                select(User)
+                .join(joins, joins.c.user_id == User.id)
+                .where(joins.c.challenge_id == challenge_id)
+            )
+            return result.scalars().all()
+        except:
+            await self._session.rollback()
+            return []
+
+    async def delete(self, challenge_id: int):
+        try:
+            challenge = await self.find_one(QueryChallengeModel(id=challenge_id))
+            if not challenge:
+                return False
+            await self._session.delete(challenge)
+            await self._session.commit()
+            await self._cache.invalidate(challenge_id=challenge_id)
+            # Reset sequence if no challenges left
+            if await self.count() == 0:
+                await self._session.execute(
+                    text("ALTER SEQUENCE challenges_id_seq RESTART WITH 1;")
+                )
+                await self._session.commit()
+            return True
+        except Exception as e:
+            log.debug(f"Error deleting challenge: {e}")
+            await self._session.rollback()
+            return False
@@ -0,0 +1,128 @@
+from repository import Storage, AsyncStorage
+from repository.schema import Challenge, Instance
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import delete, func, insert, select, tuple_
+from fastapi import Depends
+from typing import List, Optional, Tuple
+
+
+def detail_statement(instance_id: int):
+    return (
+        select(Instance)
+        .options(selectinload(Instance.challenge).selectinload(Challenge.services))
+        .where(Instance.id == instance_id)
+        .execution_options(populate_existing=True)
+    )
+
+
+def instance_summary(instance: Instance) -> dict:
+    return {
+        "id": instance.id,
+        "name": instance.name,
+        "challenge_id": instance.challenge_id,
+        "owner_id": instance.owner_id,
+        "connection_info": instance.connection_info,
+        "created_at": instance.created_at.timestamp() if instance.created_at else None,
+    }
+
+
+class InstanceRepository:
+    """Per-player instances as seen by the worker and the cron jobs."""
+
+    def __init__(self, db: Session = Depends(Storage.get)):
+        self._session = db
+
+    def find_one(self, instance_id: int) -> Optional[Instance]:
+        return self._session.execute(detail_statement(instance_id)).scalars().first()
+
+    def find_pairs(self, pairs: List[Tuple[int, str]]) -> List[Instance]:
+        """Instances of the given ``(challenge_id, owner_id)`` pairs."""
+        if not pairs:
+            return []
+        return (
+            self._session.execute(
+                select(Instance).where(
+                    tuple_(Instance.challenge_id, Instance.owner_id).in_(pairs)
+                )
+            )
+            .scalars()
+            .all()
+        )
+
+    def list_all(self) -> List[Instance]:
+        return self._session.execute(select(Instance)).scalars().all()
+
+    def set_connection_info(self, instance: Instance, connection_info: dict):
+        instance.connection_info = connection_info
+        self._session.add(instance)
+        self._session.commit()
+        return instance
+
+    def delete(self, instance_id: int) -> None:
+        self._session.execute(delete(Instance).where(Instance.id == instance_id))
+        self._session.commit()
+
+
+class AsyncInstanceRepository:
+    def __init__(self, db: AsyncSession = Depends(AsyncStorage.get)):
+        self._session = db
+
+    async def create(
+        self, challenge_id: int, owner_id: str, name: str
+    ) -> Optional[Instance]:
+        """Insert the row, or ``None`` if the owner already has one for it."""
+        try:
+            instance_id = (
+                await self._session.execute(
+                    insert(Instance)
+                    .values(challenge_id=challenge_id, owner_id=owner_id, name=name)
+                    .returning(Instance.id)
+                )
+            ).scalar_one()
+            await self._session.commit()
+        except Exception:
+            await self._session.rollback()
+            return None
+        return await self.find_one(instance_id)
+
+    async def find_one(self, instance_id: int) -> Optional[Instance]:
+        result = await self._session.execute(detail_statement(instance_id))
+        return result.scalars().first()
+
+    async def find_for(self, challenge_id: int, owner_id: str) -> Optional[Instance]:
+        result = await self._session.execute(
+            select(Instance).where(
+                Instance.challenge_id == challenge_id, Instance.owner_id == owner_id
+            )
+        )
+        return result.scalars().first()
+
+    async def list_for(self, owner_id: str) -> List[Instance]:
+        result = await self._session.execute(
+            select(Instance).where(Instance.owner_id == owner_id).order_by(Instance.id)
+        )
+        return result.scalars().all()
+
+    async def list_challenge(self, challenge_id: int) -> List[Instance]:
+        result = await self._session.execute(
+            select(Instance).where(Instance.challenge_id == challenge_id)
+        )
+        return result.scalars().all()
+
+    async def count_for(self, owner_id: str) -> int:
+        result = await self._session.execute(
+            select(func.count()).select_from(Instance).where(Instance.owner_id == owner_id)
+        )
+        return result.scalar()
+
+    async def list_page(self, page: int = 1, page_size: int = 100):
+        """One page of every live instance, oldest first, and their number."""
+        result = await self._session.execute(
+            select(Instance, func.count().over().label("total"))
+            .order_by(Instance.id)
+            .limit(page_size)
+            .offset((page - 1) * page_size)
+        )
+        rows = result.all()
+        return [x.Instance for x in rows], rows[0].total if rows else 0
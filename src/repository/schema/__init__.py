@@ -9,7 +9,10 @@ from sqlalchemy import (
     Enum,
     Boolean,
     DateTime,
+    Index,
+    JSON,
 )
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship, mapped_column
 from typing import List
 import datetime
@@ -17,6 +20,9 @@ from uuid import uuid4
 
 Base = declarative_base()
 
+# JSONB on PostgreSQL, plain JSON elsewhere (the SQLite test database).
+JSONType = JSON().with_variant(JSONB(), "postgresql")
+
 
 class User(Base):
     __tablename__ = "users"
@@ -33,6 +39,9 @@ class User(Base):
 
 class Service(Base):
     __tablename__ = "services"
+    __table_args__ = (
+        Index("ix_services_challenge_id_name", "challenge_id", "name", unique=True),
+    )
 
     id = mapped_column(Integer, primary_key=True, index=True, autoincrement=True)
 
@@ -46,9 +55,10 @@ class Service(Base):
     cpu = mapped_column(String, default="0.5")
     memory = mapped_column(String, default="512M")
 
-    ports = mapped_column(String, nullable=False)
-    environment = mapped_column(String, nullable=False)
-    cap_add = mapped_column(String, nullable=False)
+    ports = mapped_column(JSONType, nullable=False)
+    environment = mapped_column(JSONType, nullable=False)
+    cap_add = mapped_column(JSONType, nullable=False)
+    depends_on = mapped_column(JSONType, nullable=True)
 
     def __repr__(self):
         return f"<Service {self.name} with image: {self.image}>"
@@ -73,17 +83,69 @@ class Challenge(Base):
 
     visible = mapped_column(Boolean, default=True)
 
-    connection_info = mapped_column(String, nullable=True)
+    warm_pool_size = mapped_column(Integer, default=0)
+
+    lifetime = mapped_column(Integer, nullable=True)
+
+    max_lifetime = mapped_column(Integer, nullable=True)
+
+    stop_grace = mapped_column(Integer, nullable=True)
+
+    # "shared": one instance for everyone who joins; "player": one per player
+    instance_scope = mapped_column(
+        Enum("shared", "player", name="instance_scope"), default="shared"
+    )
+
+    instances: Mapped[List["Instance"]] = relationship(
+        "Instance", back_populates="challenge", passive_deletes=True
+    )
+
+    connection_info = mapped_column(JSONType, nullable=True)
 
     def __repr__(self):
         return f"<Challenge {self.title} with status: {'running' if self.connection_info else 'stopped'}>"
 
 
+class Instance(Base):
+    """A player's own instance of a per-player challenge.
+
+    The row lives from the start request until the instance is cleaned;
+    its progress is tracked in the ``player:{id}`` hash.
+    """
+
+    __tablename__ = "instances"
+    __table_args__ = (
+        Index("ix_instances_challenge_id_owner_id", "challenge_id", "owner_id", unique=True),
+    )
+
+    id = mapped_column(Integer, primary_key=True, index=True, autoincrement=True)
+
+    name = mapped_column(String, unique=True, nullable=False)
+
+    challenge_id = mapped_column(
+        Integer, ForeignKey("challenges.id", ondelete="CASCADE"), nullable=False
+    )
+    challenge = relationship("Challenge", back_populates="instances")
+
+    owner_id = mapped_column(
+        String, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    owner = relationship("User")
+
+    connection_info = mapped_column(JSONType, nullable=True)
+
+    created_at = mapped_column(DateTime, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return f"<Instance {self.name} of challenge {self.challenge_id}>"
+
+
 joins = Table(
     "joins",
     Base.metadata,
     Column("id", Integer, primary_key=True, index=True, autoincrement=True),
     Column("challenge_id", Integer, ForeignKey(Challenge.id)),
-    Column("user_id", String, ForeignKey(User.id)),
-    Column("joined_at", DateTime, default=datetime.datetime.now),
+    Column("user_id", String, ForeignKey(User.id), index=True),
+    Column("joined_at", DateTime, default=datetime.datetime.now, index=True),
+    Index("ix_joins_challenge_id_user_id", "challenge_id", "user_id", unique=True),
 )
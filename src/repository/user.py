@@ -1,9 +1,11 @@
 from fastapi import Depends
-from repository import Storage
+from repository import Storage, AsyncStorage
 from repository.schema import User
 from typing import Optional
 from models.user import UserModel, QueryUserModel
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 class UserRepository:
@@ -39,3 +41,36 @@ class UserRepository:
             )
         except:
             return None
+
+
+class AsyncUserRepository:
+    def __init__(self, db: AsyncSession = Depends(AsyncStorage.get)):
+        self._session = db
+
+    async def create(self, user: UserModel) -> Optional[User]:
+        try:
+            user = User(**user.model_dump(exclude_none=True))
+            self._session.add(user)
+            await self._session.commit()
+            return user
+        except Exception as e:
+            await self._session.rollback()
+            return None
+
+    async def delete(self, user: User) -> bool:
+        try:
+            await self._session.delete(user)
+            await self._session.commit()
+            return True
+        except:
+            await self._session.rollback()
+            return False
+
+    async def find_one(self, query: QueryUserModel) -> Optional[User]:
+        try:
+            result = await self._session.execute(
+                select(User).filter_by(**query.model_dump(exclude_none=True))
+            )
+            return result.scalars().first()
+        except:
+            return None
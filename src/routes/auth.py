@@ -22,7 +22,7 @@ async def signin(
     response: Response,
     service: AuthService = Depends(AuthService),
 ):
-    access_token = service.signin(user)
+    access_token = await service.signin(user)
     response = APIResponse.as_json(
         code=status.HTTP_200_OK, status="Login successful", data={"token": access_token}
     )
@@ -41,7 +41,7 @@ async def signup(
     return APIResponse.as_json(
         code=status.HTTP_201_CREATED,
         status="User created",
-        data={"user": (service.signup(user)).model_dump()},
+        data={"user": (await service.signup(user)).model_dump()},
     )
 
 
@@ -52,7 +52,7 @@ async def logout(
     user=Depends(auth),
 ):
     uid = user.id
-    service.logout(uid)
+    await service.logout(uid)
     response = APIResponse.as_json(code=status.HTTP_200_OK, status="Logout successful")
     response.delete_cookie("auth")
     return response
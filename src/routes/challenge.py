@@ -1,5 +1,7 @@
-from fastapi import APIRouter, status, Depends, Query
+from fastapi import APIRouter, status, Depends, Header, Query
+from fastapi.responses import StreamingResponse
 from utils.api import APIResponse
+from utils.events import SSE_HEADERS
 from services.challenge import ChallengeService
 from models.dto import NewChallengeRequest, InstanceRequest
 
@@ -13,10 +15,10 @@ async def create_challenge(
 ):
     chall = None
     is_update = False
-    if not service.check_exist(newChallReq.config):
-        chall = service.create(newChallReq)
+    if not await service.check_exist(newChallReq.config):
+        chall = await service.create(newChallReq)
     else:
-        chall = service.update(newChallReq)
+        chall = await service.update(newChallReq)
         is_update = True
     return APIResponse.as_json(
         code=status.HTTP_201_CREATED if not is_update else status.HTTP_200_OK,
@@ -38,15 +40,111 @@ async def request_spawn_instance(
     instance: InstanceRequest,
     service: ChallengeService = Depends(ChallengeService),
 ):
-    success = service.create_instance(instance.challenge_id)
+    start = await service.create_instance(instance.challenge_id)
+    if not start:
+        message = "Instance is already running"
+    elif start["coalesced"]:
+        message = "Instance is already starting"
+    else:
+        message = "Instance started successfully"
+    return APIResponse.as_json(code=status.HTTP_200_OK, status=message, data=start)
+
+
+@router.get("/ports")
+async def get_port_stats(
+    service: ChallengeService = Depends(ChallengeService),
+):
+    if not service._user or not service._user.is_admin:
+        return APIResponse.as_json(
+            code=status.HTTP_403_FORBIDDEN, status="You are not allowed to view ports"
+        )
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK,
+        status="Port pool retrieved successfully",
+        data=await service.port_stats(),
+    )
+
+
+@router.get("/nodes")
+async def get_node_usage(
+    service: ChallengeService = Depends(ChallengeService),
+):
+    if not service._user or not service._user.is_admin:
+        return APIResponse.as_json(
+            code=status.HTTP_403_FORBIDDEN, status="You are not allowed to view nodes"
+        )
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK,
+        status="Node usage retrieved successfully",
+        data=await service.node_usage(),
+    )
+
+
+@router.get("/queues")
+async def get_queue_stats(
+    service: ChallengeService = Depends(ChallengeService),
+):
+    if not service._user or not service._user.is_admin:
+        return APIResponse.as_json(
+            code=status.HTTP_403_FORBIDDEN, status="You are not allowed to view queues"
+        )
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK,
+        status="Queue stats retrieved successfully",
+        data=await service.queue_stats(),
+    )
+
+
+@router.get("/cache")
+async def get_cache_stats(
+    service: ChallengeService = Depends(ChallengeService),
+):
+    if not service._user or not service._user.is_admin:
+        return APIResponse.as_json(
+            code=status.HTTP_403_FORBIDDEN, status="You are not allowed to view cache"
+        )
     return APIResponse.as_json(
         code=status.HTTP_200_OK,
+        status="Cache statistics retrieved successfully",
+        data=service.cache_stats(),
+    )
+
+
+@router.get("/reconcile")
+async def get_reconcile_report(
+    service: ChallengeService = Depends(ChallengeService),
+):
+    if not service._user or not service._user.is_admin:
+        return APIResponse.as_json(
+            code=status.HTTP_403_FORBIDDEN,
+            status="You are not allowed to view the reconciliation report",
+        )
+    report = await service.reconcile_report()
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK if report else status.HTTP_404_NOT_FOUND,
         status=(
-            "Instance started successfully"
-            if success
-            else "Instance is already running"
+            "Reconciliation report retrieved successfully"
+            if report
+            else "No reconciliation has run yet"
         ),
-        data=success,
+        data=report,
+    )
+
+
+@router.post("/reconcile")
+async def request_reconcile(
+    dry_run: bool = Query(False, title="Only report the differences"),
+    service: ChallengeService = Depends(ChallengeService),
+):
+    if not service._user or not service._user.is_admin:
+        return APIResponse.as_json(
+            code=status.HTTP_403_FORBIDDEN,
+            status="You are not allowed to reconcile instances",
+        )
+    return APIResponse.as_json(
+        code=status.HTTP_202_ACCEPTED,
+        status="Reconciliation queued",
+        data={"task_id": await service.reconcile(dry_run), "dry_run": dry_run},
     )
 
 
@@ -55,7 +153,7 @@ async def get_challenge(
     challenge_id: int,
     service: ChallengeService = Depends(ChallengeService),
 ):
-    challenge = service.get_challenge(challenge_id)
+    challenge = await service.get_challenge(challenge_id)
     return APIResponse.as_json(
         code=status.HTTP_200_OK,
         status="Challenge retrieved successfully",
@@ -68,7 +166,7 @@ async def get_instance_status(
     challenge_id: int,
     service: ChallengeService = Depends(ChallengeService),
 ):
-    chall_status = service.get_challenge_status(challenge_id)
+    chall_status = await service.get_challenge_status(challenge_id)
     return APIResponse.as_json(
         code=status.HTTP_200_OK,
         status="Instance status retrieved successfully",
@@ -76,6 +174,37 @@ async def get_instance_status(
     )
 
 
+@router.get("/{challenge_id}/events")
+async def stream_instance_status(
+    challenge_id: int,
+    last_event_id: str = Header(None, alias="Last-Event-ID"),
+    service: ChallengeService = Depends(ChallengeService),
+):
+    return StreamingResponse(
+        service.events(challenge_id, last_event_id),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+@router.get("/{challenge_id}/pool")
+async def get_warm_pool_stats(
+    challenge_id: int,
+    service: ChallengeService = Depends(ChallengeService),
+):
+    if not service._user or not service._user.is_admin:
+        return APIResponse.as_json(
+            code=status.HTTP_403_FORBIDDEN,
+            status="You are not allowed to view the warm pool",
+        )
+    stats = await service.warm_pool_stats(challenge_id)
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK if stats else status.HTTP_404_NOT_FOUND,
+        status="Warm pool retrieved successfully" if stats else "Challenge not found",
+        data=stats,
+    )
+
+
 @router.get("/{challenge_id}/kick")
 async def kick_user(
     challenge_id: int,
@@ -86,7 +215,7 @@ async def kick_user(
         return APIResponse.as_json(
             code=status.HTTP_403_FORBIDDEN, status="You are not allowed to kick user"
         )
-    remain_users = service.kick_user(challenge_id, email)
+    remain_users = await service.kick_user(challenge_id, email)
     return APIResponse.as_json(
         code=status.HTTP_200_OK,
         status="User kicked successfully",
@@ -103,7 +232,7 @@ async def kick_all(
         return APIResponse.as_json(
             code=status.HTTP_403_FORBIDDEN, status="You are not allowed to kick user"
         )
-    success = service.kick_all(challenge_id)
+    success = await service.kick_all(challenge_id)
     return APIResponse.as_json(
         code=status.HTTP_200_OK,
         status="All users kicked successfully" if success else "No users to kick",
@@ -115,7 +244,7 @@ async def request_join_instance(
     instance: InstanceRequest,
     service: ChallengeService = Depends(ChallengeService),
 ):
-    join_status = service.join_challenge(instance.challenge_id)
+    join_status = await service.join_challenge(instance.challenge_id)
     return APIResponse.as_json(
         code=status.HTTP_200_OK,
         status=(
@@ -126,12 +255,25 @@ async def request_join_instance(
     )
 
 
+@router.post("/extend")
+async def request_extend_instance(
+    instance: InstanceRequest,
+    service: ChallengeService = Depends(ChallengeService),
+):
+    extended = await service.extend_join(instance.challenge_id)
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK if extended else status.HTTP_404_NOT_FOUND,
+        status="Instance extended successfully" if extended else "Not joined",
+        data=extended,
+    )
+
+
 @router.post("/leave")
 async def request_stop_instance(
     instance: InstanceRequest,
     service: ChallengeService = Depends(ChallengeService),
 ):
-    leave_status = service.leave_challenge(instance.challenge_id)
+    leave_status = await service.leave_challenge(instance.challenge_id)
     return APIResponse.as_json(
         code=status.HTTP_200_OK,
         status=(
@@ -152,7 +294,7 @@ async def delete_challenge(
             status="You are not allowed to delete challenges"
         )
     
-    success = service.delete_challenge(challenge_id)
+    success = await service.delete_challenge(challenge_id)
     return APIResponse.as_json(
         code=status.HTTP_200_OK if success else status.HTTP_404_NOT_FOUND,
         status="Challenge deleted successfully" if success else "Challenge not found",
@@ -164,7 +306,7 @@ async def list_challenges(
     page: int,
     service: ChallengeService = Depends(ChallengeService),
 ):
-    challenges = service.list_challenges(page)
+    challenges = await service.list_challenges(page)
     return APIResponse.as_json(
         code=status.HTTP_200_OK,
         status="Challenges retrieved successfully",
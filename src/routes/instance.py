@@ -0,0 +1,108 @@
+from fastapi import APIRouter, status, Depends, Header, Query
+from fastapi.responses import StreamingResponse
+from utils.api import APIResponse
+from utils.events import SSE_HEADERS
+from services.instance import InstanceService
+from models.dto import InstanceRequest
+
+router = APIRouter()
+
+
+@router.post("/start")
+async def request_start_instance(
+    instance: InstanceRequest,
+    service: InstanceService = Depends(InstanceService),
+):
+    return APIResponse.as_json(
+        code=status.HTTP_202_ACCEPTED,
+        status="Instance requested successfully",
+        data=await service.start(instance.challenge_id),
+    )
+
+
+@router.get("/mine")
+async def list_my_instances(
+    service: InstanceService = Depends(InstanceService),
+):
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK,
+        status="Instances retrieved successfully",
+        data=await service.mine(),
+    )
+
+
+@router.get("/list")
+async def list_instances(
+    page: int = Query(1, ge=1),
+    service: InstanceService = Depends(InstanceService),
+):
+    if not service._user or not service._user.is_admin:
+        return APIResponse.as_json(
+            code=status.HTTP_403_FORBIDDEN,
+            status="You are not allowed to view all instances",
+        )
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK,
+        status="Instances retrieved successfully",
+        data=await service.list_all(page),
+    )
+
+
+@router.get("/{instance_id}")
+async def get_instance(
+    instance_id: int,
+    service: InstanceService = Depends(InstanceService),
+):
+    instance = await service.get(instance_id)
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK if instance else status.HTTP_404_NOT_FOUND,
+        status="Instance retrieved successfully" if instance else "Instance not found",
+        data=instance,
+    )
+
+
+@router.get("/{instance_id}/status")
+async def get_instance_status(
+    instance_id: int,
+    service: InstanceService = Depends(InstanceService),
+):
+    instance_status = await service.get_status(instance_id)
+    return APIResponse.as_json(
+        code=status.HTTP_200_OK if instance_status else status.HTTP_404_NOT_FOUND,
+        status=(
+            "Instance status retrieved successfully"
+            if instance_status
+            else "Instance not found"
+        ),
+        data=instance_status,
+    )
+
+
+@router.get("/{instance_id}/events")
+async def stream_instance_status(
+    instance_id: int,
+    last_event_id: str = Header(None, alias="Last-Event-ID"),
+    service: InstanceService = Depends(InstanceService),
+):
+    events = await service.events(instance_id, last_event_id)
+    if not events:
+        return APIResponse.as_json(
+            code=status.HTTP_404_NOT_FOUND,
+            status="Instance not found",
+        )
+    return StreamingResponse(
+        events, media_type="text/event-stream", headers=SSE_HEADERS
+    )
+
+
+@router.delete("/{instance_id}")
+async def clean_instance(
+    instance_id: int,
+    service: InstanceService = Depends(InstanceService),
+):
+    success = await service.clean(instance_id)
+    return APIResponse.as_json(
+        code=status.HTTP_202_ACCEPTED if success else status.HTTP_404_NOT_FOUND,
+        status="Instance cleanup requested" if success else "Instance not found",
+        data=success,
+    )
@@ -1,16 +1,21 @@
-from repository.user import UserRepository
+from repository.user import AsyncUserRepository
 
 from models.dto.user import NewUserRequest, UserResponse, UserRequest
 from models.user import QueryUserModel, UserModel
 
-from utils.gate_keeper import JWTHandler, PasswordHandler
+from utils.gate_keeper import AsyncJWTHandler, PasswordHandler
 from fastapi import Depends, HTTPException
 from uuid import uuid4
 from string import ascii_letters, digits
 from random import choices
 from config import config
-from services.auth.protocols import BaseService
+from services.auth.protocols import (
+    BaseService,
+    CircuitOpenError,
+    UpstreamError,
+)
 from unidecode import unidecode
+import httpx
 
 third_party_module = __import__(
     f"services.auth.protocols.{config['CTF_PLATFORM']}",
@@ -27,15 +32,17 @@ def normalize(name):
 class AuthService:
     def __init__(
         self,
-        repo: UserRepository = Depends(UserRepository),
-        jwt_handler: JWTHandler = Depends(JWTHandler),
+        repo: AsyncUserRepository = Depends(AsyncUserRepository),
+        jwt_handler: AsyncJWTHandler = Depends(AsyncJWTHandler),
     ) -> None:
         self._repo = repo
         self._jwt = jwt_handler
 
-    def signup(self, user: NewUserRequest) -> UserResponse:
+    async def signup(self, user: NewUserRequest) -> UserResponse:
         try:
-            exist_user = self._repo.find_one(query=QueryUserModel(email=user.email))
+            exist_user = await self._repo.find_one(
+                query=QueryUserModel(email=user.email)
+            )
             assert exist_user is None, "User already exists"
             new_user = UserModel(
                 id=str(uuid4()),
@@ -44,7 +51,7 @@ class AuthService:
                 password=PasswordHandler.hash(user.password),
                 display_name=user.display_name,
             )
-            new_user = self._repo.create(new_user)
+            new_user = await self._repo.create(new_user)
             assert new_user is not None, "Failed to create user"
             new_user = UserResponse(
                 id=new_user.id,
@@ -56,7 +63,7 @@ class AuthService:
         except Exception as e:
             raise HTTPException(status_code=204, detail=str(e))
 
-    def signin(self, user: UserRequest) -> str:
+    async def signin(self, user: UserRequest) -> str:
         print(f"DEBUG: Login attempt with email='{user.email}' and password='{user.password}'")
         
         # TEST MODE: Allow test credentials for development
@@ -64,7 +71,7 @@ class AuthService:
             print("DEBUG: Matched test@example.com credentials")
             try:
                 # Create or get test user
-                exist_user = self._repo.find_one(query=QueryUserModel(email="test@example.com"))
+                exist_user = await self._repo.find_one(query=QueryUserModel(email="test@example.com"))
                 if not exist_user:
                     print("DEBUG: Creating new test user")
                     exist_user = UserModel(
@@ -73,12 +80,12 @@ class AuthService:
                         display_name="Test User",
                         is_admin=False,
                     )
-                    exist_user = self._repo.create(exist_user)
+                    exist_user = await self._repo.create(exist_user)
                     if not exist_user:
                         raise Exception("Failed to create user in database")
                     print(f"DEBUG: User created successfully with ID: {exist_user.id}")
                 
-                token = self._jwt.create({"uid": exist_user.id})
+                token = await self._jwt.create({"uid": exist_user.id})
                 if token is None:
                     raise Exception("Failed to create token")
                 print("DEBUG: Successfully created token for test user")
@@ -92,7 +99,7 @@ class AuthService:
             print("DEBUG: Matched admin@example.com credentials")
             try:
                 # Create or get admin user
-                exist_user = self._repo.find_one(query=QueryUserModel(email="admin@example.com"))
+                exist_user = await self._repo.find_one(query=QueryUserModel(email="admin@example.com"))
                 if not exist_user:
                     print("DEBUG: Creating new admin user")
                     exist_user = UserModel(
@@ -101,14 +108,14 @@ class AuthService:
                         display_name="Admin User",
                         is_admin=True,
                     )
-                    exist_user = self._repo.create(exist_user)
+                    exist_user = await self._repo.create(exist_user)
                     if not exist_user:
                         raise Exception("Failed to create admin user in database")
                     print(f"DEBUG: Admin user created successfully with ID: {exist_user.id}")
                 else:
                     print("DEBUG: Found existing admin user")
                 
-                token = self._jwt.create({"uid": exist_user.id})
+                token = await self._jwt.create({"uid": exist_user.id})
                 if token is None:
                     raise Exception("Failed to create token")
                 print("DEBUG: Successfully created token for admin user")
@@ -121,13 +128,15 @@ class AuthService:
         # Original CTFd authentication for other users
         try:
             thirdPartyService = Service()
-            user_data = thirdPartyService.fetch_user_info(user.email, user.password)
+            user_data = await thirdPartyService.fetch_user_info(
+                user.email, user.password
+            )
             if not user_data:
                 raise Exception("Failed to fetch user data from CTFd")
             
             print(f"DEBUG: CTFd user data: email={user_data['email']}, name={user_data['name']}")
             
-            exist_user = self._repo.find_one(
+            exist_user = await self._repo.find_one(
                 query=QueryUserModel(email=user_data["email"])
             )
             
@@ -139,11 +148,11 @@ class AuthService:
                     display_name=normalize(user_data["name"]),
                     is_admin=False,
                 )
-                exist_user = self._repo.create(new_user)
+                exist_user = await self._repo.create(new_user)
                 
                 if not exist_user:
                     # Try to find if user with same display name exists
-                    name_conflict = self._repo.find_one(
+                    name_conflict = await self._repo.find_one(
                         query=QueryUserModel(display_name=normalize(user_data["name"]))
                     )
                     if name_conflict:
@@ -154,19 +163,24 @@ class AuthService:
             else:
                 print(f"DEBUG: Found existing user with ID: {exist_user.id}")
 
-            token = self._jwt.create({"uid": exist_user.id})
+            token = await self._jwt.create({"uid": exist_user.id})
             if token is None:
                 raise Exception("Failed to create token")
             
             print(f"DEBUG: Successfully created token for user {exist_user.email}")
             return token
+        except (CircuitOpenError, UpstreamError, httpx.HTTPError) as e:
+            print(f"CTFd unavailable during sign in: {e}")
+            raise HTTPException(
+                status_code=503, detail="CTFd is unavailable, please retry shortly"
+            )
         except Exception as e:
             print(f"Error when sign in: {e}")
             raise HTTPException(status_code=204, detail=str(e))
 
-    def logout(self, uid: str) -> None:
+    async def logout(self, uid: str) -> None:
         try:
-            self._jwt.revoke(uid)
+            await self._jwt.revoke(uid)
         except Exception as e:
             raise HTTPException(status_code=204, detail=str(e))
 
@@ -1,12 +1,156 @@
-import requests
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Optional
+import asyncio
+import threading
+import time
+import httpx
 
 
-class BaseService:
-    def __init__(self):
-        self._s = requests.Session()
+class UpstreamError(Exception):
+    """The identity provider failed to answer (timeout, 5xx, bad payload)."""
+
+
+class CircuitOpenError(Exception):
+    """Calls are being rejected until the identity provider recovers."""
+
+
+class CircuitBreaker:
+    """Fails fast after ``threshold`` consecutive upstream failures.
+
+    Once open, calls are rejected for ``reset`` seconds; the next call after
+    that is let through as a probe and closes the circuit if it succeeds.
+    """
+
+    def __init__(self, threshold: int, reset: float):
+        self._threshold = threshold
+        self._reset = reset
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self._reset:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self._reset:
+                raise CircuitOpenError("Identity provider is unavailable")
+            # Let one probe through and keep rejecting the others meanwhile.
+            self._opened_at = time.monotonic()
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self._threshold:
+                self._opened_at = time.monotonic()
+
+
+class BaseService(ABC):
+    """Async identity lookup against a third-party CTF platform.
+
+    Subclasses set ``_url`` and implement :meth:`_fetch`. The HTTP client,
+    circuit breaker and identity cache are shared by every instance talking
+    to the same URL in a process, so a login never opens a new connection
+    pool and a degraded platform is only waited on by the probe request.
+    """
+
+    _clients = {}
+    _breakers = {}
+    _caches = {}
+    _lock = threading.Lock()
+
+    def __init__(self, settings: dict):
+        self._settings = settings
 
     def path(self, path):
         return self._url + path
 
-    def fetch_user_info(self, name, password):
-        pass
+    @property
+    def _client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with BaseService._lock:
+            client, client_loop = BaseService._clients.get(self._url, (None, None))
+            if client is None or client_loop is not loop or client.is_closed:
+                client = httpx.AsyncClient(
+                    timeout=float(self._settings["TIMEOUT"]),
+                    limits=httpx.Limits(
+                        max_connections=int(self._settings["MAX_CONNECTIONS"])
+                    ),
+                )
+                BaseService._clients[self._url] = (client, loop)
+            return client
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        with BaseService._lock:
+            if self._url not in BaseService._breakers:
+                BaseService._breakers[self._url] = CircuitBreaker(
+                    int(self._settings["BREAKER_THRESHOLD"]),
+                    float(self._settings["BREAKER_RESET"]),
+                )
+            return BaseService._breakers[self._url]
+
+    @property
+    def _cache(self) -> OrderedDict:
+        with BaseService._lock:
+            return BaseService._caches.setdefault(self._url, OrderedDict())
+
+    async def fetch_user_info(self, name, password) -> Optional[dict]:
+        key = sha256(f"{name}:{password}".encode()).hexdigest()
+        cached = self._cache_get(key)
+        if cached:
+            return cached
+        self.breaker.allow()
+        try:
+            user = await self._fetch(name, password)
+        except Exception:
+            # Any error, not only an HTTP one, means the call did not succeed.
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        if user:
+            self._cache_put(key, user)
+        return user
+
+    @abstractmethod
+    async def _fetch(self, name, password) -> Optional[dict]:
+        """Resolve the identity; raise :class:`UpstreamError` on outages."""
+
+    def _cache_get(self, key: str) -> Optional[dict]:
+        with BaseService._lock:
+            cache = BaseService._caches.get(self._url)
+            entry = cache.get(key) if cache else None
+            if not entry or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+    def _cache_put(self, key: str, user: dict) -> None:
+        cache = self._cache
+        with BaseService._lock:
+            cache[key] = (time.monotonic() + float(self._settings["CACHE_TTL"]), user)
+            cache.move_to_end(key)
+            while len(cache) > int(self._settings["CACHE_SIZE"]):
+                cache.popitem(last=False)
+
+    @staticmethod
+    async def close() -> None:
+        with BaseService._lock:
+            clients = list(BaseService._clients.values())
+            BaseService._clients = {}
+        for client, _ in clients:
+            await client.aclose()
@@ -1,188 +1,424 @@
-from fastapi import Depends
+from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from repository.schema import (
     User,
 )
-from repository.challenge import ChallengeRepository
+from repository.challenge import AsyncChallengeRepository
 from models.dto import NewChallengeRequest
 from models.challenge import QueryChallengeModel
 from models.user import QueryUserModel
-from repository.user import UserRepository
+from repository.user import AsyncUserRepository
+from repository.instance import AsyncInstanceRepository
 from utils.ops import ChallOpsHandler
-from utils.gate_keeper import auth
-from worker import pull_images, start_challenge, clean_challenge
-from repository import RedisStorage
-from redis import Redis
+from utils.gate_keeper import auth, UserCache
+from utils.ports import AsyncPortAllocator
+from utils.warm_pool import AsyncWarmPool
+from utils.scheduler import AsyncScheduler, NoNodeFits, demand
+from utils.admission import AsyncAdmissionQueue
+from utils.locks import AsyncStartLock
+from utils.queues import broker_client, queue_stats
+from utils.pull import PullEngine
+from utils.state import AsyncInstanceState
+from utils.events import status_events
+from utils.expiry import AsyncJoinExpiry, lifetimes
+from utils.reconcile import REPORT_KEY as RECONCILE_REPORT_KEY
+from worker import (
+    pull_images,
+    start_challenge,
+    clean_challenge,
+    refill_warm_pool,
+    drain_warm_pool,
+    reconcile,
+    clean_instance,
+    release_instances,
+)
+from repository import AsyncRedisStorage, RedisStorage
+from repository.cache import CatalogueCache
+from redis.asyncio import Redis
+from typing import Optional
+from uuid import uuid4
 import json
 
 
+async def enqueue(task, *args, task_id: str = None, **kwargs):
+    """Publish a Celery task without blocking the event loop."""
+    return await run_in_threadpool(task.apply_async, args, kwargs, task_id=task_id)
+
+
 class ChallengeService:
 
     def __init__(
         self,
         user: User = Depends(auth),
-        lock_store: Redis = Depends(RedisStorage.get),
-        repo: ChallengeRepository = Depends(ChallengeRepository),
-        user_repo: UserRepository = Depends(UserRepository),
+        lock_store: Redis = Depends(AsyncRedisStorage.get),
+        repo: AsyncChallengeRepository = Depends(AsyncChallengeRepository),
+        user_repo: AsyncUserRepository = Depends(AsyncUserRepository),
+        instance_repo: AsyncInstanceRepository = Depends(AsyncInstanceRepository),
     ) -> None:
         self._repo = repo
         self._user = user
         self._user_repo = user_repo
+        self._instance_repo = instance_repo
         self._lock_store = lock_store
 
-    def create(self, challenge: NewChallengeRequest):
+    async def create(self, challenge: NewChallengeRequest):
         if self._user.id != "bot":
             raise Exception("Only bot can create challenges")
-        ops_handler = ChallOpsHandler(challenge.config, creds=challenge.creds)
-        ops_handler.verify_images()
-        pull_images.delay(challenge.config, challenge.creds)
-        return self._repo.create(ops_handler.config)
-
-    def create_instance(self, chall_id: int):
-        if self._lock_store.get(f"start:{chall_id}") or self._lock_store.get(
-            f"delete:{chall_id}"
-        ):
-            return False
-        start_challenge.delay(chall_id, self._user.id)
-        return True
+        ops_handler = await self._verified_ops(challenge)
+        chall = await self._repo.create(ops_handler.config)
+        await enqueue(pull_images, challenge.config, challenge.creds, chall.id)
+        return chall
+
+    async def create_instance(self, chall_id: int) -> Optional[dict]:
+        """Start an instance of ``chall_id``, or join the start under way.
+
+        Returns the id of the task doing the start (``None`` when a warm
+        instance was handed over as is) and whether the caller was coalesced
+        onto someone else's start; ``None`` if there is nothing to start.
+        """
+        state = AsyncInstanceState(self._lock_store)
+        # A state a dead worker left behind does not block the start.
+        if await state.live(chall_id) in ("pulling", "running", "deleting"):
+            return None
+        challenge = await self._repo.find_detail(chall_id)
+        if not challenge or challenge.instance_scope == "player":
+            # Players start their own instance through /api/instance/start.
+            return None
+        task_id = uuid4().hex
+        start_lock = AsyncStartLock(self._lock_store)
+        holder = await start_lock.acquire(chall_id, task_id)
+        if holder is None:
+            return None
+        if holder != task_id:
+            return {"task_id": holder, "coalesced": True}
+        try:
+            if challenge.warm_pool_size:
+                published = await self._take_warm(challenge, state, task_id)
+                if published is not None:
+                    started = task_id if published else None
+                    return {"task_id": started, "coalesced": False}
+            await self._admit(challenge, task_id)
+        except IOError:
+            # The ports of this challenge are still leased to someone else.
+            await start_lock.release(chall_id, task_id)
+            return None
+        except Exception:
+            await start_lock.release(chall_id, task_id)
+            raise
+        return {"task_id": task_id, "coalesced": False}
+
+    async def _take_warm(self, challenge, state, task_id: str) -> Optional[bool]:
+        """Hand a warm instance over to ``challenge``.
+
+        ``True`` if ``task_id`` was published to start its containers,
+        ``False`` if it was already running, ``None`` if the pool was empty.
+        Raises ``IOError`` when the challenge already holds ports.
+        """
+        chall_id = challenge.id
+        pool = AsyncWarmPool(self._lock_store)
+        warm = await pool.take(chall_id)
+        await enqueue(refill_warm_pool, chall_id)
+        if not warm:
+            return None
+        try:
+            await AsyncPortAllocator(self._lock_store).transfer(
+                f"warm:{warm['token']}", chall_id
+            )
+        except IOError:
+            await pool.put(chall_id, warm)
+            raise
+        await AsyncScheduler(self._lock_store).transfer(
+            f"warm:{warm['token']}", chall_id
+        )
+        if not warm["started"]:
+            await state.transition(
+                chall_id, "creating", phase="queued", task_id=task_id
+            )
+            await enqueue(
+                start_challenge, chall_id, self._user.id, warm, task_id=task_id
+            )
+            return True
+        challenge = await self._repo.change_status(
+            challenge, connection_info=warm["connection_info"]
+        )
+        await self._repo.add_user(challenge, self._user)
+        await AsyncJoinExpiry(self._lock_store).start(
+            chall_id, self._user.id, lifetimes(challenge)[0]
+        )
+        await state.transition(chall_id, "running", players=1)
+        await AsyncStartLock(self._lock_store).release(chall_id, task_id)
+        return False
 
-    def reset_challenge(self, chall_id: int):
-        challenge = self._repo.find_one(QueryChallengeModel(id=chall_id))
+    async def _admit(self, challenge, task_id: str) -> None:
+        """Start ``challenge``, or queue it while no node has room for it."""
+        state = AsyncInstanceState(self._lock_store)
+        try:
+            position = await AsyncAdmissionQueue(self._lock_store).admit(
+                challenge.id,
+                *demand(challenge),
+                {"kind": "challenge", "id": challenge.id, "user_id": self._user.id},
+            )
+        except NoNodeFits as e:
+            await state.transition(challenge.id, "failed", error=str(e))
+            raise HTTPException(status.HTTP_409_CONFLICT, str(e))
+        try:
+            if position:
+                # Started by the admit_queued task once a node has room.
+                await state.transition(challenge.id, "queued", task_id=task_id)
+                return
+            await state.transition(
+                challenge.id, "creating", phase="queued", task_id=task_id
+            )
+            await enqueue(
+                start_challenge, challenge.id, self._user.id, task_id=task_id
+            )
+        except Exception:
+            # Free what admit placed or queued; no task will ever start it.
+            await AsyncScheduler(self._lock_store).release(challenge.id)
+            await AsyncAdmissionQueue(self._lock_store).remove(challenge.id)
+            raise
+
+    async def reset_challenge(self, chall_id: int) -> Optional[dict]:
+        challenge = await self._repo.detail_snapshot(chall_id)
         if not challenge:
-            return False
-        if self._user.display_name not in [x.display_name for x in challenge.players]:
-            return False
-        clean_challenge(chall_id)
-        start_challenge.delay(chall_id, self._user.id)
-        return True
+            return None
+        if self._user.id not in [x["id"] for x in challenge["players"]]:
+            return None
+        await run_in_threadpool(clean_challenge, chall_id)
+        task_id = uuid4().hex
+        start_lock = AsyncStartLock(self._lock_store)
+        holder = await start_lock.acquire(chall_id, task_id)
+        if holder is None:
+            return None
+        if holder != task_id:
+            return {"task_id": holder, "coalesced": True}
+        try:
+            await self._admit(await self._repo.find_detail(chall_id), task_id)
+        except Exception:
+            await start_lock.release(chall_id, task_id)
+            raise
+        return {"task_id": task_id, "coalesced": False}
 
-    def list_challenges(self, page):
-        challenges = self._repo.list(page)
+    async def list_challenges(self, page):
+        catalogue = await self._repo.list_snapshot(page)
+        joined_ids = set(await self._repo.joined_ids(self._user.id))
         challenges = [
-            {
-                "id": x.id,
-                "title": x.title,
-                "connection_info": x.connection_info,
-                "players": [y.display_name for y in x.players],
-            }
-            for x in challenges
-        ]
-        joined_challenges = [
-            {
-                "id": x["id"],
-            }
-            for x in filter(
-                lambda x: self._user.display_name in x["players"], challenges
-            )
+            {**x, "joined": x["id"] in joined_ids} for x in catalogue["data"]
         ]
         return {
-            "total": self._repo.count() or 0,
+            "total": catalogue["total"] or 0,
             "data": challenges,
-            "join": joined_challenges,
+            "join": [{"id": x["id"]} for x in challenges if x["joined"]],
         }
 
-    def get_challenge(self, chall_id: int):
-        challenge = self._repo.find_one(QueryChallengeModel(id=chall_id))
+    async def get_challenge(self, chall_id: int):
+        challenge = await self._repo.detail_snapshot(chall_id)
         if not challenge:
             return None
-        player_names = [x.display_name for x in challenge.players]
-        joined = self._user.display_name in player_names
+        joined = self._user.id in [x["id"] for x in challenge["players"]]
         result = {
-            "id": challenge.id,
-            "title": challenge.title,
-            "services": [
-                {
-                    "name": x.name,
-                    "image": x.image,
-                    "ports": json.loads(x.ports),
-                }
-                for x in challenge.services
-            ],
-            "players": player_names,
+            "id": challenge["id"],
+            "title": challenge["title"],
+            "services": challenge["services"],
+            "players": [x["display_name"] for x in challenge["players"]],
             "joined": joined,
         }
-        if joined:
-            connect_info = challenge.connection_info
-            if not connect_info:
+        scope = challenge.get("instance_scope") or "shared"
+        result["instance_scope"] = scope
+        if joined and scope == "player":
+            instance = await self._instance_repo.find_for(chall_id, self._user.id)
+            result["instance_id"] = instance.id if instance else None
+            result["connection_info"] = instance.connection_info if instance else None
+        elif joined:
+            if not challenge["connection_info"]:
                 raise Exception("Challenge not started")
-            result["connection_info"] = json.loads(connect_info)
+            result["connection_info"] = challenge["connection_info"]
         return result
 
-    def join_challenge(self, challenge_id: int):
-        challenge = self._repo.find_one(QueryChallengeModel(id=challenge_id))
+    async def join_challenge(self, challenge_id: int):
+        challenge = await self._repo.find_one(QueryChallengeModel(id=challenge_id))
         if not challenge:
             return False
-        if self._user in challenge.players:
+        if await self._repo.is_joined(challenge_id, self._user.id):
             return False
-        challenge = self._repo.add_user(challenge, self._user)
-        self._lock_store.incr(f"chall:{challenge_id}:count")
-        return challenge is not None
+        lifetime, _ = lifetimes(challenge)
+        challenge = await self._repo.add_user(challenge, self._user)
+        if challenge is None:
+            return False
+        await AsyncJoinExpiry(self._lock_store).start(
+            challenge_id, self._user.id, lifetime
+        )
+        await AsyncInstanceState(self._lock_store).add_player(challenge_id)
+        return True
 
-    def leave_challenge(self, challenge_id: int):
-        remain_player = self._repo.remove_user(challenge_id, self._user.id)
+    async def extend_join(self, challenge_id: int):
+        """Push the caller's deadline out; ``None`` when not joined."""
+        challenge = await self._repo.find_one(QueryChallengeModel(id=challenge_id))
+        if not challenge:
+            return None
+        if not await self._repo.is_joined(challenge_id, self._user.id):
+            return None
+        expires_at = await AsyncJoinExpiry(self._lock_store).extend(
+            challenge_id, self._user.id, *lifetimes(challenge)
+        )
+        return {"expires_at": expires_at} if expires_at else None
+
+    async def leave_challenge(self, challenge_id: int):
+        remain_player = await self._repo.remove_user(challenge_id, self._user.id)
+        await AsyncJoinExpiry(self._lock_store).remove(challenge_id, self._user.id)
+        await AsyncInstanceState(self._lock_store).set_players(
+            challenge_id, len(remain_player)
+        )
+        await enqueue(release_instances, [(challenge_id, self._user.id)])
         if len(remain_player) == 0:
-            clean_challenge.delay(challenge_id)
+            await enqueue(clean_challenge, challenge_id)
         return remain_player
 
-    def kick_user(self, challenge_id: int, email: str):
+    async def kick_user(self, challenge_id: int, email: str):
         try:
-            kicked_user = self._user_repo.find_one(QueryUserModel(email=email))
+            kicked_user = await self._user_repo.find_one(QueryUserModel(email=email))
             if "@" not in email:
-                kicked_user = self._user_repo.find_one(
+                kicked_user = await self._user_repo.find_one(
                     QueryUserModel(display_name=email)
                 )
-            remain_players = self._repo.remove_user(challenge_id, kicked_user.id)
+            remain_players = await self._repo.remove_user(
+                challenge_id, kicked_user.id
+            )
+            await AsyncJoinExpiry(self._lock_store).remove(
+                challenge_id, kicked_user.id
+            )
+            await AsyncInstanceState(self._lock_store).set_players(
+                challenge_id, len(remain_players)
+            )
+            await enqueue(release_instances, [(challenge_id, kicked_user.id)])
             if len(remain_players) > 0:
                 remain_players = [x.display_name for x in remain_players]
             return remain_players
         except:
             return []
 
-    def kick_all(self, challenge_id: int):
+    async def kick_all(self, challenge_id: int):
         try:
-            challenge = self._repo.find_one(QueryChallengeModel(id=challenge_id))
+            challenge = await self._repo.find_detail(challenge_id)
             for player in challenge.players:
-                self._repo.remove_user(challenge_id, player.id)
-            clean_challenge.delay(challenge_id)
+                await self._repo.remove_user(challenge_id, player.id)
+            await AsyncJoinExpiry(self._lock_store).remove(
+                challenge_id, *[x.id for x in challenge.players]
+            )
+            await enqueue(
+                release_instances, [(challenge_id, x.id) for x in challenge.players]
+            )
+            await enqueue(clean_challenge, challenge_id)
             return True
         except:
             return False
 
-    def delete_challenge(self, challenge_id: int):
+    async def delete_challenge(self, challenge_id: int):
         try:
-            challenge = self._repo.find_one(QueryChallengeModel(id=challenge_id))
+            challenge = await self._repo.find_one(QueryChallengeModel(id=challenge_id))
             if not challenge:
                 return False
-            
-            self.kick_all(challenge_id)
-            clean_challenge.delay(challenge_id)
 
-            success = self._repo.delete(challenge_id)
+            await self.kick_all(challenge_id)
+            await AsyncAdmissionQueue(self._lock_store).remove(challenge_id)
+            await enqueue(clean_challenge, challenge_id)
+            await enqueue(drain_warm_pool, challenge_id)
+            # Deleting the challenge cascades to its instance rows, so hand
+            # the worker everything it needs to find their containers.
+            for instance in await self._instance_repo.list_challenge(challenge_id):
+                await enqueue(
+                    clean_instance,
+                    instance.id,
+                    name=instance.name,
+                    grace=challenge.stop_grace,
+                )
+
+            success = await self._repo.delete(challenge_id)
             return success
         except Exception as e:
             print(f"Error deleting challenge: {e}")
             return False
 
-    def check_exist(self, enc_config: str):
-        ops = ChallOpsHandler(enc_config=enc_config)
-        return self._repo.find_one(QueryChallengeModel(title=ops.cfg.title)) is not None
-
-    def update(self, challenge: NewChallengeRequest):
-        ops_handler = ChallOpsHandler(challenge.config, creds=challenge.creds)
-        ops_handler.verify_images()
-        pull_images.delay(challenge.config, challenge.creds)
-        return self._repo.update(ops_handler.config)
-
-    def get_challenge_status(self, chall_id: int):
-        challenge = self._repo.find_one(QueryChallengeModel(id=chall_id))
-        status = "stopped"
-        if self._lock_store.get(f"start:{chall_id}"):
-            status = "creating"
-        if self._lock_store.get(f"delete:{chall_id}"):
-            status = "deleting"
-        if challenge.connection_info and self._lock_store.get(
-            f"chall:{chall_id}:count"
-        ):
-            status = "running"
-        if self._lock_store.get(f"pulling:{challenge.title}"):
-            status = "pulling"
-        return status
+    async def check_exist(self, enc_config: str):
+        ops = await run_in_threadpool(ChallOpsHandler, enc_config=enc_config)
+        challenge = await self._repo.find_one(QueryChallengeModel(title=ops.cfg.title))
+        return challenge is not None
+
+    async def update(self, challenge: NewChallengeRequest):
+        ops_handler = await self._verified_ops(challenge)
+        chall = await self._repo.update(ops_handler.config)
+        await enqueue(pull_images, challenge.config, challenge.creds, chall.id)
+        await enqueue(refill_warm_pool, chall.id, reset=True)
+        return chall
+
+    async def get_challenge_status(self, chall_id: int):
+        result = await AsyncInstanceState(self._lock_store).get(chall_id)
+        images = result.pop("images", [])
+        if result["status"] == "pulling":
+            result["progress"] = await PullEngine.read_progress_async(
+                self._lock_store, images
+            )
+        elif result["status"] == "queued":
+            result["position"] = await AsyncAdmissionQueue(self._lock_store).position(
+                chall_id
+            )
+        return result
+
+    def events(self, chall_id: int, last_event_id: str = None):
+        """Server-Sent Events of the shared instance of ``chall_id``."""
+
+        async def with_position(event: dict) -> dict:
+            if event.get("status") == "queued":
+                event["position"] = await AsyncAdmissionQueue(
+                    self._lock_store
+                ).position(chall_id)
+            return event
+
+        return status_events(
+            self._lock_store,
+            ("instance", chall_id),
+            lambda: self.get_challenge_status(chall_id),
+            last_event_id,
+            with_position,
+        )
+
+    async def port_stats(self):
+        return await AsyncPortAllocator(self._lock_store).stats()
+
+    async def node_usage(self):
+        return await AsyncScheduler(self._lock_store).usage()
+
+    async def queue_stats(self):
+        return await run_in_threadpool(
+            queue_stats, next(RedisStorage.get()), broker_client()
+        )
+
+    async def warm_pool_stats(self, chall_id: int):
+        challenge = await self._repo.find_one(QueryChallengeModel(id=chall_id))
+        if not challenge:
+            return None
+        return {
+            "size": challenge.warm_pool_size or 0,
+            **await AsyncWarmPool(self._lock_store).stats(chall_id),
+        }
+
+    async def reconcile_report(self):
+        raw = await self._lock_store.get(RECONCILE_REPORT_KEY)
+        return json.loads(raw) if raw else None
+
+    async def reconcile(self, dry_run: bool = False) -> str:
+        return (await enqueue(reconcile, dry_run)).id
+
+    def cache_stats(self):
+        return {"catalogue": CatalogueCache.stats(), "users": UserCache.stats()}
+
+    @staticmethod
+    async def _verified_ops(challenge: NewChallengeRequest) -> ChallOpsHandler:
+        """Parse the config and check its images off the event loop."""
+
+        def verify():
+            ops_handler = ChallOpsHandler(challenge.config, creds=challenge.creds)
+            ops_handler.verify_images()
+            return ops_handler
+
+        return await run_in_threadpool(verify)
@@ -0,0 +1,186 @@
+from fastapi import Depends, HTTPException, status
+from repository import AsyncRedisStorage
+from repository.schema import Instance, User
+from repository.challenge import AsyncChallengeRepository
+from repository.instance import AsyncInstanceRepository, instance_summary
+from utils.gate_keeper import auth
+from utils.state import AsyncInstanceState
+from utils.events import status_events
+from utils.expiry import AsyncJoinExpiry, lifetimes
+from utils.admission import AsyncAdmissionQueue
+from utils.locks import AsyncStartLock
+from utils.scheduler import AsyncScheduler, NoNodeFits, demand
+from services.challenge import enqueue
+from worker import clean_instance, player_instance_name, start_instance
+from config import config
+from redis.asyncio import Redis
+from typing import Optional
+from uuid import uuid4
+
+
+class InstanceService:
+    """Instances of challenges whose ``instance_scope`` is ``player``.
+
+    Every player gets their own containers, network and ports, and may hold
+    up to ``INSTANCES.PER_USER`` of them at once.
+    """
+
+    def __init__(
+        self,
+        user: User = Depends(auth),
+        lock_store: Redis = Depends(AsyncRedisStorage.get),
+        repo: AsyncInstanceRepository = Depends(AsyncInstanceRepository),
+        challenge_repo: AsyncChallengeRepository = Depends(AsyncChallengeRepository),
+    ) -> None:
+        self._user = user
+        self._lock_store = lock_store
+        self._repo = repo
+        self._challenge_repo = challenge_repo
+        self._state = AsyncInstanceState(lock_store, prefix="player")
+        self._admission = AsyncAdmissionQueue(lock_store)
+
+    @property
+    def quota(self) -> int:
+        return int(config["INSTANCES"]["PER_USER"])
+
+    async def start(self, chall_id: int) -> dict:
+        challenge = await self._challenge_repo.find_detail(chall_id)
+        if not challenge:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "Challenge not found")
+        if challenge.instance_scope != "player":
+            raise HTTPException(
+                status.HTTP_409_CONFLICT, "Challenge uses a shared instance"
+            )
+        instance = await self._repo.find_for(chall_id, self._user.id)
+        if not instance:
+            if await self._repo.count_for(self._user.id) >= self.quota:
+                raise HTTPException(
+                    status.HTTP_429_TOO_MANY_REQUESTS,
+                    f"You may run at most {self.quota} instances at once",
+                )
+            instance = await self._repo.create(
+                chall_id, self._user.id, player_instance_name(challenge, uuid4().hex[:8])
+            )
+            if instance is None:
+                # A concurrent request created it first.
+                instance = await self._repo.find_for(chall_id, self._user.id)
+                return await self.summary(instance)
+            if not await self._challenge_repo.is_joined(chall_id, self._user.id):
+                await self._challenge_repo.add_user(challenge, self._user)
+                await AsyncJoinExpiry(self._lock_store).start(
+                    chall_id, self._user.id, lifetimes(challenge)[0]
+                )
+        elif await self._state.live(instance.id) != "failed":
+            return await self.summary(instance)
+        owner, task_id = f"player:{instance.id}", uuid4().hex
+        holder = await AsyncStartLock(self._lock_store).acquire(owner, task_id)
+        if holder != task_id:
+            # Another request is already starting it.
+            return {
+                **await self.summary(instance),
+                "task_id": holder,
+                "coalesced": holder is not None,
+            }
+        try:
+            position = await self._admission.admit(
+                owner,
+                *demand(challenge),
+                {"kind": "instance", "id": instance.id},
+            )
+            if position:
+                # Started by the admit_queued task once a node has room.
+                await self._state.transition(instance.id, "queued", task_id=task_id)
+            else:
+                await self._state.transition(
+                    instance.id, "creating", phase="queued", task_id=task_id
+                )
+                await enqueue(start_instance, instance.id, task_id=task_id)
+        except NoNodeFits as e:
+            await AsyncStartLock(self._lock_store).release(owner, task_id)
+            await self._state.transition(instance.id, "failed", error=str(e))
+            raise HTTPException(status.HTTP_409_CONFLICT, str(e))
+        except Exception:
+            # Whatever admit placed or queued would otherwise never be freed:
+            # the instance row exists, so the reconciler counts it as alive.
+            await AsyncScheduler(self._lock_store).release(owner)
+            await self._admission.remove(owner)
+            await AsyncStartLock(self._lock_store).release(owner, task_id)
+            raise
+        return {**await self.summary(instance), "task_id": task_id, "coalesced": False}
+
+    async def find(self, instance_id: int) -> Optional[Instance]:
+        """The instance if the caller owns it or is an admin."""
+        instance = await self._repo.find_one(instance_id)
+        if not instance:
+            return None
+        if instance.owner_id != self._user.id and not self._user.is_admin:
+            return None
+        return instance
+
+    async def summary(self, instance: Instance) -> dict:
+        return {
+            **instance_summary(instance),
+            "status": await self.status(instance.id),
+        }
+
+    async def status(self, instance_id: int) -> dict:
+        result = await self._state.get(instance_id)
+        if result["status"] == "queued":
+            result["position"] = await self._admission.position(f"player:{instance_id}")
+        return result
+
+    async def get(self, instance_id: int) -> Optional[dict]:
+        instance = await self.find(instance_id)
+        return await self.summary(instance) if instance else None
+
+    async def get_status(self, instance_id: int) -> Optional[dict]:
+        instance = await self.find(instance_id)
+        return await self.status(instance.id) if instance else None
+
+    async def events(self, instance_id: int, last_event_id: str = None):
+        """Server-Sent Events of the instance, or None if the caller may not see it."""
+        instance = await self.find(instance_id)
+        if not instance:
+            return None
+        owner = f"player:{instance.id}"
+
+        async def with_position(event: dict) -> dict:
+            if event.get("status") == "queued":
+                event["position"] = await self._admission.position(owner)
+            return event
+
+        return status_events(
+            self._lock_store,
+            ("player", instance.id),
+            lambda: self.status(instance.id),
+            last_event_id,
+            with_position,
+        )
+
+    async def clean(self, instance_id: int) -> bool:
+        instance = await self.find(instance_id)
+        if not instance:
+            return False
+        if await self._state.current(instance.id) == "deleting":
+            return True
+        await self._admission.remove(f"player:{instance.id}")
+        await self._state.transition(instance.id, "deleting", phase="queued")
+        await enqueue(clean_instance, instance.id)
+        return True
+
+    async def mine(self) -> dict:
+        instances = await self._repo.list_for(self._user.id)
+        return {
+            "quota": self.quota,
+            "data": [await self.summary(x) for x in instances],
+        }
+
+    async def list_all(self, page: int = 1) -> dict:
+        instances, total = await self._repo.list_page(page)
+        states = await self._state.states([x.id for x in instances])
+        return {
+            "total": total,
+            "data": [
+                {**instance_summary(x), "state": states[x.id][0]} for x in instances
+            ],
+        }
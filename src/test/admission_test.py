@@ -0,0 +1,164 @@
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+from fakeredis import FakeRedis, FakeServer
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from repository.schema import Base, Challenge, Instance, User
+from utils.admission import AdmissionQueue, AsyncAdmissionQueue
+from utils.locks import StartLock
+from utils.scheduler import NoNodeFits, Node, Scheduler
+from utils.state import InstanceState
+import asyncio
+import worker
+
+GIB = 1024**3
+NODES = [Node("a", "tcp://a:2375", "a", 1000, GIB)]
+
+
+class TestAdmissionQueue(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        server = FakeServer()
+        self.store = FakeRedis(server=server)
+        patcher = patch("utils.scheduler.load_nodes", return_value=NODES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The API queues, the worker drains: both sides see the same queue.
+        self.queue = AsyncAdmissionQueue(AsyncFakeRedis(server=server))
+        self.drained = AdmissionQueue(self.store)
+
+    async def test_first_come_first_served(self):
+        self.assertEqual(await self.queue.push("1", {"kind": "challenge"}), 1)
+        self.assertEqual(await self.queue.push("player:2", {"kind": "instance"}), 2)
+        self.assertEqual(await self.queue.push("1", {"kind": "challenge"}), 1)
+        self.assertEqual(self.drained.owners(), ["1", "player:2"])
+        self.assertEqual(self.drained.head()[0], "1")
+        self.drained.remove("1")
+        self.assertEqual(await self.queue.position("player:2"), 1)
+        self.assertIsNone(await self.queue.position("1"))
+
+    async def test_admit_places_while_there_is_room(self):
+        request = {"kind": "challenge"}
+        self.assertIsNone(await self.queue.admit("1", 600, GIB // 2, request))
+        self.assertEqual(Scheduler(self.store).node_of("1").name, "a")
+        self.assertEqual(await self.queue.admit("2", 600, GIB // 2, request), 1)
+        # Fits, but waits behind the queued request.
+        self.assertEqual(await self.queue.admit("3", 100, 0, request), 2)
+        self.assertEqual(self.drained.head()[1]["cpu"], 600)
+
+    async def test_rejects_a_demand_larger_than_any_node(self):
+        with self.assertRaises(NoNodeFits):
+            await self.queue.admit("1", 2000, 0, {"kind": "challenge"})
+        self.assertEqual(self.drained.length(), 0)
+        # Larger than the room left is queued, not rejected.
+        await self.queue.admit("2", 1000, 0, {"kind": "challenge"})
+        self.assertEqual(await self.queue.admit("3", 1000, 0, {"kind": "challenge"}), 1)
+
+
+class TestAdmitQueued(TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.store = FakeRedis(server=self.server)
+        engine = create_engine(
+            "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+        )
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.add_all(
+            [
+                User(id="alice", email="alice@game", display_name="alice"),
+                Challenge(id=1, title="pwn"),
+                Challenge(id=2, title="web"),
+                Challenge(id=3, title="rev", instance_scope="player"),
+                Instance(id=7, name="chall-rev-player-a", challenge_id=3, owner_id="alice"),
+            ]
+        )
+        self.session.commit()
+        self.addCleanup(self.session.close)
+        self.published = []
+        for target in (
+            patch("utils.scheduler.load_nodes", return_value=NODES),
+            patch.object(worker.RedisStorage, "get", lambda: iter([self.store])),
+            patch.object(worker.Storage, "get", lambda: iter([self.session])),
+            patch.object(worker.admit_queued, "delay", lambda: None),
+            patch.object(
+                worker.start_challenge, "apply_async", self.publish("start_challenge")
+            ),
+            patch.object(
+                worker.start_instance, "apply_async", self.publish("start_instance")
+            ),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+        self.queue = AdmissionQueue(self.store)
+        self.scheduler = Scheduler(self.store)
+
+    def publish(self, name: str):
+        return lambda args, task_id=None: self.published.append((name, args[0], task_id))
+
+    def request(self, owner, cpu: int, kind: str = "challenge", id: int = None):
+        StartLock(self.store).acquire(owner, f"task-{owner}")
+        request = {"kind": kind, "id": id or int(owner), "user_id": "alice"}
+        queue = AsyncAdmissionQueue(AsyncFakeRedis(server=self.server))
+        asyncio.run(queue.push(owner, {**request, "cpu": cpu, "memory": 0}))
+
+    def test_oldest_first_and_nobody_overtakes(self):
+        self.scheduler.place("busy", 600, 0)
+        self.request("1", 600)
+        self.request("2", 100)
+        self.assertEqual(worker.admit_queued(), 0)
+        self.assertEqual(self.queue.owners(), ["1", "2"])
+        # Releasing the node lets both in, in the order they came.
+        worker.release_placement(self.store, "busy")
+        self.assertEqual(worker.admit_queued(), 2)
+        self.assertEqual(
+            self.published,
+            [("start_challenge", 1, "task-1"), ("start_challenge", 2, "task-2")],
+        )
+        self.assertEqual(InstanceState(self.store).current(1), "creating")
+        self.assertEqual(self.queue.length(), 0)
+
+    def test_admitted_again_after_a_release(self):
+        self.request("1", 1000)
+        self.request("2", 1000)
+        self.assertEqual(worker.admit_queued(), 1)
+        self.assertEqual(self.queue.owners(), ["2"])
+        worker.release_placement(self.store, "1")
+        self.assertEqual(worker.admit_queued(), 1)
+        self.assertEqual(self.scheduler.node_of("2").name, "a")
+
+    def test_deleted_rows_are_dropped(self):
+        self.request("player:8", 100, kind="instance", id=8)
+        self.request("player:7", 100, kind="instance", id=7)
+        self.assertEqual(worker.admit_queued(), 1)
+        self.assertEqual(self.published, [("start_instance", 7, "task-player:7")])
+        self.assertIsNone(self.scheduler.placement("player:8"))
+        self.assertIsNone(StartLock(self.store).holder("player:8"))
+
+    def test_too_large_is_failed_not_blocking(self):
+        self.request("1", 5000)
+        self.request("2", 100)
+        self.assertEqual(worker.admit_queued(), 1)
+        self.assertEqual(InstanceState(self.store).current(1), "failed")
+        self.assertEqual([x[1] for x in self.published], [2])
+
+    def test_deleted_while_queued(self):
+        self.scheduler.place("busy", 1000, 0)
+        self.request("1", 100)
+        self.store.set("delete:1", 1)
+        worker.release_placement(self.store, "busy")
+        self.assertEqual(worker.admit_queued(), 0)
+        self.assertEqual(self.published, [])
+        self.assertEqual(self.scheduler.placements(), {})
+
+    def test_cleaning_a_queued_instance_leaves_the_queue(self):
+        self.scheduler.place("busy", 1000, 0)
+        self.request("player:7", 100, kind="instance", id=7)
+        with patch.object(worker, "teardown_instance"), patch.object(worker, "docker_for"):
+            worker.clean_instance(7)
+        self.assertEqual(self.queue.length(), 0)
+        self.assertIsNone(self.store.get("delete:player:7"))
+        worker.release_placement(self.store, "busy")
+        self.assertEqual(worker.admit_queued(), 0)
+        self.assertIsNone(InstanceState(self.store, prefix="player").current(7))
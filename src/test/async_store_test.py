@@ -0,0 +1,75 @@
+from unittest import IsolatedAsyncioTestCase
+from fakeredis import FakeRedis, FakeServer
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from utils.expiry import AsyncJoinExpiry, JoinExpiry
+from utils.locks import AsyncStartLock, StartLock
+from utils.ports import AsyncPortAllocator, PortAllocator
+from utils.scheduler import AsyncScheduler, Node, Scheduler
+from utils.state import AsyncInstanceState, InstanceState
+from utils.warm_pool import AsyncWarmPool, WarmPool
+
+NODES = [Node("a", "unix:///a.sock", "a.game", 2000, 0)]
+
+
+class TestHandOff(IsolatedAsyncioTestCase):
+    """The API writes over ``redis.asyncio``, the worker and cron read back."""
+
+    async def asyncSetUp(self):
+        server = FakeServer()
+        self.api = AsyncFakeRedis(server=server)
+        self.worker = FakeRedis(server=server)
+
+    async def test_warm_ports_are_handed_over(self):
+        ports = PortAllocator(self.worker).reserve("warm:t", 2)
+        self.assertTrue(await AsyncPortAllocator(self.api).transfer("warm:t", "1"))
+        self.assertEqual((await AsyncPortAllocator(self.api).stats())["leases"], 1)
+        self.assertEqual(PortAllocator(self.worker).release_reservation("1"), len(ports))
+        self.assertEqual(PortAllocator(self.worker).release_reservation("warm:t"), 0)
+
+    async def test_placement(self):
+        scheduler = AsyncScheduler(self.api, NODES)
+        self.assertEqual((await scheduler.place("warm:t", 500, 0)).name, "a")
+        self.assertTrue(await scheduler.transfer("warm:t", "1"))
+        self.assertEqual(await scheduler.reserved(), {"a": (500, 0)})
+        self.assertEqual(Scheduler(self.worker, NODES).node_of("1").name, "a")
+        self.assertEqual(list(Scheduler(self.worker, NODES).placements()), ["1"])
+        self.assertTrue(await scheduler.release("1"))
+        self.assertEqual((await scheduler.usage())[0]["reserved_cpu"], 0)
+
+    async def test_expiry(self):
+        expiry = AsyncJoinExpiry(self.api)
+        await expiry.start(1, "alice", 60)
+        deadline = await expiry.extend(1, "alice", 120, 300)
+        self.assertAlmostEqual(JoinExpiry(self.worker).next_deadline(), deadline, places=2)
+        self.assertIsNone(await expiry.extend(2, "alice", 120, 300))
+        await expiry.remove(1, "alice")
+        self.assertIsNone(JoinExpiry(self.worker).next_deadline())
+
+    async def test_start_lock(self):
+        lock = AsyncStartLock(self.api)
+        self.assertEqual(await lock.acquire(1, "task"), "task")
+        self.assertEqual(await lock.acquire(1, "other"), "task")
+        self.assertEqual(StartLock(self.worker).holder(1), "task")
+        self.assertFalse(StartLock(self.worker).claim(1, "other"))
+        self.assertTrue(await lock.release(1, "task"))
+        self.assertIsNone(StartLock(self.worker).holder(1))
+
+    async def test_state(self):
+        state = AsyncInstanceState(self.api)
+        await state.transition(1, "queued")
+        await state.add_player(1)
+        self.assertEqual(InstanceState(self.worker).current(1), "queued")
+        InstanceState(self.worker).transition(1, "running", players=2)
+        self.assertEqual(await state.live(1), "running")
+        self.assertEqual((await state.get(1))["players"], 2)
+        self.assertEqual((await state.states([1, 2]))[2], (None, 0.0))
+
+    async def test_warm_pool(self):
+        WarmPool(self.worker).put(1, {"instance": "a"})
+        WarmPool(self.worker).put(1, {"instance": "b"})
+        pool = AsyncWarmPool(self.api)
+        self.assertEqual(await pool.take(1), {"instance": "a"})
+        self.assertEqual(WarmPool(self.worker).size(1), 1)
+        await pool.take(1)
+        self.assertIsNone(await pool.take(1))
+        self.assertEqual(await pool.stats(1), {"ready": 0, "hits": 2, "misses": 1})
@@ -0,0 +1,79 @@
+from unittest import IsolatedAsyncioTestCase
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+from starlette.requests import Request
+from repository.schema import Base, User
+from repository.user import AsyncUserRepository
+from utils.gate_keeper import AsyncJWTHandler, UserCache, auth
+
+
+class MemoryStore:
+    def __init__(self):
+        self.data = {}
+        self.published = []
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+class TestUserCache(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.engine = create_async_engine(
+            "sqlite+aiosqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        self.session = async_sessionmaker(self.engine, expire_on_commit=False)()
+        self.session.add(User(id="user-1", email="user1@game", display_name="user 1"))
+        await self.session.commit()
+        self.store = MemoryStore()
+        self.jwt = AsyncJWTHandler(self.store)
+        self.token = await self.jwt.create({"uid": "user-1"})
+        self.statements = []
+        event.listen(self.engine.sync_engine, "before_cursor_execute", self.record)
+        UserCache.invalidate()
+        UserCache._listening.set()
+
+    async def asyncTearDown(self):
+        UserCache._listening.clear()
+        UserCache.invalidate()
+        event.remove(self.engine.sync_engine, "before_cursor_execute", self.record)
+        await self.session.close()
+        await self.engine.dispose()
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    async def resolve(self):
+        return await auth(
+            Request({"type": "http", "headers": []}),
+            jwt_handler=self.jwt,
+            user_repo=AsyncUserRepository(self.session),
+            token=None,
+            cookie_token=self.token,
+        )
+
+    async def test_repeat_request_skips_database(self):
+        self.assertEqual((await self.resolve()).id, "user-1")
+        self.assertEqual(len(self.statements), 1)
+        user = await self.resolve()
+        self.assertEqual(user.display_name, "user 1")
+        self.assertEqual(len(self.statements), 1)
+
+    async def test_revoke_invalidates(self):
+        await self.resolve()
+        await self.jwt.revoke("user-1")
+        self.assertIn(("auth:invalidate", "user-1"), self.store.published)
+        self.assertIsNone(await self.resolve())
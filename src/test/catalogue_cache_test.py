@@ -0,0 +1,94 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+from fakeredis import FakeRedis, FakeServer
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from repository.cache import VERSIONS_KEY, AsyncCatalogueCache, CatalogueCache
+
+
+class CountingRedis(AsyncFakeRedis):
+    """An async ``FakeRedis`` that counts the catalogue commands it serves."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    async def hget(self, *args):
+        self.calls.append("hget")
+        return await super().hget(*args)
+
+    async def get(self, *args):
+        self.calls.append("get")
+        return await super().get(*args)
+
+
+def forget_local():
+    for entries in (CatalogueCache._local, CatalogueCache._versions):
+        entries.clear()
+
+
+class TestCatalogueCache(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        forget_local()
+        self.addCleanup(forget_local)
+        self.now = 1000.0
+        target = patch("repository.cache.time.monotonic", lambda: self.now)
+        target.start()
+        self.addCleanup(target.stop)
+        server = FakeServer()
+        self.store = CountingRedis(server=server)
+        self.cache = AsyncCatalogueCache(self.store)
+        # What the worker, cron and admin views invalidate through.
+        self.writer = CatalogueCache(FakeRedis(server=server))
+        self.loads = 0
+
+    async def load(self) -> dict:
+        self.loads += 1
+        return {"title": "pwn", "loads": self.loads}
+
+    async def test_local_hit_costs_no_round_trip(self):
+        self.assertEqual((await self.cache.challenge(1, self.load))["loads"], 1)
+        self.store.calls.clear()
+        self.assertEqual((await self.cache.challenge(1, self.load))["loads"], 1)
+        self.assertEqual(self.store.calls, [])
+
+    async def test_other_process_hits_redis(self):
+        await self.cache.challenge(1, self.load)
+        forget_local()
+        self.assertEqual((await self.cache.challenge(1, self.load))["loads"], 1)
+        self.assertEqual(self.loads, 1)
+
+    async def test_invalidate_is_seen_at_once_by_the_writer(self):
+        await self.cache.challenge(1, self.load)
+        await self.cache.challenge(2, self.load)
+        await self.cache.invalidate(challenge_id=1)
+        self.assertEqual((await self.cache.challenge(1, self.load))["loads"], 3)
+        self.assertEqual((await self.cache.challenge(2, self.load))["loads"], 2)
+
+    async def test_invalidate_is_seen_by_others_after_the_local_ttl(self):
+        await self.cache.challenge(1, self.load)
+        await self.store.hincrby(VERSIONS_KEY, "c:1")
+        self.assertEqual((await self.cache.challenge(1, self.load))["loads"], 1)
+        self.now += self.cache._local_ttl + 1
+        self.assertEqual((await self.cache.challenge(1, self.load))["loads"], 2)
+
+    async def test_worker_invalidation_bumps_the_list(self):
+        await self.cache.list_page(1, self.load)
+
+        async def joined():
+            return [1]
+
+        await self.cache.joined("alice", joined)
+        self.writer.invalidate_many([1, 2], ["alice"])
+        self.assertEqual((await self.cache.list_page(1, self.load))["loads"], 2)
+
+        async def rejoined():
+            return [1, 2]
+
+        self.assertEqual(await self.cache.joined("alice", rejoined), [1, 2])
+
+    async def test_without_redis_every_read_loads(self):
+        cache = AsyncCatalogueCache(None)
+        await cache.challenge(1, self.load)
+        await cache.invalidate(challenge_id=1)
+        CatalogueCache(None).invalidate(challenge_id=1)
+        self.assertEqual((await cache.challenge(1, self.load))["loads"], 2)
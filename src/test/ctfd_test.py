@@ -0,0 +1,104 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import IsolatedAsyncioTestCase
+from config import config
+from services.auth.protocols import BaseService, CircuitOpenError, UpstreamError
+from services.auth.protocols.ctfd import Service
+import contextlib
+import io
+import json
+import threading
+
+USER = {"id": 1, "name": "player", "email": "player@game"}
+
+
+class StubCTFd(BaseHTTPRequestHandler):
+    """Answers ``/api/v1/users/me`` like CTFd for the token ``good``."""
+
+    hits = 0
+    status = 200
+
+    def do_GET(self):
+        StubCTFd.hits += 1
+        if StubCTFd.status != 200:
+            self.send_response(StubCTFd.status)
+            self.end_headers()
+            return
+        if self.headers.get("Authorization") != "Bearer good":
+            self.send_response(401)
+            self.end_headers()
+            return
+        body = json.dumps({"success": True, "data": USER}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCTFdService(IsolatedAsyncioTestCase):
+    def setUp(self):
+        StubCTFd.hits = 0
+        StubCTFd.status = 200
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubCTFd)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.settings = dict(config["CTFD"])
+        config["CTFD"].update(
+            URL=f"http://127.0.0.1:{self.server.server_port}",
+            BREAKER_THRESHOLD=2,
+            BREAKER_RESET=60,
+        )
+
+    async def asyncTearDown(self):
+        await BaseService.close()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        config["CTFD"].clear()
+        config["CTFD"].update(self.settings)
+
+    async def test_identity_is_cached(self):
+        self.assertEqual(await Service().fetch_user_info("player", "good"), USER)
+        self.assertEqual(await Service().fetch_user_info("player@game", "good"), USER)
+        self.assertEqual(await Service().fetch_user_info("player", "good"), USER)
+        self.assertEqual(StubCTFd.hits, 2)
+
+    async def test_login_writes_nothing_to_stdout(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            await Service().fetch_user_info("player", "good")
+            await Service().fetch_user_info("player", "bad")
+        self.assertEqual(out.getvalue(), "")
+
+    async def test_rejected_token_is_not_a_failure(self):
+        for _ in range(3):
+            self.assertIsNone(await Service().fetch_user_info("player", "bad"))
+        self.assertEqual(Service().breaker.state, "closed")
+
+    async def test_breaker_fails_fast(self):
+        StubCTFd.status = 502
+        for _ in range(2):
+            with self.assertRaises(UpstreamError):
+                await Service().fetch_user_info("player", "good")
+        with self.assertRaises(CircuitOpenError):
+            await Service().fetch_user_info("player", "good")
+        self.assertEqual(StubCTFd.hits, 2)
+
+    async def test_any_error_counts_as_a_failure(self):
+        class Broken(Service):
+            async def _fetch(self, name, access_token):
+                raise KeyError("data")
+
+        for _ in range(2):
+            with self.assertRaises(KeyError):
+                await Broken().fetch_user_info("player", "good")
+        with self.assertRaises(CircuitOpenError):
+            await Service().fetch_user_info("player", "good")
+        self.assertEqual(StubCTFd.hits, 0)
+
+    def test_protocols_must_fetch(self):
+        with self.assertRaises(TypeError):
+            BaseService(config["CTFD"])
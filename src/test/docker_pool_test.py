@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+from config import config
+from utils.docker import DockerClientPool, DockerHandler
+import threading
+
+
+class FakeClient:
+    """A ``DockerClient`` that counts pings instead of talking to a daemon."""
+
+    healthy = True
+
+    def __init__(self, base_url: str, max_pool_size: int):
+        self.base_url = base_url
+        self.api = SimpleNamespace(request=lambda *args, **kwargs: None)
+        self.pings = 0
+        self.closed = False
+
+    def login(self, **kwargs):
+        pass
+
+    def ping(self) -> bool:
+        self.pings += 1
+        return FakeClient.healthy
+
+    def close(self):
+        self.closed = True
+
+
+class TestDockerClientPool(TestCase):
+    def setUp(self):
+        FakeClient.healthy = True
+        self.now = 1000.0
+        for target in (
+            patch("utils.docker.DockerClient", FakeClient),
+            patch("utils.docker.time.monotonic", lambda: self.now),
+            patch.dict("utils.docker.config", {"DOCKER": self.docker_config()}),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+        self.pool = DockerClientPool()
+
+    @staticmethod
+    def docker_config() -> dict:
+        return {**config["DOCKER"], "MAX_CLIENTS": 2, "HEALTH_INTERVAL": 30}
+
+    def test_one_client_per_daemon_and_login(self):
+        client = self.pool.get(base_url="tcp://a")
+        self.assertIs(self.pool.get(base_url="tcp://a"), client)
+        self.assertIsNot(self.pool.get("user", "secret", base_url="tcp://a"), client)
+        # Pinged once until the health interval has passed.
+        self.assertEqual(client.pings, 1)
+        self.now += 31
+        self.pool.get(base_url="tcp://a")
+        self.assertEqual(client.pings, 2)
+
+    def test_least_recently_used_client_is_closed(self):
+        a = self.pool.get(base_url="tcp://a")
+        b = self.pool.get(base_url="tcp://b")
+        self.pool.get(base_url="tcp://a")
+        c = self.pool.get(base_url="tcp://c")
+        self.assertTrue(b.closed)
+        self.assertFalse(a.closed or c.closed)
+        self.assertIsNot(self.pool.get(base_url="tcp://b"), b)
+        self.assertTrue(a.closed)
+
+    def test_fails_fast_while_backing_off(self):
+        FakeClient.healthy = False
+        with self.assertRaises(Exception):
+            self.pool.get(base_url="tcp://a")
+        client = next(iter(self.pool._clients.values()))
+        with self.assertRaises(Exception):
+            self.pool.get(base_url="tcp://a")
+        self.assertEqual(client.pings, 1)
+        FakeClient.healthy = True
+        self.now += 2
+        self.assertIs(self.pool.get(base_url="tcp://a"), client)
+        self.assertEqual(client.pings, 2)
+
+    def test_concurrent_callers(self):
+        errors = []
+
+        def use(name: str):
+            try:
+                for _ in range(200):
+                    self.pool.get(base_url=f"tcp://{name}")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=use, args=(x % 4,)) for x in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(self.pool._clients), 2)
+
+
+class TestPublishedPorts(TestCase):
+    def test_read_from_one_sparse_listing(self):
+        calls = []
+
+        def listing(**kwargs):
+            calls.append(kwargs)
+            published = [
+                {"PrivatePort": 80, "PublicPort": 30001, "Type": "tcp"},
+                {"PrivatePort": 81, "Type": "tcp"},
+            ]
+            return [
+                SimpleNamespace(attrs={"Ports": published}),
+                SimpleNamespace(attrs={"Ports": None}),
+            ]
+
+        client = SimpleNamespace(containers=SimpleNamespace(list=listing))
+        with patch("utils.docker.client_pool.get", return_value=client):
+            self.assertEqual(DockerHandler().published_ports(), {30001})
+        self.assertEqual(calls, [{"all": True, "sparse": True}])
@@ -0,0 +1,88 @@
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from utils.events import StatusHub, format_event, parse_event, status_events, strip
+from utils.state import EVENTS_KEY, AsyncInstanceState
+import asyncio
+import json
+
+
+class TestEvents(TestCase):
+    def test_stream_entry_reads_like_the_status_endpoint(self):
+        event = parse_event(
+            b"1700000000000-1",
+            {b"scope": b"player", b"id": b"7", b"state": b"queued", b"phase": b"", b"error": b""},
+        )
+        self.assertEqual(event["event_id"], "1700000000000-1")
+        self.assertEqual(
+            strip(event), {"id": 7, "status": "queued", "phase": "", "error": ""}
+        )
+
+    def test_format(self):
+        message = format_event({"status": "running"}, "1-0")
+        self.assertTrue(message.endswith("\n\n"))
+        lines = message.strip().split("\n")
+        self.assertEqual(lines[:2], ["id: 1-0", "event: status"])
+        self.assertEqual(json.loads(lines[2][len("data: "):]), {"status": "running"})
+        self.assertFalse(format_event({}).startswith("id:"))
+
+
+class TestStatusEvents(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = AsyncFakeRedis()
+        self.state = AsyncInstanceState(self.store)
+        target = patch("utils.events.AsyncRedisStorage.client", lambda: self.store)
+        target.start()
+        self.addCleanup(target.stop)
+
+    async def asyncTearDown(self):
+        StatusHub._subscribers.clear()
+        if StatusHub._task:
+            StatusHub._task.cancel()
+            StatusHub._task = None
+
+    async def test_change_right_after_the_snapshot_is_sent(self):
+        await self.state.transition(1, "pulling")
+
+        async def snapshot() -> dict:
+            # Lands before the hub task has issued its first XREAD.
+            await self.state.transition(1, "creating", phase="network")
+            return {"status": "pulling"}
+
+        events = status_events(self.store, ("instance", 1), snapshot)
+        self.assertIn('"pulling"', await anext(events))
+        message = await asyncio.wait_for(anext(events), 5)
+        self.assertIn('"creating"', message)
+        await events.aclose()
+
+    async def resume(self, last_event_id: str) -> str:
+        async def snapshot() -> dict:
+            return {"status": "snapshot"}
+
+        events = status_events(self.store, ("instance", 1), snapshot, last_event_id)
+        try:
+            return await asyncio.wait_for(anext(events), 5)
+        finally:
+            await events.aclose()
+
+    async def test_resume_replays_what_was_missed(self):
+        await self.state.transition(1, "creating")
+        first = (await self.store.xrange(EVENTS_KEY))[0][0].decode()
+        await self.state.transition(1, "running")
+        message = await self.resume(first)
+        self.assertIn('"running"', message)
+        self.assertNotIn("snapshot", message)
+
+    async def test_malformed_id_gets_the_snapshot(self):
+        await self.state.transition(1, "running")
+        for last_event_id in ("abc", "1-x", "-1", "1-2-3"):
+            self.assertIn('"snapshot"', await self.resume(last_event_id))
+
+    async def test_trimmed_or_unknown_id_gets_the_snapshot(self):
+        await self.state.transition(1, "creating")
+        await self.state.transition(1, "running")
+        # Older than what the stream kept.
+        await self.store.xtrim(EVENTS_KEY, maxlen=1)
+        self.assertIn('"snapshot"', await self.resume("0-1"))
+        # Newer than anything in it, e.g. after Redis was reset.
+        self.assertIn('"snapshot"', await self.resume("99999999999999-0"))
@@ -0,0 +1,52 @@
+from unittest import IsolatedAsyncioTestCase
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+from repository.schema import Base, Challenge, User
+from repository.instance import AsyncInstanceRepository
+
+
+class TestInstanceRepository(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.engine = create_async_engine(
+            "sqlite+aiosqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        self.session = async_sessionmaker(self.engine, expire_on_commit=False)()
+        self.session.add_all(
+            [
+                User(id="alice", email="alice@game", display_name="alice"),
+                User(id="bob", email="bob@game", display_name="bob"),
+                Challenge(id=1, title="pwn", instance_scope="player"),
+                Challenge(id=2, title="web", instance_scope="player"),
+            ]
+        )
+        await self.session.commit()
+        self.repo = AsyncInstanceRepository(self.session)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.engine.dispose()
+
+    async def test_every_player_gets_their_own_instance(self):
+        alice = await self.repo.create(1, "alice", "chall-pwn-player-a")
+        bob = await self.repo.create(1, "bob", "chall-pwn-player-b")
+        self.assertNotEqual(alice.id, bob.id)
+        self.assertEqual(alice.challenge.title, "pwn")
+        self.assertEqual((await self.repo.find_for(1, "bob")).id, bob.id)
+
+    async def test_one_instance_per_player_and_challenge(self):
+        await self.repo.create(1, "alice", "chall-pwn-player-a")
+        self.assertIsNone(await self.repo.create(1, "alice", "chall-pwn-player-c"))
+        await self.repo.create(2, "alice", "chall-web-player-a")
+        self.assertEqual(await self.repo.count_for("alice"), 2)
+        self.assertEqual(await self.repo.count_for("bob"), 0)
+
+    async def test_admin_listing_pages_every_instance(self):
+        await self.repo.create(1, "alice", "chall-pwn-player-a")
+        await self.repo.create(1, "bob", "chall-pwn-player-b")
+        instances, total = await self.repo.list_page(1, page_size=1)
+        self.assertEqual(total, 2)
+        self.assertEqual([x.owner_id for x in instances], ["alice"])
@@ -0,0 +1,195 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+from fakeredis import FakeRedis
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from repository.cache import CatalogueCache
+from repository.challenge import ChallengeRepository
+from repository.schema import Base, Challenge, User, joins
+from services.challenge import ChallengeService
+from utils.expiry import EXPIRY_KEY, AsyncJoinExpiry, JoinExpiry, JoinReaper
+from utils.leader import LeaderLease
+import cron
+import time
+
+
+class TestJoinExpiry(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.expiry = AsyncJoinExpiry(AsyncFakeRedis())
+
+    async def test_extend_stays_within_the_max_lifetime(self):
+        now = float(int(time.time()))
+        with patch("utils.expiry.time.time", return_value=now):
+            await self.expiry.start(1, "alice", 60)
+        with patch("utils.expiry.time.time", return_value=now + 50):
+            self.assertEqual(await self.expiry.extend(1, "alice", 60, 100), now + 100)
+        with patch("utils.expiry.time.time", return_value=now + 90):
+            self.assertEqual(await self.expiry.extend(1, "alice", 60, 100), now + 100)
+        self.assertIsNone(await self.expiry.extend(1, "bob", 60, 100))
+
+    async def test_extend_never_shortens(self):
+        now = float(int(time.time()))
+        with patch("utils.expiry.time.time", return_value=now):
+            await self.expiry.start(1, "alice", 600)
+            self.assertEqual(await self.expiry.extend(1, "alice", 60, 3600), now + 600)
+
+
+def deadline(store, chall_id: int, user_id: str):
+    return store.zscore(EXPIRY_KEY, JoinExpiry.member(chall_id, user_id))
+
+
+class TestJoinReaper(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.expiry = JoinExpiry(self.store)
+        self.reaped = []
+        self.reaper = JoinReaper(self.store, self.reaped.append)
+
+    def test_reaps_only_due_joins(self):
+        self.expiry.start(1, "alice", -1)
+        self.expiry.start(1, "bob", 600)
+        self.assertEqual(self.reaper.reap(), 1)
+        self.assertEqual(self.reaped, [[(1, "alice")]])
+        self.assertEqual(self.reaper.reap(), 0)
+        self.assertIsNotNone(deadline(self.store, 1, "bob"))
+
+    def test_failed_joins_are_retried(self):
+        def broken(due):
+            raise RuntimeError("database is down")
+
+        self.expiry.start(1, "alice", -1)
+        with self.assertRaises(RuntimeError):
+            JoinReaper(self.store, broken).reap()
+        self.assertGreater(deadline(self.store, 1, "alice"), time.time())
+
+    def test_runs_only_while_leader(self):
+        other = LeaderLease(self.store, "cron", 30)
+        self.addCleanup(self.reaper.stop)
+        with patch.object(cron, "leader", LeaderLease(self.store, "cron", 30)):
+            with patch.object(cron, "reaper", self.reaper):
+                cron.renew_leader()
+                self.assertTrue(self.reaper.running)
+                cron.renew_leader()
+                self.assertTrue(self.reaper.running)
+                # The lease expired and another process took it.
+                self.store.delete("leader:cron")
+                other.acquire()
+                cron.renew_leader()
+                self.assertFalse(self.reaper.running)
+                other.release()
+                cron.renew_leader()
+                self.assertTrue(self.reaper.running)
+
+
+class TestExpireJoins(TestCase):
+    def setUp(self):
+        engine = create_engine(
+            "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+        )
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+        self.session.add_all(
+            [
+                User(id="alice", email="alice@game", display_name="alice"),
+                User(id="bob", email="bob@game", display_name="bob"),
+                Challenge(id=1, title="pwn"),
+                Challenge(id=2, title="web", lifetime=60, max_lifetime=120),
+            ]
+        )
+        self.session.commit()
+        self.repo = ChallengeRepository(self.session, CatalogueCache(None))
+        self.now = datetime.now()
+
+    def join(self, chall_id: int, user_id: str, age: int):
+        self.session.execute(
+            insert(joins).values(
+                challenge_id=chall_id,
+                user_id=user_id,
+                joined_at=self.now - timedelta(seconds=age),
+            )
+        )
+        self.session.commit()
+
+    def test_sweeps_joins_past_their_challenge_max_lifetime(self):
+        self.join(1, "alice", 3000)
+        self.join(1, "bob", 4000)
+        self.join(2, "alice", 200)
+        self.join(2, "bob", 100)
+        expired = self.repo.expire_joins(self.now, 900, 3600)
+        self.assertEqual(
+            expired,
+            {1: {"users": ["bob"], "remaining": 1}, 2: {"users": ["alice"], "remaining": 1}},
+        )
+        left = self.session.execute(select(joins.c.challenge_id, joins.c.user_id)).all()
+        self.assertEqual(sorted(left), [(1, "alice"), (2, "bob")])
+
+    def test_cron_sweep_forgets_the_swept_joins(self):
+        store = FakeRedis()
+        expiry = JoinExpiry(store)
+        self.join(1, "alice", 100)
+        self.join(2, "alice", 200)
+        self.join(2, "bob", 200)
+        expiry.start(2, "alice", 600)
+        expiry.start(2, "bob", 600)
+        cleaned, released = [], []
+        for target in (
+            patch.object(cron.Storage, "get", lambda: iter([self.session])),
+            patch.object(cron.RedisStorage, "get", lambda: iter([store])),
+            patch.object(cron.clean_challenges, "delay", cleaned.append),
+            patch.object(cron.release_instances, "delay", released.append),
+            patch.dict("cron.config", {"JOINS": {"LIFETIME": 60, "MAX_LIFETIME": 150}}),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+        cron.delete_joined_users()
+        self.assertEqual(cleaned, [[2]])
+        self.assertEqual(sorted(released[0]), [(2, "alice"), (2, "bob")])
+        self.assertIsNone(deadline(store, 2, "alice"))
+        self.assertIsNone(deadline(store, 2, "bob"))
+        left = self.session.execute(select(joins.c.challenge_id, joins.c.user_id)).all()
+        self.assertEqual(left, [(1, "alice")])
+
+    def test_lifetime_longer_than_max_lifetime_wins(self):
+        self.join(1, "alice", 1000)
+        self.assertEqual(self.repo.expire_joins(self.now, 1200, 600), {})
+        self.assertEqual(list(self.repo.expire_joins(self.now, 900, 600)), [1])
+
+
+class TestExtendJoin(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = AsyncFakeRedis()
+        joined = {"alice"}
+        challenge = SimpleNamespace(id=1, lifetime=60, max_lifetime=120)
+
+        class Repo:
+            async def find_one(self, query):
+                return challenge if query.id == 1 else None
+
+            async def is_joined(self, chall_id, user_id):
+                return user_id in joined
+
+        def service(user_id: str) -> ChallengeService:
+            return ChallengeService(
+                user=SimpleNamespace(id=user_id, is_admin=False),
+                lock_store=self.store,
+                repo=Repo(),
+                user_repo=None,
+                instance_repo=None,
+            )
+
+        self.service = service
+
+    async def test_extends_up_to_the_max_lifetime(self):
+        now = float(int(time.time()))
+        with patch("utils.expiry.time.time", return_value=now):
+            await AsyncJoinExpiry(self.store).start(1, "alice", 60)
+        with patch("utils.expiry.time.time", return_value=now + 100):
+            extended = await self.service("alice").extend_join(1)
+        self.assertEqual(extended, {"expires_at": now + 120})
+        self.assertIsNone(await self.service("bob").extend_join(1))
+        self.assertIsNone(await self.service("alice").extend_join(2))
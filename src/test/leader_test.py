@@ -0,0 +1,83 @@
+from unittest import TestCase
+from unittest.mock import patch
+from apscheduler.schedulers.background import BackgroundScheduler
+from fakeredis import FakeRedis
+from redis import RedisError
+from utils.leader import LeaderLease
+import cron
+
+
+class TestLeaderLease(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.first = LeaderLease(self.store, "cron", 30)
+        self.second = LeaderLease(self.store, "cron", 30)
+
+    def test_only_one_holder(self):
+        self.assertTrue(self.first.acquire())
+        self.assertFalse(self.second.acquire())
+        self.assertTrue(self.first.acquire())
+
+    def test_renew_extends_the_lease(self):
+        self.first.acquire()
+        self.store.pexpire("leader:cron", 1000)
+        self.assertTrue(self.first.acquire())
+        self.assertGreater(self.store.pttl("leader:cron"), 29000)
+
+    def test_lost_lease_passes_on(self):
+        self.first.acquire()
+        # The lease ran out while the holder was stalled.
+        self.store.delete("leader:cron")
+        self.assertTrue(self.second.acquire())
+        self.assertFalse(self.first.acquire())
+
+    def test_release_frees_only_an_own_lease(self):
+        self.first.acquire()
+        self.second.release()
+        self.assertFalse(self.second.acquire())
+        self.first.release()
+        self.assertTrue(self.second.acquire())
+
+    def test_redis_failure_is_not_leadership(self):
+        with patch.object(self.first, "_acquire", side_effect=RedisError("down")):
+            self.assertFalse(self.first.acquire())
+
+    def test_only_runs_in_the_holder(self):
+        runs = []
+        self.first.acquire()
+        self.assertIsNone(self.second.only(runs.append)("second"))
+        self.first.only(runs.append)("first")
+        self.assertEqual(runs, ["first"])
+
+
+class TestCronStart(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        for target in (
+            patch.object(cron.RedisStorage, "get", lambda: iter([self.store])),
+            patch.object(cron, "scheduler", BackgroundScheduler()),
+            patch.object(cron, "leader", None),
+            patch.object(cron, "reaper", None),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+
+    def test_lease_and_reaper_are_built_on_start(self):
+        self.assertIsNone(cron.leader)
+        cron.start()
+        try:
+            self.assertIsInstance(cron.leader, LeaderLease)
+            self.assertEqual(
+                {x.id for x in cron.scheduler.get_jobs()},
+                {
+                    "renew_leader",
+                    "delete_joined_users",
+                    "refill_warm_pools",
+                    "reconcile_instances",
+                    "admit_queued_starts",
+                },
+            )
+        finally:
+            cron.shutdown()
+        self.assertFalse(cron.reaper.running)
+        self.assertIsNone(self.store.get("leader:cron"))
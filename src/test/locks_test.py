@@ -0,0 +1,179 @@
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+from fakeredis import FakeRedis
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from services.challenge import ChallengeService
+from utils.locks import AsyncStartLock, StartLock
+from services.instance import InstanceService
+from utils.scheduler import PLACEMENTS_KEY, Node, Scheduler
+from utils.state import AsyncInstanceState
+import asyncio
+import worker
+
+NODES = [Node("a", "tcp://a:2375", "a", 0, 0)]
+
+
+class TestStartLock(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.lock = StartLock(self.store)
+
+    def test_later_requests_follow_the_first_task(self):
+        self.assertEqual(self.lock.acquire(1, "a"), "a")
+        self.assertEqual(self.lock.acquire(1, "b"), "a")
+        self.assertEqual(self.lock.holder(1), "a")
+        self.assertEqual(self.lock.acquire(2, "b"), "b")
+
+    def test_only_the_holder_claims_and_releases(self):
+        self.lock.acquire(1, "a")
+        self.assertTrue(self.lock.claim(1, "a"))
+        self.assertFalse(self.lock.claim(1, "b"))
+        self.assertFalse(self.lock.release(1, "b"))
+        self.assertEqual(self.lock.holder(1), "a")
+        self.assertTrue(self.lock.release(1, "a"))
+        # A task published without the API claims a free lock.
+        self.assertTrue(self.lock.claim(1, "b"))
+
+    def test_nothing_starts_while_deleting(self):
+        self.store.set(self.lock.delete_key(1), 1)
+        self.assertIsNone(self.lock.acquire(1, "a"))
+        self.assertIsNone(self.lock.holder(1))
+
+    def test_worker_skips_a_start_another_task_holds(self):
+        self.lock.acquire("player:7", "a")
+        with patch.object(worker.RedisStorage, "get", lambda: iter([self.store])):
+            result = worker.start_instance.apply(args=(7,), task_id="b").get()
+        self.assertEqual(result, "Instance 7 is started by task a")
+        self.assertEqual(self.lock.holder("player:7"), "a")
+
+    def test_worker_releases_a_start_whose_challenge_is_gone(self):
+        class Repo:
+            def __init__(self, storage, cache):
+                pass
+
+            def find_one(self, query):
+                return None
+
+        self.lock.acquire(1, "a")
+        Scheduler(self.store, NODES).place(1, 100, 0)
+        for target in (
+            patch("utils.scheduler.load_nodes", return_value=NODES),
+            patch.object(worker, "ChallengeRepository", Repo),
+            patch.object(worker.Storage, "get", lambda: iter([None])),
+            patch.object(worker.RedisStorage, "get", lambda: iter([self.store])),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+        self.assertIsNone(
+            worker.start_challenge.apply(args=(1, "alice"), task_id="a").get()
+        )
+        self.assertIsNone(self.lock.holder(1))
+        self.assertEqual(Scheduler(self.store).placements(), {})
+
+
+class TestChallengeStart(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = AsyncFakeRedis()
+        self.challenge = SimpleNamespace(
+            id=1,
+            title="pwn",
+            instance_scope="shared",
+            warm_pool_size=0,
+            services=[],
+            players=[{"id": "alice"}],
+        )
+        challenge = self.challenge
+
+        class Repo:
+            async def find_detail(self, chall_id):
+                return challenge
+
+            async def detail_snapshot(self, chall_id):
+                return {"players": challenge.players}
+
+        self.service = ChallengeService(
+            user=SimpleNamespace(id="alice", is_admin=False),
+            lock_store=self.store,
+            repo=Repo(),
+            user_repo=None,
+            instance_repo=None,
+        )
+        self.published = []
+        for target in (
+            patch("utils.scheduler.load_nodes", return_value=NODES),
+            patch("services.challenge.enqueue", self.enqueue),
+            patch("services.challenge.clean_challenge", lambda chall_id: None),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+
+    async def enqueue(self, task, *args, task_id=None, **kwargs):
+        await asyncio.sleep(0)
+        self.published.append(task_id)
+
+    async def test_concurrent_starts_are_coalesced(self):
+        first, second = await asyncio.gather(
+            self.service.create_instance(1), self.service.create_instance(1)
+        )
+        self.assertEqual(len(self.published), 1)
+        self.assertFalse(first["coalesced"])
+        self.assertTrue(second["coalesced"])
+        self.assertEqual(second["task_id"], first["task_id"])
+
+    async def test_lock_released_when_publishing_fails(self):
+        async def broken(*args, **kwargs):
+            raise RuntimeError("broker is down")
+
+        with patch("services.challenge.enqueue", broken):
+            with self.assertRaises(RuntimeError):
+                await self.service.create_instance(1)
+            with self.assertRaises(RuntimeError):
+                await self.service.reset_challenge(1)
+        self.assertIsNone(await self.store.get(AsyncStartLock.key(1)))
+        # The placement made by admit is freed too.
+        self.assertEqual(await self.store.hgetall(PLACEMENTS_KEY), {})
+        started = await self.service.reset_challenge(1)
+        self.assertEqual(self.published, [started["task_id"]])
+
+    async def test_refused_while_deleting(self):
+        await self.store.set(AsyncStartLock.delete_key(1), 1)
+        self.assertIsNone(await self.service.create_instance(1))
+        self.assertIsNone(await self.service.reset_challenge(1))
+        self.assertEqual(self.published, [])
+
+
+class TestInstanceStart(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = AsyncFakeRedis()
+        challenge = SimpleNamespace(id=3, title="rev", instance_scope="player", services=[])
+        instance = SimpleNamespace(id=7)
+
+        class ChallengeRepo:
+            async def find_detail(self, chall_id):
+                return challenge
+
+        class Repo:
+            async def find_for(self, chall_id, user_id):
+                return instance
+
+        self.service = InstanceService(
+            user=SimpleNamespace(id="alice", is_admin=False),
+            lock_store=self.store,
+            repo=Repo(),
+            challenge_repo=ChallengeRepo(),
+        )
+        target = patch("utils.scheduler.load_nodes", return_value=NODES)
+        target.start()
+        self.addCleanup(target.stop)
+        await AsyncInstanceState(self.store, prefix="player").transition(7, "failed")
+
+    async def test_placement_released_when_publishing_fails(self):
+        async def broken(*args, **kwargs):
+            raise RuntimeError("broker is down")
+
+        with patch("services.instance.enqueue", broken):
+            with self.assertRaises(RuntimeError):
+                await self.service.start(3)
+        self.assertEqual(await self.store.hgetall(PLACEMENTS_KEY), {})
+        self.assertIsNone(await self.store.get(AsyncStartLock.key("player:7")))
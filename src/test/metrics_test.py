@@ -0,0 +1,70 @@
+from unittest import TestCase
+from fakeredis import FakeRedis
+from prometheus_client import REGISTRY, CollectorRegistry, generate_latest
+from utils import metrics
+from utils.cluster_metrics import ClusterCollector
+
+
+def observed(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(f"{name}_count", labels) or 0
+
+
+class CountingRedis(FakeRedis):
+    """A ``FakeRedis`` that counts the commands sent to it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = 0
+
+    def execute_command(self, *args, **kwargs):
+        self.commands += 1
+        return super().execute_command(*args, **kwargs)
+
+
+class TestMetrics(TestCase):
+    def test_docker_operations_are_bounded(self):
+        operation = metrics.docker_operation
+        self.assertEqual(
+            operation("post", "http+docker://localhost/v1.44/containers/create?name=x"),
+            "POST /containers/create",
+        )
+        self.assertEqual(
+            operation("POST", "http://node-2:2375/v1.44/containers/chall-web-1/start"),
+            "POST /containers/{id}/start",
+        )
+        self.assertEqual(
+            operation("GET", "http://node/v1.44/images/ghcr.io/team/web:latest/json"),
+            "GET /images/{id}/json",
+        )
+        self.assertEqual(
+            operation("DELETE", "http://node/v1.44/networks/chall-web-network"),
+            "DELETE /networks/{id}",
+        )
+        self.assertEqual(operation("GET", "http://node/_ping"), "GET /_ping")
+
+    def test_phase_timer(self):
+        phases = []
+        before = observed(
+            "instance_manager_start_phase_seconds", kind="test", phase="ports"
+        )
+        timer = metrics.PhaseTimer("test", phases.append)
+        timer("network")
+        timer("ports")
+        timer.done("running")
+        self.assertEqual(phases, ["network", "ports"])
+        self.assertEqual(
+            observed("instance_manager_start_phase_seconds", kind="test", phase="ports"),
+            before + 1,
+        )
+        self.assertEqual(
+            observed("instance_manager_start_seconds", kind="test", outcome="running"), 1
+        )
+
+    def test_cluster_metrics_are_read_only_when_scraped(self):
+        store = CountingRedis()
+        registry = CollectorRegistry(auto_describe=True)
+        registry.register(ClusterCollector(store, FakeRedis()))
+        self.assertEqual(store.commands, 0)
+        scraped = generate_latest(registry).decode()
+        self.assertIn("instance_manager_port_pool_ports", scraped)
+        self.assertGreater(store.commands, 0)
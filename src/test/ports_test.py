@@ -0,0 +1,129 @@
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+from fakeredis import FakeRedis, FakeServer
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from utils.ports import (
+    FREE_PORTS_KEY,
+    LEASED_PORTS_KEY,
+    LEASES_KEY,
+    REBUILD_LOCK_KEY,
+    AsyncPortAllocator,
+    PortAllocator,
+)
+import time
+
+
+class TestPortPool(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.ports = PortAllocator(self.store)
+
+    def free(self) -> set:
+        return {int(x) for x in self.store.smembers(FREE_PORTS_KEY)}
+
+    def leased(self) -> set:
+        return {int(x) for x in self.store.smembers(LEASED_PORTS_KEY)}
+
+    def test_first_reservation_seeds_the_pool(self):
+        self.ports.reserve("1", 2)
+        self.assertEqual(len(self.free()), self.ports.total - 2)
+        self.ports.release_reservation("1")
+        self.assertEqual(len(self.free()), self.ports.total)
+        # Seeded once: an emptied pool is not refilled behind the leases.
+        self.ports.reserve("1", self.ports.total)
+        with self.assertRaises(IOError):
+            self.ports.reserve("2", 1)
+
+    def test_rebuild_leaves_out_published_ports(self):
+        published = {self.ports._min_port, self.ports._min_port + 5}
+        self.assertEqual(self.ports.rebuild(published), self.ports.total - 2)
+        self.assertFalse(published & self.free())
+
+    def test_rebuild_keeps_reservations_made_before_their_containers(self):
+        # A worker reserved ports for a container Docker does not list yet.
+        reserved = set(self.ports.reserve("1", 3))
+        self.assertEqual(self.ports.rebuild(set()), self.ports.total - 3)
+        self.assertFalse(reserved & self.free())
+        self.ports.release_reservation("1")
+        self.assertEqual(self.leased(), set())
+        self.assertTrue(reserved <= self.free())
+
+    def test_one_rebuild_at_a_time(self):
+        self.ports.reserve("1", 1)
+        self.store.set(REBUILD_LOCK_KEY, 1)
+        self.assertEqual(self.ports.rebuild(set()), self.ports.total - 1)
+
+
+class TestReservation(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.ports = PortAllocator(self.store)
+
+    def free(self) -> set:
+        return {int(x) for x in self.store.smembers(FREE_PORTS_KEY)}
+
+    def leased(self) -> set:
+        return {int(x) for x in self.store.smembers(LEASED_PORTS_KEY)}
+
+    def test_all_or_nothing(self):
+        with self.assertRaises(IOError):
+            self.ports.reserve("1", self.ports.total + 1)
+        self.assertEqual(len(self.free()), self.ports.total)
+        self.assertEqual(self.leased(), set())
+        self.assertEqual(len(self.ports.reserve("1", self.ports.total)), self.ports.total)
+        self.assertEqual(self.free(), set())
+
+    def test_one_lease_per_owner(self):
+        self.ports.reserve("1", 2)
+        with self.assertRaises(IOError):
+            self.ports.reserve("1", 1)
+        self.assertEqual(len(self.leased()), 2)
+
+    def test_rollback_after_a_partial_start(self):
+        # The first service started, the second could not: every port returns.
+        reserved = set(self.ports.reserve("1", 2))
+        self.assertEqual(self.ports.release_reservation("1"), 2)
+        self.assertTrue(reserved <= self.free())
+        self.assertEqual(self.leased(), set())
+        self.assertEqual(self.store.zcard(LEASES_KEY), 0)
+        self.assertEqual(self.ports.release_reservation("1"), 0)
+
+    def test_pending_lease_expires(self):
+        stale = set(self.ports.reserve("1", 2))
+        later = time.time() + self.ports._lease_ttl + 1
+        with patch("utils.ports.time.time", return_value=later):
+            self.ports.reserve("2", 1)
+        self.assertTrue(stale <= self.free())
+        self.assertEqual(self.store.zscore(LEASES_KEY, "1"), None)
+        self.assertEqual(len(self.leased()), 1)
+
+    def test_committed_lease_is_kept(self):
+        kept = set(self.ports.reserve("1", 2))
+        self.ports.commit("1")
+        later = time.time() + self.ports._lease_ttl + 1
+        with patch("utils.ports.time.time", return_value=later):
+            self.ports.reserve("2", 1)
+        self.assertFalse(kept & self.free())
+        self.assertTrue(kept <= self.leased())
+        self.assertEqual(self.ports.stats()["pending_leases"], 1)
+
+
+class TestTransfer(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        server = FakeServer()
+        self.store = FakeRedis(server=server)
+        self.ports = PortAllocator(self.store)
+        self.api = AsyncPortAllocator(AsyncFakeRedis(server=server))
+
+    async def test_warm_lease_moves_as_a_unit(self):
+        ports = set(self.ports.reserve("warm:a", 2))
+        self.assertTrue(await self.api.transfer("warm:a", "3"))
+        self.assertFalse(await self.api.transfer("warm:a", "4"))
+        self.assertEqual(self.ports.release_reservation("3"), 2)
+        self.assertTrue(ports <= {int(x) for x in self.store.smembers(FREE_PORTS_KEY)})
+
+    async def test_owner_with_a_lease_is_refused(self):
+        self.ports.reserve("warm:a", 1)
+        self.ports.reserve("3", 1)
+        with self.assertRaises(IOError):
+            await self.api.transfer("warm:a", "3")
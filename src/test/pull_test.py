@@ -0,0 +1,164 @@
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+from fakeredis import FakeRedis
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from services.challenge import ChallengeService
+from utils.pull import PullEngine, PullProgress
+from utils.state import AsyncInstanceState
+import threading
+
+# What the daemon streams for an image with one cached and one new layer.
+EVENTS = [
+    {"status": "Pulling from library/pwn", "id": "latest"},
+    {"status": "Already exists", "progressDetail": {}, "id": "a"},
+    {"status": "Pulling fs layer", "progressDetail": {}, "id": "b"},
+    {"status": "Downloading", "progressDetail": {"current": 25, "total": 100}, "id": "b"},
+    {"status": "Downloading", "progressDetail": {"current": 75, "total": 100}, "id": "b"},
+    {"status": "Download complete", "progressDetail": {}, "id": "b"},
+    {"status": "Extracting", "progressDetail": {"current": 10, "total": 100}, "id": "b"},
+    {"status": "Pull complete", "progressDetail": {}, "id": "b"},
+    {"status": "Digest: sha256:0"},
+]
+
+
+class FakeDocker:
+    """Streams ``EVENTS`` for every pull, or the daemon error of a missing image."""
+
+    def __init__(self):
+        self.pulled = []
+        self._lock = threading.Lock()
+
+    def pull_image(self, image_name: str, progress=None):
+        with self._lock:
+            self.pulled.append(image_name)
+        if image_name.startswith("missing"):
+            raise Exception(f"manifest for {image_name} not found")
+        for event in EVENTS:
+            progress(event)
+        return True
+
+
+class TestPullProgress(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.now = 1000.0
+        target = patch("utils.pull.time.monotonic", lambda: self.now)
+        target.start()
+        self.addCleanup(target.stop)
+        self.progress = PullProgress(self.store, "pwn")
+        self.progress.start()
+
+    def read(self) -> dict:
+        return PullEngine.read_progress(self.store, ["pwn"])
+
+    def test_layers_are_summed(self):
+        for event in EVENTS[:5]:
+            self.progress.update(event)
+        self.progress.flush()
+        self.assertEqual(
+            self.read(),
+            {"state": "pulling", "current": 75, "total": 100, "percent": 75.0, "error": ""},
+        )
+        # Extraction counts as downloaded, not as 10 of 100 again.
+        for event in EVENTS[5:]:
+            self.progress.update(event)
+        self.progress.finish()
+        self.assertEqual(self.read()["state"], "done")
+        self.assertEqual(self.read()["percent"], 100.0)
+
+    def test_events_without_a_layer_are_ignored(self):
+        self.progress.update(EVENTS[0])
+        self.progress.update(EVENTS[-1])
+        self.progress.flush()
+        self.assertEqual(
+            [x for x in self.store.hkeys("pull:pwn") if x.startswith(b"layer:")], []
+        )
+        self.assertIsNone(self.read()["percent"])
+
+    def test_writes_are_throttled(self):
+        self.progress.update(EVENTS[2])
+        self.assertIn(b"layer:b", self.store.hkeys("pull:pwn"))
+        self.progress.update(EVENTS[3])
+        self.assertEqual(self.read()["current"], 0)
+        self.now += 1
+        self.progress.update(EVENTS[4])
+        self.assertEqual(self.read()["current"], 75)
+
+    def test_failure_is_recorded(self):
+        self.progress.finish(error="no space left on device")
+        self.assertEqual(self.read()["state"], "failed")
+        self.assertEqual(self.read()["error"], "no space left on device")
+        self.assertGreater(self.store.ttl("pull:pwn"), 0)
+
+
+class TestPullEngine(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.docker = FakeDocker()
+        self.engine = PullEngine(self.docker, self.store)
+
+    def test_each_reference_is_pulled_once(self):
+        self.engine.pull(["pwn", "web", "pwn"])
+        self.assertEqual(sorted(self.docker.pulled), ["pwn", "web"])
+        self.assertEqual(PullEngine.read_progress(self.store, ["pwn", "web"])["state"], "done")
+        self.assertFalse(self.store.exists("pull:pwn:lock"))
+
+    def test_failures_are_collected(self):
+        with self.assertRaisesRegex(Exception, "missing-a: manifest for missing-a"):
+            self.engine.pull(["pwn", "missing-a"])
+        progress = PullEngine.read_progress(self.store, ["pwn", "missing-a"])
+        self.assertEqual(progress["state"], "failed")
+        self.assertFalse(self.store.exists("pull:missing-a:lock"))
+
+    def test_waits_for_a_pull_in_flight(self):
+        self.store.set("pull:pwn:lock", 1)
+        other = PullProgress(self.store, "pwn")
+        other.start()
+
+        def finish_other(seconds: float):
+            other.finish(error="unauthorized")
+            self.store.delete("pull:pwn:lock")
+
+        with patch("utils.pull.time.sleep", finish_other):
+            with self.assertRaisesRegex(Exception, "pwn: unauthorized"):
+                self.engine.pull(["pwn"])
+        self.assertEqual(self.docker.pulled, [])
+
+
+class TestPullStatus(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = AsyncFakeRedis()
+        self.state = AsyncInstanceState(self.store)
+        self.service = ChallengeService(
+            user=SimpleNamespace(id="alice", is_admin=False),
+            lock_store=self.store,
+            repo=None,
+            user_repo=None,
+            instance_repo=None,
+        )
+
+    async def test_pulling_status_carries_the_progress(self):
+        await self.state.transition(1, "pulling", phase="images", images=["pwn", "web"])
+        await self.store.hset(
+            "pull:pwn",
+            mapping={"state": "done", "layer:a": '{"current": 40, "total": 40}'},
+        )
+        await self.store.hset(
+            "pull:web",
+            mapping={"state": "pulling", "layer:b": '{"current": 10, "total": 60}'},
+        )
+        result = await self.service.get_challenge_status(1)
+        self.assertEqual((result["status"], result["phase"]), ("pulling", "images"))
+        self.assertNotIn("images", result)
+        self.assertEqual(
+            result["progress"],
+            {"state": "pulling", "current": 50, "total": 100, "percent": 50.0, "error": ""},
+        )
+
+    async def test_other_statuses_have_no_progress(self):
+        self.assertEqual((await self.service.get_challenge_status(1))["status"], "stopped")
+        await self.state.transition(1, "running", players=1)
+        result = await self.service.get_challenge_status(1)
+        self.assertEqual((result["status"], result["players"]), ("running", 1))
+        self.assertNotIn("progress", result)
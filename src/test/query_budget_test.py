@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+from unittest import IsolatedAsyncioTestCase
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+from repository.schema import Base, Challenge, Service, User
+from repository.cache import AsyncCatalogueCache
+from repository.challenge import AsyncChallengeRepository
+from repository.user import AsyncUserRepository
+from models.challenge import ChallengeConfig, ServiceConfig
+from services.challenge import ChallengeService
+
+LIST_BUDGET = 2
+DETAIL_BUDGET = 3
+
+
+def challenge_config(title: str, images: dict) -> ChallengeConfig:
+    return ChallengeConfig(
+        title=title,
+        services=[ServiceConfig(name=name, image=image) for name, image in images.items()],
+    )
+
+
+class TestQueryBudget(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.engine = create_async_engine(
+            "sqlite+aiosqlite://",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        self.session = async_sessionmaker(self.engine, expire_on_commit=False)()
+        users = [
+            User(id=f"user-{i}", email=f"user{i}@game", display_name=f"user {i}")
+            for i in range(100)
+        ]
+        self.session.add_all(users)
+        for i in range(60):
+            challenge = Challenge(
+                title=f"challenge {i}",
+                visible=True,
+                connection_info={"host": "localhost", "ports": {}},
+            )
+            challenge.services = [
+                Service(
+                    image=f"image-{i}-{j}",
+                    name=f"service-{j}",
+                    ports=[],
+                    environment=[],
+                    cap_add=[],
+                )
+                for j in range(3)
+            ]
+            challenge.players = users[i : i + 40]
+            self.session.add(challenge)
+        await self.session.commit()
+        self.session.expunge_all()
+        self.user = await self.session.get(User, "user-5")
+        self.service = ChallengeService(
+            user=self.user,
+            lock_store=None,
+            repo=AsyncChallengeRepository(
+                self.session, cache=AsyncCatalogueCache(None)
+            ),
+            user_repo=AsyncUserRepository(self.session),
+        )
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.engine.dispose()
+
+    @contextmanager
+    def count_queries(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine.sync_engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(self.engine.sync_engine, "before_cursor_execute", record)
+
+    async def test_list_challenges(self):
+        with self.count_queries() as statements:
+            result = await self.service.list_challenges(1)
+        self.assertLessEqual(len(statements), LIST_BUDGET)
+        self.assertEqual(result["total"], 60)
+        self.assertEqual(len(result["data"]), 50)
+        self.assertEqual(result["data"][0]["player_count"], 40)
+        self.assertEqual([x["id"] for x in result["join"]], list(range(1, 7)))
+
+    async def test_get_challenge(self):
+        with self.count_queries() as statements:
+            result = await self.service.get_challenge(3)
+        self.assertLessEqual(len(statements), DETAIL_BUDGET)
+        self.assertTrue(result["joined"])
+        self.assertEqual(len(result["services"]), 3)
+        self.assertEqual(len(result["players"]), 40)
+
+    async def test_create_round_trips_do_not_grow_with_services(self):
+        counts = []
+        for size in (1, 8):
+            images = {f"service-{j}": f"image-{j}" for j in range(size)}
+            with self.count_queries() as statements:
+                chall = await self.service._repo.create(
+                    challenge_config(f"bulk {size}", images)
+                )
+            counts.append(len(statements))
+            self.assertEqual(len(chall.services), size)
+        self.assertEqual(counts[0], counts[1])
+
+    async def test_update_upserts_and_prunes_services(self):
+        images = {"service-0": "image-new", "service-9": "image-9"}
+        with self.count_queries() as statements:
+            chall = await self.service._repo.update(
+                challenge_config("challenge 0", images)
+            )
+        self.assertLessEqual(len(statements), 3 + DETAIL_BUDGET)
+        self.assertEqual({x.name: x.image for x in chall.services}, images)
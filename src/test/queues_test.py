@@ -0,0 +1,35 @@
+from unittest import TestCase
+from utils import queues
+
+
+class Task:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class TestQueues(TestCase):
+    def test_starts_come_first(self):
+        self.assertEqual(queues.queue_names()[0], "start")
+        self.assertEqual(set(queues.ROUTES.values()) - set(queues.queue_names()), set())
+
+    def test_routing(self):
+        self.assertEqual(queues.queue_of("worker.pull_images"), "pull")
+        self.assertEqual(queues.queue_of("worker.start_instance"), "start")
+        self.assertEqual(queues.queue_of("worker.clean_challenge"), "teardown")
+        self.assertEqual(queues.queue_of("worker.reconcile"), "default")
+
+    def test_time_limits_follow_the_queue(self):
+        limits = queues.QueueTimeLimits()
+        pull = queues.settings("pull")
+        self.assertEqual(
+            limits.annotate(Task("worker.pull_images")),
+            {"soft_time_limit": pull["SOFT_TIME_LIMIT"], "time_limit": pull["TIME_LIMIT"]},
+        )
+        self.assertIsNone(limits.annotate(Task("celery.chord_unlock")))
+
+    def test_consumed_queue(self):
+        self.assertEqual(queues.consumed_queue(["pull"]), "pull")
+        self.assertEqual(queues.consumed_queue("teardown"), "teardown")
+        self.assertIsNone(queues.consumed_queue(["start", "pull"]))
+        self.assertIsNone(queues.consumed_queue(None))
+        self.assertIsNone(queues.consumed_queue(["elsewhere"]))
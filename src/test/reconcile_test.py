@@ -0,0 +1,187 @@
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+from fakeredis import FakeRedis
+from utils.docker import LABEL_CHALLENGE, LABEL_INSTANCE
+from utils.ports import LEASED_PORTS_KEY, LEASES_KEY, PortAllocator
+from utils.reconcile import REPORT_KEY, Reconciler
+from utils.scheduler import Node, Scheduler
+from utils.state import InstanceState
+import json
+import time
+
+NODES = [Node("a", "tcp://a:2375", "a", 0, 0)]
+
+
+class FakeDocker:
+    """The two listing calls the reconciler makes to a node."""
+
+    def __init__(self, instances: dict = None, reachable: bool = True):
+        # Instance name -> (challenge id, running containers)
+        self.instances = instances or {}
+        self.reachable = reachable
+
+    def managed_containers(self):
+        if not self.reachable:
+            raise ConnectionError("node is down")
+        return [
+            SimpleNamespace(
+                id=f"{name}-1",
+                attrs={
+                    "Labels": {LABEL_INSTANCE: name, LABEL_CHALLENGE: str(chall_id)},
+                    "State": "running" if running else "exited",
+                },
+            )
+            for name, (chall_id, running) in self.instances.items()
+        ]
+
+    def managed_networks(self):
+        return [
+            SimpleNamespace(
+                name=f"{name}-network",
+                attrs={"Labels": {LABEL_INSTANCE: name, LABEL_CHALLENGE: str(chall_id)}},
+            )
+            for name, (chall_id, _) in self.instances.items()
+        ]
+
+
+class FakeRepo:
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def list_all(self):
+        return self.rows
+
+    def change_status(self, challenge, connection_info=None):
+        challenge.connection_info = connection_info
+        challenge.status = "running" if connection_info else "stopped"
+        return challenge
+
+
+def challenge(chall_id: int, instance: str = None):
+    return SimpleNamespace(
+        id=chall_id,
+        status="running" if instance else "stopped",
+        connection_info={"instance": instance, "node": "a"} if instance else None,
+    )
+
+
+class TestReconciler(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.torn_down = []
+        for target in (
+            patch("utils.scheduler.load_nodes", return_value=NODES),
+            patch(
+                "utils.reconcile.teardown_instance",
+                lambda docker, instance, grace: self.torn_down.append(instance),
+            ),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+        self.state = InstanceState(self.store)
+        self.ports = PortAllocator(self.store)
+
+    def run_reconciler(self, challenges: list, docker: FakeDocker, dry_run=False, players=()):
+        self.repo = FakeRepo(challenges)
+        return Reconciler(
+            {"a": docker},
+            self.store,
+            self.repo,
+            FakeRepo(list(players)),
+            dry_run=dry_run,
+        ).run()
+
+    def kinds(self, report: dict) -> list:
+        return sorted(x["kind"] for x in report["fixes"])
+
+    def test_nothing_to_fix(self):
+        self.state.transition(1, "running")
+        report = self.run_reconciler([challenge(1, "chall-1")], FakeDocker({"chall-1": (1, True)}))
+        self.assertEqual(report["fixes"], [])
+        self.assertEqual(json.loads(self.store.get(REPORT_KEY))["instances"], 1)
+
+    def test_stale_lock(self):
+        self.store.set("start:1", "task")
+        self.state.transition(1, "failed")
+        report = self.run_reconciler([challenge(1)], FakeDocker())
+        self.assertEqual(self.kinds(report), ["stale_lock"])
+        self.assertIsNone(self.store.get("start:1"))
+
+    def test_lock_of_a_task_in_progress_is_kept(self):
+        self.store.set("start:1", "task")
+        self.state.transition(1, "creating")
+        self.assertEqual(self.run_reconciler([challenge(1)], FakeDocker())["fixes"], [])
+        self.assertIsNotNone(self.store.get("start:1"))
+
+    def test_dead_instance(self):
+        self.state.transition(1, "running")
+        self.ports.reserve(1, 1)
+        self.ports.commit(1)
+        row = challenge(1, "chall-1")
+        report = self.run_reconciler([row], FakeDocker({"chall-1": (1, False)}))
+        self.assertIn("dead_instance", self.kinds(report))
+        self.assertEqual(row.status, "stopped")
+        self.assertEqual(self.state.current(1), "stopped")
+        self.assertEqual(self.store.smembers(LEASED_PORTS_KEY), set())
+        # Nothing claims the exited containers any more.
+        self.assertEqual(self.torn_down, ["chall-1"])
+
+    def test_orphan_instance(self):
+        report = self.run_reconciler([challenge(1)], FakeDocker({"chall-9": (9, True)}))
+        self.assertEqual(self.kinds(report), ["orphan_instance"])
+        self.assertEqual(self.torn_down, ["chall-9"])
+
+    def test_player_instances_are_not_orphans(self):
+        players = [SimpleNamespace(id=7, name="chall-1-player-a")]
+        docker = FakeDocker({"chall-1-player-a": (1, True)})
+        report = self.run_reconciler([challenge(1)], docker, players=players)
+        self.assertEqual(report["fixes"], [])
+
+    def test_stale_state(self):
+        self.state.transition(1, "running")
+        report = self.run_reconciler([challenge(1)], FakeDocker())
+        self.assertEqual(self.kinds(report), ["stale_state"])
+        self.assertEqual(self.state.current(1), "stopped")
+
+    def test_leaked_lease(self):
+        self.ports.reserve("player:7", 2)
+        self.ports.commit("player:7")
+        report = self.run_reconciler([], FakeDocker())
+        self.assertEqual(self.kinds(report), ["leaked_lease"])
+        self.assertEqual(self.store.zcard(LEASES_KEY), 0)
+
+    def test_leaked_placement(self):
+        scheduler = Scheduler(self.store)
+        scheduler.place("player:7", 100, 0)
+        scheduler.place("player:8", 100, 0)
+        # Only placements older than the lock timeout are given back.
+        placed = scheduler.placements()["player:7"]
+        placed["placed_at"] = time.time() - 10**6
+        self.store.hset("nodes:placements", "player:7", json.dumps(placed))
+        report = self.run_reconciler([], FakeDocker())
+        self.assertEqual(self.kinds(report), ["leaked_placement"])
+        self.assertEqual(list(scheduler.placements()), ["player:8"])
+
+    def test_unreachable_node_is_left_alone(self):
+        self.state.transition(1, "running")
+        report = self.run_reconciler([challenge(1, "chall-1")], FakeDocker(reachable=False))
+        self.assertEqual(report["unreachable_nodes"], ["a"])
+        self.assertEqual(report["fixes"], [])
+
+    def test_dry_run_only_reports(self):
+        self.store.set("start:1", "task")
+        self.state.transition(2, "running")
+        rows = [challenge(1), challenge(2), challenge(3, "chall-3")]
+        docker = FakeDocker({"chall-9": (9, True)})
+        report = self.run_reconciler(rows, docker, dry_run=True)
+        self.assertTrue(report["dry_run"])
+        self.assertEqual(
+            self.kinds(report),
+            ["dead_instance", "orphan_instance", "stale_lock", "stale_state"],
+        )
+        self.assertFalse(any(x.get("repaired") for x in report["fixes"]))
+        self.assertIsNotNone(self.store.get("start:1"))
+        self.assertEqual(self.state.current(2), "running")
+        self.assertEqual(rows[2].status, "running")
+        self.assertEqual(self.torn_down, [])
@@ -0,0 +1,144 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from urllib.parse import urlparse
+from utils.docker import DockerHandler, LABEL_INSTANCE, client_pool
+from utils.scheduler import Node, best_fit, parse_memory
+import json
+import re
+import threading
+
+GIB = 1024**3
+NO_CREDS = {"username": "", "password": ""}
+
+
+class FakeDockerd(BaseHTTPRequestHandler):
+    """Just enough of the Engine API for one node to answer ``DockerHandler``.
+
+    Containers are listed with the node's name as their instance label, and
+    ``containers/create`` fails with "No such image" until the image is pulled.
+    """
+
+    def reply(self, status: int, body=None):
+        raw = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def route(self, method: str):
+        path = re.sub(r"^/v[0-9.]+/", "/", urlparse(self.path).path)
+        self.server.calls.append((method, path))
+        return path
+
+    def do_HEAD(self):
+        self.route("HEAD")
+        self.reply(200)
+
+    def do_GET(self):
+        path = self.route("GET")
+        if path == "/_ping":
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"OK")
+        elif path == "/version":
+            self.reply(200, {"ApiVersion": "1.41", "Version": "20.10.0"})
+        elif path == "/containers/json":
+            self.reply(
+                200,
+                [
+                    {
+                        "Id": f"{self.server.name}-1",
+                        "Labels": {LABEL_INSTANCE: self.server.name},
+                        "State": "running",
+                    }
+                ],
+            )
+        elif path.startswith("/containers/"):
+            self.reply(200, {"Id": path.split("/")[2], "Config": {}, "State": {}})
+        else:
+            self.reply(404, {"message": "not found"})
+
+    def do_POST(self):
+        path = self.route("POST")
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if path == "/images/create":
+            self.server.images.add("challenge")
+            self.reply(200, {"status": "Downloaded newer image"})
+        elif path == "/containers/create":
+            if "challenge" not in self.server.images:
+                self.reply(404, {"message": "No such image: challenge:latest"})
+            else:
+                self.reply(201, {"Id": f"{self.server.name}-2", "Warnings": []})
+        else:
+            self.reply(404, {"message": "not found"})
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBestFit(TestCase):
+    def setUp(self):
+        self.nodes = [
+            Node("big", "tcp://big:2375", "big.game", 8000, 16 * GIB),
+            Node("small", "tcp://small:2375", "small.game", 2000, 4 * GIB),
+        ]
+
+    def test_prefers_the_tightest_node(self):
+        self.assertEqual(best_fit(self.nodes, {}, 1000, GIB).name, "small")
+
+    def test_skips_nodes_without_room(self):
+        reserved = {"small": (1500, GIB)}
+        self.assertEqual(best_fit(self.nodes, reserved, 1000, GIB).name, "big")
+        self.assertEqual(best_fit(self.nodes, {}, 1000, 8 * GIB).name, "big")
+
+    def test_nothing_fits(self):
+        self.assertIsNone(best_fit(self.nodes, {}, 16000, GIB))
+
+    def test_unbounded_node_is_last_resort(self):
+        nodes = [Node("any", "tcp://any:2375", "any.game", 0, 0), *self.nodes]
+        self.assertEqual(best_fit(nodes, {}, 1000, GIB).name, "small")
+        self.assertEqual(best_fit(nodes, {}, 16000, 32 * GIB).name, "any")
+
+    def test_parse_memory(self):
+        self.assertEqual(parse_memory("512M"), 512 * 1024**2)
+        self.assertEqual(parse_memory("1g"), GIB)
+        self.assertEqual(parse_memory("2GB"), 2 * GIB)
+        self.assertEqual(parse_memory(1024), 1024)
+        self.assertEqual(parse_memory(None), 0)
+
+
+class TestNodeRouting(TestCase):
+    def setUp(self):
+        client_pool.reset()
+        self.servers = {}
+        for name in ("a", "b"):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDockerd)
+            server.name, server.calls, server.images = name, [], set()
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers[name] = server
+
+    def tearDown(self):
+        client_pool.reset()
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def node(self, name: str) -> Node:
+        url = f"tcp://127.0.0.1:{self.servers[name].server_port}"
+        return Node(name, url, f"{name}.game", 0, 0)
+
+    def test_handlers_talk_to_their_node(self):
+        for name in ("a", "b"):
+            containers = DockerHandler(NO_CREDS, node=self.node(name)).managed_containers()
+            self.assertEqual([x.attrs["Labels"][LABEL_INSTANCE] for x in containers], [name])
+        self.assertIn(("GET", "/containers/json"), self.servers["a"].calls)
+        self.assertIn(("GET", "/containers/json"), self.servers["b"].calls)
+
+    def test_missing_image_is_pulled_on_the_node(self):
+        docker = DockerHandler(NO_CREDS, node=self.node("b"))
+        container = docker.create_container("challenge", name="chall-web")
+        self.assertEqual(container.id, "b-2")
+        self.assertIn(("POST", "/images/create"), self.servers["b"].calls)
+        self.assertNotIn(("POST", "/images/create"), self.servers["a"].calls)
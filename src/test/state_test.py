@@ -0,0 +1,121 @@
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+from fakeredis import FakeRedis, FakeServer
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from services.challenge import ChallengeService
+from utils.scheduler import Node
+from utils.state import EVENTS_KEY, AsyncInstanceState, InstanceState
+import time
+
+NODES = [Node("a", "tcp://a:2375", "a", 0, 0)]
+
+
+class TestInstanceState(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        server = FakeServer()
+        self.store = FakeRedis(server=server)
+        # The worker writes the state, the API reads it.
+        self.state = InstanceState(self.store)
+        self.api = AsyncInstanceState(AsyncFakeRedis(server=server))
+
+    async def test_transition_replaces_phase_and_error(self):
+        self.state.transition(1, "creating", phase="network", task_id="a")
+        self.state.phase(1, "containers")
+        self.assertEqual((await self.api.get(1))["phase"], "containers")
+        self.state.transition(1, "failed", error="No such image")
+        result = await self.api.get(1)
+        self.assertEqual((result["status"], result["phase"]), ("failed", ""))
+        self.assertEqual(result["error"], "No such image")
+        self.assertIn("creating_at", result)
+        self.state.transition(1, "running", players=1)
+        self.assertEqual((await self.api.get(1))["error"], "")
+        self.assertEqual((await self.api.get(1))["players"], 1)
+
+    def test_unknown_state(self):
+        with self.assertRaises(ValueError):
+            self.state.transition(1, "exploded")
+        self.assertIsNone(self.state.current(1))
+
+    def test_every_change_is_an_event(self):
+        self.state.transition(1, "creating", phase="network")
+        self.state.phase(1, "containers")
+        InstanceState(self.store, prefix="player").transition(7, "running")
+        events = [
+            {k.decode(): v.decode() for k, v in fields.items()}
+            for _, fields in self.store.xrange(EVENTS_KEY)
+        ]
+        self.assertEqual(
+            [(x["scope"], x["id"], x.get("state"), x["phase"]) for x in events],
+            [
+                ("instance", "1", "creating", "network"),
+                ("instance", "1", None, "containers"),
+                ("player", "7", "running", ""),
+            ],
+        )
+
+    def test_states_of_many_instances(self):
+        self.state.transition(1, "running")
+        states = self.state.states([1, 2])
+        self.assertEqual(states[1][0], "running")
+        self.assertEqual(states[2], (None, 0.0))
+
+    async def test_state_of_a_dead_task_is_failed(self):
+        self.state.transition(1, "deleting")
+        self.state.transition(2, "running")
+        self.assertEqual(await self.api.live(1), "deleting")
+        later = time.time() + self.state._stale_after
+        with patch("utils.state.time.time", return_value=later):
+            self.assertEqual(await self.api.live(1), "failed")
+            self.assertEqual(await self.api.live(2), "running")
+            self.assertIsNone(await self.api.live(3))
+        # Progress on a phase keeps it alive.
+        with patch("utils.state.time.time", return_value=later - 1):
+            self.state.phase(1, "containers")
+        with patch("utils.state.time.time", return_value=later):
+            self.assertEqual(await self.api.live(1), "deleting")
+
+
+class TestStartGate(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = AsyncFakeRedis()
+        challenge = SimpleNamespace(
+            id=1, title="pwn", instance_scope="shared", warm_pool_size=0, services=[]
+        )
+
+        class Repo:
+            async def find_detail(self, chall_id):
+                return challenge
+
+        self.service = ChallengeService(
+            user=SimpleNamespace(id="alice", is_admin=False),
+            lock_store=self.store,
+            repo=Repo(),
+            user_repo=None,
+            instance_repo=None,
+        )
+        self.published = []
+
+        async def enqueue(task, *args, task_id=None, **kwargs):
+            self.published.append(task_id)
+
+        for target in (
+            patch("utils.scheduler.load_nodes", return_value=NODES),
+            patch("services.challenge.enqueue", enqueue),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+        self.state = AsyncInstanceState(self.store)
+
+    async def test_busy_states_block_the_start(self):
+        for busy in ("pulling", "running", "deleting"):
+            await self.state.transition(1, busy)
+            self.assertIsNone(await self.service.create_instance(1))
+        self.assertEqual(self.published, [])
+
+    async def test_stale_deleting_does_not_block(self):
+        await self.state.transition(1, "deleting")
+        await self.store.hset("instance:1", "updated_at", time.time() - 10**6)
+        started = await self.service.create_instance(1)
+        self.assertEqual(self.published, [started["task_id"]])
+        self.assertEqual(await self.state.current(1), "creating")
@@ -0,0 +1,158 @@
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+from docker.errors import APIError, NotFound
+from fakeredis import FakeRedis
+from config import config
+from utils.state import InstanceState
+from utils.teardown import TeardownError, teardown_instance
+import worker
+
+
+class FakeContainer:
+    def __init__(self, name: str, failures: int = 0, gone: bool = False):
+        self.name = name
+        self.failures = failures
+        self.gone = gone
+        self.calls = []
+
+    def stop(self, timeout: int):
+        self.calls.append(("stop", timeout))
+        if self.gone:
+            raise NotFound("No such container")
+
+    def kill(self):
+        self.calls.append(("kill",))
+
+    def remove(self, force: bool, v: bool):
+        self.calls.append(("remove",))
+        if self.failures:
+            self.failures -= 1
+            raise APIError("removal already in progress")
+
+
+class FakeNetwork:
+    def __init__(self, name: str):
+        self.name = name
+        self.removed = False
+
+    def remove(self):
+        self.removed = True
+
+
+class FakeDocker:
+    """Labelled lookups, plus lookups by name for unlabelled instances."""
+
+    def __init__(self, labelled: list = (), named: list = (), networks: list = ()):
+        self.labelled = list(labelled)
+        self.named = {x.name: x for x in named}
+        self.networks = {x.name: x for x in networks}
+
+    def instance_containers(self, instance: str):
+        return self.labelled
+
+    def get_container(self, name: str):
+        return self.named.get(name)
+
+    def instance_networks(self, instance: str):
+        return []
+
+    def get_network(self, name: str):
+        return self.networks.get(name)
+
+
+class TestTeardown(TestCase):
+    def setUp(self):
+        patcher = patch("utils.teardown.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_failures_are_retried(self):
+        healthy, flaky = FakeContainer("a"), FakeContainer("b", failures=2)
+        teardown_instance(FakeDocker([healthy, flaky]), "chall-pwn", grace=3)
+        self.assertEqual(healthy.calls, [("stop", 3), ("remove",)])
+        self.assertEqual(flaky.calls.count(("remove",)), 3)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_survivors_are_reported(self):
+        stuck = FakeContainer("a", failures=100)
+        with patch.dict("utils.teardown.config", {"DOCKER": self.docker(retries=2)}):
+            with self.assertRaises(TeardownError):
+                teardown_instance(FakeDocker([stuck]), "chall-pwn", grace=3)
+        self.assertEqual(stuck.calls.count(("remove",)), 3)
+
+    def test_no_grace_kills(self):
+        container = FakeContainer("a")
+        teardown_instance(FakeDocker([container]), "chall-pwn", grace=0)
+        self.assertEqual(container.calls, [("kill",), ("remove",)])
+
+    def test_container_gone_already(self):
+        container = FakeContainer("a", gone=True)
+        teardown_instance(FakeDocker([container]), "chall-pwn", grace=3)
+        self.assertEqual(container.calls, [("stop", 3)])
+
+    def test_unlabelled_instance_is_found_by_name(self):
+        web, network = FakeContainer("chall-pwn-web"), FakeNetwork("chall-pwn-network")
+        docker = FakeDocker(named=[web], networks=[network])
+        teardown_instance(
+            docker,
+            "chall-pwn",
+            grace=0,
+            containers=["chall-pwn-web", "chall-pwn-db"],
+            network="chall-pwn-network",
+        )
+        self.assertEqual(web.calls, [("kill",), ("remove",)])
+        self.assertTrue(network.removed)
+
+    @staticmethod
+    def docker(retries: int) -> dict:
+        return {**config["DOCKER"], "TEARDOWN_RETRIES": retries}
+
+
+class TestCleanChallenge(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.challenge = SimpleNamespace(
+            id=1,
+            title="pwn",
+            services=[],
+            stop_grace=None,
+            connection_info={"instance": "chall-pwn", "node": "a", "ports": {}},
+        )
+        challenge = self.challenge
+
+        class Repo:
+            def __init__(self, storage, cache):
+                pass
+
+            def find_one(self, query):
+                return challenge
+
+            def change_status(self, challenge, connection_info=None):
+                challenge.connection_info = connection_info
+                return challenge
+
+        for target in (
+            patch.object(worker, "ChallengeRepository", Repo),
+            patch.object(worker.Storage, "get", lambda: iter([None])),
+            patch.object(worker.RedisStorage, "get", lambda: iter([self.store])),
+            patch.object(worker, "docker_for", lambda *args: None),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+
+    def test_connection_info_kept_when_teardown_fails(self):
+        def broken(*args, **kwargs):
+            raise TeardownError("1 resources of chall-pwn could not be removed")
+
+        with patch.object(worker, "teardown_instance", broken):
+            worker.clean_challenge(1)
+        self.assertEqual(self.challenge.connection_info["instance"], "chall-pwn")
+        self.assertEqual(InstanceState(self.store).current(1), "failed")
+        self.assertIsNone(self.store.get("delete:1"))
+
+    def test_connection_info_cleared_after_teardown(self):
+        with patch.object(worker, "teardown_instance", lambda *args, **kwargs: None):
+            worker.clean_challenge(1)
+        self.assertIsNone(self.challenge.connection_info)
+        self.assertEqual(InstanceState(self.store).current(1), "stopped")
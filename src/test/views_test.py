@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+from unittest import TestCase
+from fastapi.testclient import TestClient
+from app import app
+from services.challenge import ChallengeService
+
+
+class FakeService:
+    def __init__(self, user):
+        self._user = user
+
+    async def list_challenges(self, page: int):
+        challenge = {
+            "id": 1,
+            "title": "pwn",
+            "player_count": 2,
+            "joined": False,
+            "instance_scope": "shared",
+        }
+        return {"data": [challenge], "total": 1, "join": None}
+
+    async def get_challenge(self, chall_id: int):
+        return {
+            "id": 1,
+            "title": "pwn",
+            "services": [],
+            "players": ["alice", "bob"],
+            "joined": False,
+            "instance_scope": "shared",
+        }
+
+
+class TestChallengeViews(TestCase):
+    def setUp(self):
+        self.client = TestClient(app)
+        self.addCleanup(app.dependency_overrides.clear)
+
+    def login(self, is_admin: bool) -> None:
+        user = SimpleNamespace(id="carol", display_name="carol", is_admin=is_admin)
+        app.dependency_overrides[ChallengeService] = lambda: FakeService(user)
+
+    def test_admin_reaches_the_kicks_from_the_index(self):
+        self.login(is_admin=True)
+        index = self.client.get("/")
+        self.assertIn('href="/challenge/1"', index.text)
+        detail = self.client.get("/challenge/1", follow_redirects=False)
+        self.assertEqual(detail.status_code, 200)
+        self.assertIn('class="btn btn-sm btn-danger kick-player" data-player="bob"', detail.text)
+
+    def test_players_see_no_kicks(self):
+        self.login(is_admin=False)
+        self.assertNotIn('href="/challenge/1"', self.client.get("/").text)
+        detail = self.client.get("/challenge/1", follow_redirects=False)
+        self.assertEqual(detail.status_code, 307)
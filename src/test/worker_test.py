@@ -0,0 +1,234 @@
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import patch
+from fakeredis import FakeRedis, FakeServer
+from fakeredis.aioredis import FakeRedis as AsyncFakeRedis
+from models.challenge import ServiceConfig
+from services.challenge import ChallengeService
+from utils.locks import StartLock
+from utils.ops import service_waves
+from utils.ports import LEASED_PORTS_KEY, PortAllocator
+from utils.scheduler import Node, Scheduler
+from utils.state import AsyncInstanceState
+from utils.warm_pool import WarmPool
+import worker
+
+NODES = [Node("a", "tcp://a:2375", "a.example", 0, 0)]
+
+
+def services(**depends_on) -> list:
+    return [
+        ServiceConfig(image="challenge", name=name, ports=[80], depends_on=deps)
+        for name, deps in depends_on.items()
+    ]
+
+
+class FakeDocker:
+    """The calls ``spawn_instance`` makes to a node, recorded."""
+
+    def __init__(self, node=None, creds=None):
+        self.started = []
+
+    def create_challenge_network(self, name: str, labels: dict = None):
+        return SimpleNamespace(name=name)
+
+    def create_container(self, image_name: str, **kwargs):
+        return SimpleNamespace(start=lambda: self.started.append(kwargs["name"]))
+
+    def attach_container(self, container, network, alias):
+        pass
+
+
+class TestServiceWaves(TestCase):
+    def names(self, waves: list) -> list:
+        return [[x.name for x in wave] for wave in waves]
+
+    def test_dependencies_start_in_earlier_waves(self):
+        listed = services(web=["db", "cache"], db=[], cache=[], bot=["web"])
+        waves = service_waves(listed, {x.name: x.depends_on for x in listed})
+        self.assertEqual(self.names(waves), [["db", "cache"], ["web"], ["bot"]])
+
+    def test_unknown_dependency(self):
+        listed = services(web=["db"])
+        with self.assertRaisesRegex(Exception, "unknown services: \\['db'\\]"):
+            service_waves(listed, {x.name: x.depends_on for x in listed})
+
+    def test_cycle(self):
+        listed = services(a=["b"], b=["c"], c=["a"], d=[])
+        with self.assertRaisesRegex(Exception, "Circular dependency"):
+            service_waves(listed, {x.name: x.depends_on for x in listed})
+
+
+class TestSpawnInstance(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.challenge = SimpleNamespace(
+            id=1, title="pwn", services=services(web=["db"], db=[])
+        )
+        for target in (
+            patch("utils.scheduler.load_nodes", return_value=NODES),
+            patch.object(worker, "DockerHandler", FakeDocker),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+
+    def test_real_start_records_timings(self):
+        entry = worker.spawn_instance(
+            self.store, self.challenge, "chall-pwn", 1, timings_key="chall:1:timings"
+        )
+        self.assertEqual(set(entry["connection_info"]["ports"]), {80})
+        self.assertEqual(set(self.store.hkeys("chall:1:timings")), {b"web", b"db"})
+        # Committed: the lease outlives the pending TTL.
+        self.assertEqual(PortAllocator(self.store).stats()["pending_leases"], 0)
+
+    def test_warm_refill_keeps_the_timings_of_the_last_start(self):
+        self.store.hset("chall:1:timings", mapping={"web": 1.5})
+        entry = worker.spawn_instance(
+            self.store, self.challenge, "chall-pwn-warm-a", "warm:a", start=False
+        )
+        self.assertFalse(entry["started"])
+        self.assertEqual(self.store.hgetall("chall:1:timings"), {b"web": b"1.5"})
+
+
+class TestWarmPool(TestCase):
+    def setUp(self):
+        self.store = FakeRedis()
+        self.pool = WarmPool(self.store)
+        self.challenge = SimpleNamespace(
+            id=1, title="pwn", services=services(web=[]), warm_pool_size=2
+        )
+        self.torn_down = []
+        challenge = self.challenge
+
+        class Repo:
+            def __init__(self, storage, cache):
+                pass
+
+            def find_one(self, query):
+                return challenge
+
+        for target in (
+            patch("utils.scheduler.load_nodes", return_value=NODES),
+            patch.object(worker, "DockerHandler", FakeDocker),
+            patch.object(worker, "docker_for", lambda *args: FakeDocker()),
+            patch.object(worker, "ChallengeRepository", Repo),
+            patch.object(worker.Storage, "get", lambda: iter([None])),
+            patch.object(worker.RedisStorage, "get", lambda: iter([self.store])),
+            patch.object(
+                worker,
+                "teardown_instance",
+                lambda docker, instance, **kwargs: self.torn_down.append(instance),
+            ),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+
+    def test_refill_reserves_under_the_warm_owner(self):
+        worker.refill_warm_pool(1)
+        entries = self.pool.peek([1])[1]
+        self.assertEqual(len(entries), 2)
+        owners = {f"warm:{x['token']}" for x in entries}
+        self.assertEqual(set(Scheduler(self.store).placements()), owners)
+        self.assertEqual(len(self.store.smembers(LEASED_PORTS_KEY)), 2)
+        self.assertIsNone(self.store.get("warm:1:refill"))
+
+    def test_drain_releases_everything(self):
+        worker.refill_warm_pool(1)
+        self.challenge.warm_pool_size = 1
+        worker.refill_warm_pool(1)
+        self.assertEqual(self.pool.size(1), 1)
+        self.assertEqual(len(self.torn_down), 1)
+        worker.drain_warm_pool(1)
+        self.assertEqual(self.pool.size(1), 0)
+        self.assertEqual(len(self.torn_down), 2)
+        self.assertEqual(Scheduler(self.store).placements(), {})
+        self.assertEqual(self.store.smembers(LEASED_PORTS_KEY), set())
+
+
+class TestTakeWarm(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        server = FakeServer()
+        # The worker fills the pool, the API takes from it.
+        self.worker = FakeRedis(server=server)
+        self.store = AsyncFakeRedis(server=server)
+        self.challenge = SimpleNamespace(
+            id=1,
+            title="pwn",
+            instance_scope="shared",
+            warm_pool_size=1,
+            services=services(web=[]),
+            lifetime=None,
+            max_lifetime=None,
+            connection_info=None,
+        )
+        challenge = self.challenge
+
+        class Repo:
+            async def find_detail(self, chall_id):
+                return challenge
+
+            async def change_status(self, challenge, connection_info=None):
+                challenge.connection_info = connection_info
+                return challenge
+
+            async def add_user(self, challenge, user):
+                return challenge
+
+        self.service = ChallengeService(
+            user=SimpleNamespace(id="alice", is_admin=False),
+            lock_store=self.store,
+            repo=Repo(),
+            user_repo=None,
+            instance_repo=None,
+        )
+        self.published = []
+        for target in (
+            patch("utils.scheduler.load_nodes", return_value=NODES),
+            patch("services.challenge.enqueue", self.enqueue),
+        ):
+            target.start()
+            self.addCleanup(target.stop)
+
+    async def enqueue(self, task, *args, task_id=None, **kwargs):
+        self.published.append(task.name)
+
+    async def warm(self, started: bool) -> dict:
+        Scheduler(self.worker).place("warm:a", 0, 0)
+        PortAllocator(self.worker).reserve("warm:a", 1)
+        entry = {
+            "token": "a",
+            "instance": "chall-pwn-warm-a",
+            "started": started,
+            "connection_info": {"host": "a.example", "ports": {}, "node": "a"},
+        }
+        WarmPool(self.worker).put(1, entry)
+        return entry
+
+    async def test_started_instance_is_handed_over(self):
+        entry = await self.warm(started=True)
+        self.assertEqual(
+            await self.service.create_instance(1), {"task_id": None, "coalesced": False}
+        )
+        self.assertEqual(self.challenge.connection_info, entry["connection_info"])
+        self.assertEqual(await AsyncInstanceState(self.store).current(1), "running")
+        self.assertEqual(list(Scheduler(self.worker).placements()), ["1"])
+        self.assertEqual(await self.store.zrange("ports:leases", 0, -1), [b"1"])
+        self.assertIsNone(StartLock(self.worker).holder(1))
+        self.assertEqual(self.published, ["worker.refill_warm_pool"])
+
+    async def test_created_instance_is_started(self):
+        await self.warm(started=False)
+        started = await self.service.create_instance(1)
+        self.assertFalse(started["coalesced"])
+        self.assertEqual(
+            self.published, ["worker.refill_warm_pool", "worker.start_challenge"]
+        )
+        self.assertEqual(StartLock(self.worker).holder(1), started["task_id"])
+
+    async def test_put_back_when_the_challenge_holds_ports(self):
+        await self.warm(started=True)
+        PortAllocator(self.worker).reserve(1, 1)
+        self.assertIsNone(await self.service.create_instance(1))
+        self.assertEqual(WarmPool(self.worker).peek([1])[1][0]["token"], "a")
+        self.assertEqual(list(Scheduler(self.worker).placements()), ["warm:a"])
+        self.assertIsNone(StartLock(self.worker).holder(1))
@@ -0,0 +1,116 @@
+from typing import List, Optional, Tuple, Union
+from utils.scheduler import AsyncScheduler
+import json
+import time
+
+QUEUE_KEY = "admission:queue"
+REQUESTS_KEY = "admission:requests"
+SEQUENCE_KEY = "admission:sequence"
+LOCK_KEY = "admission:lock"
+
+# KEYS: queue, requests, sequence; ARGV: owner, request
+# Returns the owner's 0-based rank; queueing twice keeps the first place.
+PUSH_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    redis.call('ZADD', KEYS[1], redis.call('INCR', KEYS[3]), ARGV[1])
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+return redis.call('ZRANK', KEYS[1], ARGV[1])
+"""
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class _AdmissionQueueBase:
+    """Keys, scripts and replies shared by the sync and async admission queues.
+
+    Owners are the scheduler's (a challenge id or ``player:{id}``), ranked
+    by arrival in the ``admission:queue`` sorted set so a position is one
+    ``ZRANK``; what to start once there is room is kept in
+    ``admission:requests``. Requests carry the ``cpu``/``memory`` demand to
+    place.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._push = store.register_script(PUSH_SCRIPT)
+
+    @staticmethod
+    def _push_call(owner: Union[int, str], request: dict) -> dict:
+        request = {**request, "queued_at": time.time()}
+        return dict(
+            keys=[QUEUE_KEY, REQUESTS_KEY, SEQUENCE_KEY],
+            args=[owner, json.dumps(request)],
+        )
+
+    @staticmethod
+    def _position(rank) -> Optional[int]:
+        return None if rank is None else int(rank) + 1
+
+    @staticmethod
+    def _head(first: list, request) -> Optional[Tuple[str, Optional[dict]]]:
+        if not first:
+            return None
+        return _decode(first[0]), json.loads(request) if request else None
+
+    def _remove_pipeline(self, owner: Union[int, str]):
+        pipe = self._store.pipeline(transaction=True)
+        pipe.zrem(QUEUE_KEY, owner)
+        pipe.hdel(REQUESTS_KEY, owner)
+        return pipe
+
+
+class AdmissionQueue(_AdmissionQueueBase):
+    """The worker's side of the queue: drain it as capacity frees up."""
+
+    def length(self) -> int:
+        return self._store.zcard(QUEUE_KEY)
+
+    def owners(self) -> List[str]:
+        return [_decode(x) for x in self._store.zrange(QUEUE_KEY, 0, -1)]
+
+    def head(self) -> Optional[Tuple[str, Optional[dict]]]:
+        """The oldest owner and its request."""
+        first = self._store.zrange(QUEUE_KEY, 0, 0)
+        request = self._store.hget(REQUESTS_KEY, _decode(first[0])) if first else None
+        return self._head(first, request)
+
+    def remove(self, owner: Union[int, str]) -> None:
+        self._remove_pipeline(owner).execute()
+
+
+class AsyncAdmissionQueue(_AdmissionQueueBase):
+    """The API's side of the queue: admit starts, or queue them."""
+
+    async def push(self, owner: Union[int, str], request: dict) -> int:
+        """Queue ``owner`` and return its 1-based position."""
+        return self._position(await self._push(**self._push_call(owner, request)))
+
+    async def position(self, owner: Union[int, str]) -> Optional[int]:
+        """1-based place of ``owner`` in the queue, ``None`` if not queued."""
+        return self._position(await self._store.zrank(QUEUE_KEY, owner))
+
+    async def remove(self, owner: Union[int, str]) -> None:
+        await self._remove_pipeline(owner).execute()
+
+    async def admit(
+        self, owner: Union[int, str], cpu: int, memory: int, request: dict
+    ) -> Optional[int]:
+        """Reserve capacity for ``owner`` now, or queue it.
+
+        Returns ``None`` once placed, else the 1-based queue position. Nobody
+        skips the queue while it is non-empty, even if they would fit. Raises
+        :class:`~utils.scheduler.NoNodeFits` for a demand no node could ever
+        hold, rather than queueing it.
+        """
+        scheduler = AsyncScheduler(self._store)
+        scheduler.check_fits(owner, cpu, memory)
+        if not await self._store.zcard(QUEUE_KEY):
+            try:
+                await scheduler.place(owner, cpu, memory)
+                return None
+            except IOError:
+                pass
+        return await self.push(owner, {**request, "cpu": cpu, "memory": memory})
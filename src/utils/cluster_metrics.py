@@ -0,0 +1,134 @@
+from typing import Iterator
+from collections import Counter
+from prometheus_client.core import GaugeMetricFamily, HistogramMetricFamily, Metric
+from redis import Redis
+from utils.admission import AdmissionQueue
+from utils.events import StatusHub
+from utils.ports import PortAllocator
+from utils.queues import queue_stats
+from utils.scheduler import Scheduler
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def owner_kind(owner: str) -> str:
+    """``challenge``, ``warm`` or ``player``, after the owner a placement is kept under."""
+    kind, _, _ = owner.partition(":")
+    return kind if kind in ("warm", "player") else "challenge"
+
+
+class ClusterCollector:
+    """Gauges read from Redis and the broker when /metrics is scraped.
+
+    Port pool, node reservations, instances, the admission queue and the
+    Celery queues are shared by every process, so only the API exports them
+    rather than every worker repeating the same series. A part that cannot
+    be read is left out of the scrape instead of failing it.
+    """
+
+    def __init__(self, store: Redis, broker: Redis):
+        self._store = store
+        self._broker = broker
+
+    def describe(self) -> list:
+        # Without this, registering calls collect() to learn the names, so
+        # importing the app would already query Redis and the broker.
+        return []
+
+    def collect(self) -> Iterator[Metric]:
+        for part in (self._ports, self._nodes, self._admission, self._queues):
+            try:
+                yield from part()
+            except Exception as e:
+                log.warning(f"Cannot collect {part.__name__[1:]} metrics: {e}")
+        subscribers = GaugeMetricFamily(
+            "instance_manager_event_stream_subscribers",
+            "Open status event streams of this API process",
+        )
+        subscribers.add_metric([], StatusHub.subscribers())
+        yield subscribers
+
+    def _ports(self) -> Iterator[Metric]:
+        stats = PortAllocator(self._store).stats()
+        ports = GaugeMetricFamily(
+            "instance_manager_port_pool_ports",
+            "Host ports of the pool, free or in use",
+            labels=["state"],
+        )
+        ports.add_metric(["free"], stats["free"])
+        ports.add_metric(["used"], stats["used"])
+        yield ports
+        leases = GaugeMetricFamily(
+            "instance_manager_port_leases",
+            "Port reservations held, pending ones included",
+            labels=["state"],
+        )
+        leases.add_metric(["pending"], stats["pending_leases"])
+        leases.add_metric(["committed"], stats["leases"] - stats["pending_leases"])
+        yield leases
+
+    def _nodes(self) -> Iterator[Metric]:
+        scheduler = Scheduler(self._store)
+        capacity = GaugeMetricFamily(
+            "instance_manager_node_capacity",
+            "Capacity of a node; 0 means unbounded",
+            labels=["node", "resource"],
+        )
+        reserved = GaugeMetricFamily(
+            "instance_manager_node_reserved",
+            "Capacity reserved by the instances placed on a node",
+            labels=["node", "resource"],
+        )
+        for node in scheduler.usage():
+            for resource, unit in (("cpu", "millicores"), ("memory", "bytes")):
+                capacity.add_metric([node["name"], f"{resource}_{unit}"], node[resource])
+                reserved.add_metric(
+                    [node["name"], f"{resource}_{unit}"], node[f"reserved_{resource}"]
+                )
+        yield capacity
+        yield reserved
+        counts = Counter(
+            (placed["node"], owner_kind(owner))
+            for owner, placed in scheduler.placements().items()
+        )
+        instances = GaugeMetricFamily(
+            "instance_manager_instances",
+            "Instances holding capacity on a node, starting ones included",
+            labels=["node", "kind"],
+        )
+        for (node, kind), count in sorted(counts.items()):
+            instances.add_metric([node, kind], count)
+        yield instances
+
+    def _admission(self) -> Iterator[Metric]:
+        queued = GaugeMetricFamily(
+            "instance_manager_admission_queue_length",
+            "Starts waiting for a node to have room for them",
+        )
+        queued.add_metric([], AdmissionQueue(self._store).length())
+        yield queued
+
+    def _queues(self) -> Iterator[Metric]:
+        depth = GaugeMetricFamily(
+            "instance_manager_celery_queue_depth",
+            "Tasks waiting in a Celery queue",
+            labels=["queue"],
+        )
+        wait = HistogramMetricFamily(
+            "instance_manager_celery_queue_wait_seconds",
+            "Time tasks spent in a Celery queue before a worker started them",
+            labels=["queue"],
+        )
+        for stats in queue_stats(self._store, self._broker):
+            depth.add_metric([stats["queue"]], stats["depth"])
+            wait.add_metric(
+                [stats["queue"]],
+                [
+                    ("+Inf" if bound == "inf" else bound, count)
+                    for bound, count in stats["wait_buckets"].items()
+                ],
+                sum_value=stats["wait_sum"],
+            )
+        yield depth
+        yield wait
@@ -1,23 +1,156 @@
 from docker import DockerClient
+from docker.errors import ImageNotFound
+from docker.utils import parse_repository_tag
 from config import config
+from utils.metrics import instrument_docker
+from collections import OrderedDict
+from hashlib import sha256
+import threading
+import time
+
+# Every container and network of an instance carries these labels.
+LABEL_INSTANCE = "instance-manager.instance"
+LABEL_CHALLENGE = "instance-manager.challenge"
+LABEL_SERVICE = "instance-manager.service"
+
+
+def instance_labels(instance: str, chall_id=None, service: str = None) -> dict:
+    labels = {LABEL_INSTANCE: instance}
+    if chall_id is not None:
+        labels[LABEL_CHALLENGE] = str(chall_id)
+    if service is not None:
+        labels[LABEL_SERVICE] = service
+    return labels
+
+
+class DockerClientPool:
+    """Process-wide Docker clients, one per daemon and registry identity.
+
+    Clients keep their HTTP connections to the daemon alive across tasks and
+    requests, log in to the registry once, and only ping the daemon when the
+    last successful check is older than ``DOCKER.HEALTH_INTERVAL``. After a
+    failed ping, callers fail fast until an exponential backoff has passed.
+    At most ``DOCKER.MAX_CLIENTS`` clients are kept; the least recently used
+    one is closed to make room. Every call a client makes is timed into
+    :mod:`utils.metrics`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()
+        self._checked_at = {}
+        self._failures = {}
+        self._retry_at = {}
+
+    def reset(self):
+        with self._lock:
+            for client in self._clients.values():
+                try:
+                    client.close()
+                except:
+                    pass
+            self._clients = OrderedDict()
+            self._checked_at = {}
+            self._failures = {}
+            self._retry_at = {}
+
+    def get(
+        self, username: str = "", password: str = "", base_url: str = None
+    ) -> DockerClient:
+        base_url = base_url or config["DOCKER"]["HOST"]
+        registry = config["DOCKER"]["REGISTRY"]
+        key = (
+            base_url,
+            registry if username and password else "",
+            username or "",
+            sha256((password or "").encode()).hexdigest(),
+        )
+        evicted = []
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = DockerClient(
+                    base_url=base_url,
+                    max_pool_size=int(config["DOCKER"]["POOL_SIZE"]),
+                )
+                instrument_docker(client)
+                if registry and username and password:
+                    client.login(
+                        username=username,
+                        password=password,
+                        registry=registry,
+                    )
+                self._clients[key] = client
+                while len(self._clients) > int(config["DOCKER"]["MAX_CLIENTS"]):
+                    old_key, old_client = self._clients.popitem(last=False)
+                    self._forget(old_key)
+                    evicted.append(old_client)
+            else:
+                self._clients.move_to_end(key)
+        for old_client in evicted:
+            try:
+                old_client.close()
+            except:
+                pass
+        self._check(key, client)
+        return client
+
+    def _forget(self, key):
+        self._checked_at.pop(key, None)
+        self._failures.pop(key, None)
+        self._retry_at.pop(key, None)
+
+    def _check(self, key, client: DockerClient):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at.get(key, 0) < int(
+                config["DOCKER"]["HEALTH_INTERVAL"]
+            ):
+                return
+            if now < self._retry_at.get(key, 0):
+                raise Exception("Failed to connect to docker")
+        # Ping without the lock so a slow daemon does not hold up the others.
+        try:
+            healthy = bool(client.ping())
+        except Exception:
+            healthy = False
+        with self._lock:
+            if healthy:
+                self._failures.pop(key, None)
+                self._retry_at.pop(key, None)
+                self._checked_at[key] = now
+            else:
+                failures = self._failures.get(key, 0) + 1
+                self._failures[key] = failures
+                self._retry_at[key] = now + min(2**failures, 60)
+        if not healthy:
+            raise Exception("Failed to connect to docker")
+
+
+client_pool = DockerClientPool()
+
+
+def init_client_pool(**kwargs):
+    """Drop clients inherited from a parent process and warm a fresh one."""
+    client_pool.reset()
+    try:
+        client_pool.get(config["DOCKER"]["USERNAME"], config["DOCKER"]["PASSWORD"])
+    except Exception as e:
+        print(f"Docker client pool not ready: {e}")
 
 
 class DockerHandler:
-    def __init__(self, creds: dict = None):
-        self._client = DockerClient(base_url=config["DOCKER"]["HOST"])
+    """Operations against one Docker daemon: ``node`` or ``DOCKER.HOST``."""
+
+    def __init__(self, creds: dict = None, node=None):
         creds = creds or {}
+        self.node = node
         self._registry = config["DOCKER"]["REGISTRY"]
         self._username = creds.get("username", config["DOCKER"]["USERNAME"])
         self._password = creds.get("password", config["DOCKER"]["PASSWORD"])
-
-        if config["DOCKER"]["REGISTRY"] and self._username and self._password:
-            self._client.login(
-                username=self._username,
-                password=self._password,
-                registry=self._registry,
-            )
-        if not self._client.ping():
-            raise Exception("Failed to connect to docker")
+        self._client = client_pool.get(
+            self._username, self._password, node.url if node else None
+        )
 
     def verify_image(self, image_name: str):
         # First check if image exists locally
@@ -43,32 +176,29 @@ class DockerHandler:
         except:
             return False
 
-    def remove_challenge(self, name: str):
-        try:
-            self._client.networks.get(name).remove()
-        except:
-            pass
-        try:
-            self._client.containers.prune()
-        except:
-            pass
-
     def create_container(self, image_name: str, **kwargs):
-        container = self._client.containers.create(image_name, **kwargs)
-        return container
-
-    def pull_image(self, image_name: str):
         try:
-            if ":" in image_name:
-                image_name, tag = image_name.split(":")
-            self._client.images.pull(image_name, tag=tag)
-            return True
-        except:
-            return False
+            return self._client.containers.create(image_name, **kwargs)
+        except ImageNotFound:
+            # Images are pulled ahead of time on the default node only; other
+            # nodes fetch them the first time an instance lands there.
+            self.pull_image(image_name)
+            return self._client.containers.create(image_name, **kwargs)
+
+    def pull_image(self, image_name: str, progress=None):
+        repository, tag = parse_repository_tag(image_name)
+        for event in self._client.api.pull(
+            repository, tag=tag or "latest", stream=True, decode=True
+        ):
+            if "error" in event:
+                raise Exception(event["error"])
+            if progress:
+                progress(event)
+        return True
 
-    def create_challenge_network(self, name: str):
+    def create_challenge_network(self, name: str, labels: dict = None):
         try:
-            return self._client.networks.create(name)
+            return self._client.networks.create(name, labels=labels)
         except:
             return None
 
@@ -86,6 +216,48 @@ class DockerHandler:
         except:
             return None
 
+    def instance_containers(self, instance: str):
+        """Every container of ``instance``, running or not, in one call.
+
+        ``sparse`` skips the per-container inspect ``list`` otherwise does.
+        """
+        return self._client.containers.list(
+            all=True, sparse=True, filters={"label": f"{LABEL_INSTANCE}={instance}"}
+        )
+
+    def managed_containers(self):
+        """Every container any instance owns, in one sparse call.
+
+        Sparse entries carry ``Labels`` and ``State`` at the top of ``attrs``.
+        """
+        return self._client.containers.list(
+            all=True, sparse=True, filters={"label": LABEL_INSTANCE}
+        )
+
+    def managed_networks(self):
+        return self._client.networks.list(filters={"label": LABEL_INSTANCE})
+
+    def instance_networks(self, instance: str):
+        return self._client.networks.list(
+            filters={"label": f"{LABEL_INSTANCE}={instance}"}
+        )
+
+    def get_network(self, network_name):
+        try:
+            return self._client.networks.get(network_name)
+        except:
+            return None
+
+    def published_ports(self):
+        # Sparse listings come from one /containers/json call instead of an
+        # inspect per container; their "Ports" hold what is published now.
+        ports = set()
+        for container in self._client.containers.list(all=True, sparse=True):
+            for port in container.attrs.get("Ports") or []:
+                if port.get("PublicPort"):
+                    ports.add(int(port["PublicPort"]))
+        return ports
+
     def remove_network(self, network_name):
         try:
             network = self._client.networks.get(network_name)
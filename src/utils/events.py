@@ -0,0 +1,201 @@
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Set, Tuple
+from redis.asyncio import Redis
+from repository import AsyncRedisStorage
+from utils.state import EVENTS_KEY
+from config import config
+import asyncio
+import json
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+Topic = Tuple[str, int]
+
+# Keep proxies from caching or buffering the stream.
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+STREAM_ID = re.compile(r"^(\d+)(?:-(\d+))?$")
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _stream_id(event_id: str) -> Optional[Tuple[int, int]]:
+    """``(milliseconds, sequence)`` of a stream id, ``None`` if it is not one."""
+    match = STREAM_ID.match(event_id or "")
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2) or 0)
+
+
+def parse_event(event_id, fields: dict) -> dict:
+    event = {_decode(k): _decode(v) for k, v in fields.items()}
+    event["event_id"] = _decode(event_id)
+    event["id"] = int(event["id"])
+    if "players" in event:
+        event["players"] = int(event["players"])
+    return event
+
+
+def format_event(data: dict, event_id: str = None) -> str:
+    """One Server-Sent Event named ``status``."""
+    lines = [f"id: {event_id}"] if event_id else []
+    lines += ["event: status", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+class StatusHub:
+    """Fans ``status:events`` out to the event streams of this process.
+
+    A single task per process follows the stream with a blocking ``XREAD``
+    and hands every event to the queues subscribed to its ``(scope, id)``,
+    so Redis sees one reader however many browsers listen. The task starts
+    with the first subscriber and ends after the last one leaves. A
+    subscriber that falls too far behind loses events rather than
+    stalling the others.
+    """
+
+    _subscribers: Dict[Topic, Set[asyncio.Queue]] = {}
+    _task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def subscribe(cls, topic: Topic, after: str = "$") -> asyncio.Queue:
+        """Queue of the events of ``topic``.
+
+        A hub started by this call follows the stream from ``after``, the
+        id the subscriber read before its snapshot; a running hub only hands
+        over events it has not read yet, which all come after that.
+        """
+        queue = asyncio.Queue(maxsize=100)
+        cls._subscribers.setdefault(topic, set()).add(queue)
+        if cls._task is None or cls._task.done():
+            cls._task = asyncio.get_running_loop().create_task(cls._run(after))
+        return queue
+
+    @classmethod
+    def unsubscribe(cls, topic: Topic, queue: asyncio.Queue) -> None:
+        queues = cls._subscribers.get(topic, set())
+        queues.discard(queue)
+        if not queues:
+            cls._subscribers.pop(topic, None)
+
+    @classmethod
+    def subscribers(cls) -> int:
+        return sum(len(x) for x in cls._subscribers.values())
+
+    @classmethod
+    async def _run(cls, last_id: str) -> None:
+        store = AsyncRedisStorage.client()
+        while cls._subscribers:
+            try:
+                replies = await store.xread({EVENTS_KEY: last_id}, count=500, block=5000)
+            except Exception as e:
+                log.warning(f"Status hub lost the event stream: {e}")
+                await asyncio.sleep(1)
+                continue
+            for _, entries in replies or []:
+                for event_id, fields in entries:
+                    last_id = event_id
+                    event = parse_event(event_id, fields)
+                    for queue in cls._subscribers.get((event["scope"], event["id"]), ()):
+                        try:
+                            queue.put_nowait(event)
+                        except asyncio.QueueFull:
+                            pass
+
+
+def strip(event: dict) -> dict:
+    """A stream entry shaped like the status endpoint's response."""
+    data = {k: v for k, v in event.items() if k not in ("event_id", "scope", "state")}
+    if "state" in event:
+        data["status"] = event["state"]
+    return data
+
+
+async def _unchanged(event: dict) -> dict:
+    return event
+
+
+async def stream_head(store: Redis) -> str:
+    """Id of the newest entry of the event stream, ``0-0`` when it is empty."""
+    entries = await store.xrevrange(EVENTS_KEY, count=1)
+    return _decode(entries[0][0]) if entries else "0-0"
+
+
+async def resumable(store: Redis, event_id: str, head: str) -> bool:
+    """Whether the stream still holds everything after ``event_id``.
+
+    Not so for an id that is malformed, older than the first entry
+    ``EVENTS.STREAM_MAXLEN`` kept, or newer than ``head`` (the stream was
+    reset since).
+    """
+    position = _stream_id(event_id)
+    if position is None:
+        return False
+    first = await store.xrange(EVENTS_KEY, count=1)
+    if not first:
+        return False
+    return _stream_id(_decode(first[0][0])) <= position <= _stream_id(head)
+
+
+async def replay(store: Redis, topic: Topic, after: str) -> list:
+    """Events of ``topic`` in the stream after ``after``, oldest first.
+
+    Only what ``EVENTS.STREAM_MAXLEN`` still retains can be replayed.
+    """
+    events = []
+    while True:
+        entries = await store.xrange(EVENTS_KEY, min=f"({after}", max="+", count=500)
+        for event_id, fields in entries:
+            event = parse_event(event_id, fields)
+            if (event["scope"], event["id"]) == topic:
+                events.append(event)
+        if len(entries) < 500:
+            return events
+        after = _decode(entries[-1][0])
+
+
+async def status_events(
+    store: Redis,
+    topic: Topic,
+    snapshot: Callable[[], Awaitable[dict]],
+    last_event_id: str = None,
+    decorate: Callable[[dict], Awaitable[dict]] = None,
+) -> AsyncIterator[str]:
+    """The Server-Sent Events of one instance.
+
+    A new client first gets ``snapshot()``; a client resuming with
+    ``last_event_id`` gets what it missed from the stream instead, or the
+    snapshot too when the stream no longer holds all of it. Then every
+    change is pushed as it happens, with a comment every
+    ``EVENTS.KEEPALIVE`` seconds to keep idle connections open.
+    ``decorate`` may add fields (e.g. a queue position) before sending.
+    """
+    keepalive = float(config["EVENTS"]["KEEPALIVE"])
+    decorate = decorate or _unchanged
+    # Subscribed from the current end of the stream before the snapshot or
+    # the replay, so nothing falls between them and the hub.
+    head = await stream_head(store)
+    queue = StatusHub.subscribe(topic, head)
+    try:
+        sent = None
+        if last_event_id and await resumable(store, last_event_id, head):
+            sent = last_event_id
+            for event in await replay(store, topic, last_event_id):
+                sent = event["event_id"]
+                yield format_event(await decorate(strip(event)), sent)
+        else:
+            yield format_event(await snapshot())
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if sent and _stream_id(event["event_id"]) <= _stream_id(sent):
+                continue
+            yield format_event(await decorate(strip(event)), event["event_id"])
+    finally:
+        StatusHub.unsubscribe(topic, queue)
@@ -0,0 +1,199 @@
+from typing import Callable, List, Optional, Tuple
+from redis import Redis
+from config import config
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+EXPIRY_KEY = "joins:expiry"
+STARTED_KEY = "joins:started"
+
+# KEYS: expiry, started; ARGV: now, limit
+POP_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+    redis.call('HDEL', KEYS[2], unpack(due))
+end
+return due
+"""
+
+# KEYS: expiry, started; ARGV: member, lifetime, max lifetime, now
+# Returns the new deadline as a string (Lua numbers reply as integers) or
+# -1 when the join has no deadline.
+EXTEND_SCRIPT = """
+local deadline = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not deadline then
+    return -1
+end
+local now = tonumber(ARGV[4])
+local started = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or now)
+local extended = math.min(now + tonumber(ARGV[2]), started + tonumber(ARGV[3]))
+if extended > tonumber(deadline) then
+    redis.call('ZADD', KEYS[1], extended, ARGV[1])
+    deadline = extended
+end
+return tostring(deadline)
+"""
+
+
+def lifetimes(challenge) -> Tuple[int, int]:
+    """``(lifetime, max_lifetime)`` of a challenge in seconds."""
+    lifetime = challenge.lifetime or int(config["JOINS"]["LIFETIME"])
+    max_lifetime = challenge.max_lifetime or int(config["JOINS"]["MAX_LIFETIME"])
+    return lifetime, max(lifetime, max_lifetime)
+
+
+class _JoinExpiryBase:
+    """Keys, scripts and replies shared by the sync and async join expiry.
+
+    Deadlines of every join live in the ``joins:expiry`` sorted set:
+    members are ``{challenge_id}:{user_id}`` scored by the epoch second the
+    join ends; ``joins:started`` remembers when each one began so extensions
+    stay within the challenge's maximum lifetime.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._pop_due = store.register_script(POP_DUE_SCRIPT)
+        self._extend = store.register_script(EXTEND_SCRIPT)
+
+    @staticmethod
+    def member(chall_id: int, user_id: str) -> str:
+        return f"{chall_id}:{user_id}"
+
+    @staticmethod
+    def parse(member) -> Tuple[int, str]:
+        if isinstance(member, bytes):
+            member = member.decode()
+        chall_id, user_id = member.split(":", 1)
+        return int(chall_id), user_id
+
+    def _start_pipeline(self, chall_id: int, user_id: str, lifetime: int):
+        now = time.time()
+        member = self.member(chall_id, user_id)
+        pipe = self._store.pipeline(transaction=True)
+        pipe.zadd(EXPIRY_KEY, {member: now + lifetime})
+        pipe.hset(STARTED_KEY, member, now)
+        return pipe
+
+    def _remove_pipeline(self, chall_id: int, user_ids: Tuple[str, ...]):
+        members = [self.member(chall_id, x) for x in user_ids]
+        pipe = self._store.pipeline(transaction=True)
+        if members:
+            pipe.zrem(EXPIRY_KEY, *members)
+            pipe.hdel(STARTED_KEY, *members)
+        return pipe
+
+
+class JoinExpiry(_JoinExpiryBase):
+    """Deadlines as the worker sets them and the reaper pops them."""
+
+    def start(self, chall_id: int, user_id: str, lifetime: int) -> None:
+        self._start_pipeline(chall_id, user_id, lifetime).execute()
+
+    def remove(self, chall_id: int, *user_ids: str) -> None:
+        self._remove_pipeline(chall_id, user_ids).execute()
+
+    def pop_due(self, limit: int = 500) -> List[Tuple[int, str]]:
+        due = self._pop_due(keys=[EXPIRY_KEY, STARTED_KEY], args=[time.time(), limit])
+        return [self.parse(x) for x in due]
+
+    def next_deadline(self) -> Optional[float]:
+        first = self._store.zrange(EXPIRY_KEY, 0, 0, withscores=True)
+        return first[0][1] if first else None
+
+    def postpone(self, due: List[Tuple[int, str]], deadline: float) -> None:
+        """Give popped joins back with a new deadline."""
+        pipe = self._store.pipeline()
+        for chall_id, user_id in due:
+            pipe.zadd(EXPIRY_KEY, {self.member(chall_id, user_id): deadline})
+        pipe.execute()
+
+
+class AsyncJoinExpiry(_JoinExpiryBase):
+    """Deadlines as the API starts, extends and ends joins."""
+
+    async def start(self, chall_id: int, user_id: str, lifetime: int) -> None:
+        await self._start_pipeline(chall_id, user_id, lifetime).execute()
+
+    async def extend(
+        self, chall_id: int, user_id: str, lifetime: int, max_lifetime: int
+    ) -> Optional[float]:
+        """Push the deadline to ``lifetime`` seconds from now, within the max.
+
+        Returns the new deadline, or ``None`` when the join has none.
+        """
+        reply = await self._extend(
+            keys=[EXPIRY_KEY, STARTED_KEY],
+            args=[self.member(chall_id, user_id), lifetime, max_lifetime, time.time()],
+        )
+        if reply == -1:
+            return None
+        return float(reply.decode() if isinstance(reply, bytes) else reply)
+
+    async def remove(self, chall_id: int, *user_ids: str) -> None:
+        await self._remove_pipeline(chall_id, user_ids).execute()
+
+
+class JoinReaper:
+    """Ends joins the moment their deadline passes.
+
+    Runs in a daemon thread: it pops due members, hands them to
+    ``on_expired`` as ``(challenge_id, user_id)`` pairs and then sleeps
+    until the next deadline (at most ``JOINS.REAPER_INTERVAL`` seconds).
+    Whoever holds the cron leader lease starts it and stops it again when
+    the lease is lost, so only one process reaps.
+    """
+
+    def __init__(
+        self, store: Redis, on_expired: Callable[[List[Tuple[int, str]]], None]
+    ):
+        self._expiry = JoinExpiry(store)
+        self._on_expired = on_expired
+        self._interval = float(config["JOINS"]["REAPER_INTERVAL"])
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._thread and self._thread.is_alive() and not self._stop.is_set())
+
+    def start(self) -> None:
+        if self.running:
+            return
+        # A thread still finishing after stop() keeps its own event.
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(self._stop,), name="join-reaper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            try:
+                if self.reap():
+                    continue
+                deadline = self._expiry.next_deadline()
+                wait = self._interval if deadline is None else deadline - time.time()
+                stop.wait(min(max(wait, 0.05), self._interval))
+            except Exception as e:
+                log.warning(f"Join reaper failed: {e}")
+                stop.wait(self._interval)
+
+    def reap(self) -> int:
+        due = self._expiry.pop_due()
+        if not due:
+            return 0
+        try:
+            self._on_expired(due)
+        except Exception:
+            # Give the joins back so the next pass retries them.
+            self._expiry.postpone(due, time.time() + self._interval)
+            raise
+        return len(due)
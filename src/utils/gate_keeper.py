@@ -1,5 +1,6 @@
-from repository import RedisStorage
-from repository.user import UserRepository
+from collections import OrderedDict
+from repository import RedisStorage, AsyncRedisStorage
+from repository.user import AsyncUserRepository
 from repository.schema import User
 from models.user import QueryUserModel
 from fastapi import Depends, HTTPException, Cookie, Request
@@ -11,12 +12,18 @@ from base64 import urlsafe_b64encode, urlsafe_b64decode
 from json import dumps, loads
 from string import ascii_letters, digits
 from random import choices
-from redis import Redis
+from redis import Redis, RedisError
+from redis.asyncio import Redis as AsyncRedis
+from sqlalchemy.orm import make_transient_to_detached
 from config import config
 import logging
+import threading
+import time
 
 log = logging.getLogger(__name__)
 
+INVALIDATE_CHANNEL = "auth:invalidate"
+
 
 class PasswordHandler:
     @staticmethod
@@ -52,40 +59,62 @@ class JWTHandler:
     def verify(self, token: str) -> Tuple[Optional[dict], Exception]:
         _, payload, signature = token.split(".")
         try:
-            payload = loads(Base64.decode(payload))
-            uid = payload.get("uid", None)
-            if not uid:
-                raise Exception("Invalid payload")
-            secret = self._store.get(uid)
-            if not secret:
-                raise Exception("Invalid or expired token")
-            if isinstance(secret, bytes):
-                secret = secret.decode()
-            if signature != self.sign(payload, secret):
-                raise Exception("Invalid signature")
-            return payload, None
+            payload = self.decode(payload)
+            secret = self._store.get(payload["uid"])
+            return self.check(payload, signature, secret), None
         except Exception as e:
             return None, Exception(str(e))
 
     def create(self, payload: dict) -> str:
         try:
-            secret = "".join(choices(ascii_letters + digits, k=64))
-            uid = payload.get("uid", None)
-            if not uid:
-                raise Exception("Invalid payload")
+            secret = self.new_secret()
+            uid = self.decode_uid(payload)
             self._store.set(uid, secret, ex=config["JWT_EXPIRATION"])
-            return ".".join(
-                [
-                    Base64.encode(dumps({"alg": "HS256", "typ": "JWT"})),
-                    Base64.encode(dumps(payload)),
-                    self.sign(payload, secret),
-                ]
-            )
+            UserCache.publish(self._store, uid)
+            return self.encode(payload, secret)
         except Exception as e:
             return None
 
     def revoke(self, uid: str) -> None:
         self._store.delete(uid)
+        UserCache.publish(self._store, uid)
+
+    @staticmethod
+    def decode(payload: str) -> dict:
+        payload = loads(Base64.decode(payload))
+        JWTHandler.decode_uid(payload)
+        return payload
+
+    @staticmethod
+    def decode_uid(payload: dict) -> str:
+        uid = payload.get("uid", None)
+        if not uid:
+            raise Exception("Invalid payload")
+        return uid
+
+    @staticmethod
+    def check(payload: dict, signature: str, secret) -> dict:
+        if not secret:
+            raise Exception("Invalid or expired token")
+        if isinstance(secret, bytes):
+            secret = secret.decode()
+        if signature != JWTHandler.sign(payload, secret):
+            raise Exception("Invalid signature")
+        return payload
+
+    @staticmethod
+    def new_secret() -> str:
+        return "".join(choices(ascii_letters + digits, k=64))
+
+    @staticmethod
+    def encode(payload: dict, secret: str) -> str:
+        return ".".join(
+            [
+                Base64.encode(dumps({"alg": "HS256", "typ": "JWT"})),
+                Base64.encode(dumps(payload)),
+                JWTHandler.sign(payload, secret),
+            ]
+        )
 
     @staticmethod
     def sign(payload: dict, secret: str) -> str:
@@ -93,22 +122,167 @@ class JWTHandler:
         return Base64.encode(new(secret.encode(), payload.encode(), sha256).hexdigest())
 
 
+class AsyncJWTHandler(JWTHandler):
+    """:class:`JWTHandler` backed by ``redis.asyncio`` for the API."""
+
+    def __init__(self, store: AsyncRedis = Depends(AsyncRedisStorage.get)):
+        self._store = store
+
+    async def verify(self, token: str) -> Tuple[Optional[dict], Exception]:
+        _, payload, signature = token.split(".")
+        try:
+            payload = self.decode(payload)
+            secret = await self._store.get(payload["uid"])
+            return self.check(payload, signature, secret), None
+        except Exception as e:
+            return None, Exception(str(e))
+
+    async def create(self, payload: dict) -> str:
+        try:
+            secret = self.new_secret()
+            uid = self.decode_uid(payload)
+            await self._store.set(uid, secret, ex=config["JWT_EXPIRATION"])
+            await UserCache.publish_async(self._store, uid)
+            return self.encode(payload, secret)
+        except Exception as e:
+            return None
+
+    async def revoke(self, uid: str) -> None:
+        await self._store.delete(uid)
+        await UserCache.publish_async(self._store, uid)
+
+
+class UserCache:
+    """Resolved users keyed by uid and token signature, per process.
+
+    Entries hold the user's column values and live for ``CACHE.USER_TTL``
+    seconds in a bounded LRU. Logout, a new login and admin edits publish
+    the uid on ``auth:invalidate``; every process drops that user's entries
+    when the message arrives. Until the subscriber is connected, and after
+    it loses the connection, lookups bypass the cache.
+    """
+
+    _entries = OrderedDict()
+    _lock = threading.Lock()
+    _stats = {"hits": 0, "misses": 0, "invalidations": 0}
+    _listening = threading.Event()
+    _listener = None
+
+    @staticmethod
+    def key(token: str) -> Optional[str]:
+        try:
+            _, payload, signature = token.split(".")
+            uid = loads(Base64.decode(payload)).get("uid")
+        except Exception:
+            return None
+        return f"{uid}:{signature}" if uid else None
+
+    @classmethod
+    def get(cls, key: str) -> Optional[User]:
+        if not cls._listening.is_set():
+            return None
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if not entry or entry[0] < time.monotonic():
+                cls._stats["misses"] += 1
+                return None
+            cls._entries.move_to_end(key)
+            cls._stats["hits"] += 1
+        user = User(**entry[1])
+        make_transient_to_detached(user)
+        return user
+
+    @classmethod
+    def put(cls, key: str, user: User) -> None:
+        if not cls._listening.is_set():
+            return
+        fields = {x.key: getattr(user, x.key) for x in User.__table__.columns}
+        expires = time.monotonic() + float(config["CACHE"]["USER_TTL"])
+        with cls._lock:
+            cls._entries[key] = (expires, fields)
+            cls._entries.move_to_end(key)
+            while len(cls._entries) > int(config["CACHE"]["USER_SIZE"]):
+                cls._entries.popitem(last=False)
+
+    @classmethod
+    def invalidate(cls, uid: str = None) -> None:
+        with cls._lock:
+            if uid is None:
+                cls._entries.clear()
+            else:
+                for key in [x for x in cls._entries if x.startswith(f"{uid}:")]:
+                    del cls._entries[key]
+            cls._stats["invalidations"] += 1
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls._lock:
+            stats = dict(cls._stats, size=len(cls._entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else None
+        return stats
+
+    @staticmethod
+    def publish(store: Redis, uid: str) -> None:
+        UserCache.invalidate(uid)
+        try:
+            store.publish(INVALIDATE_CHANNEL, uid)
+        except RedisError as e:
+            log.warning(f"Failed to publish user invalidation: {e}")
+
+    @staticmethod
+    async def publish_async(store: AsyncRedis, uid: str) -> None:
+        UserCache.invalidate(uid)
+        try:
+            await store.publish(INVALIDATE_CHANNEL, uid)
+        except RedisError as e:
+            log.warning(f"Failed to publish user invalidation: {e}")
+
+    @classmethod
+    def start_listener(cls) -> None:
+        if cls._listener and cls._listener.is_alive():
+            return
+        cls._listener = threading.Thread(
+            target=cls._listen, name="user-cache-listener", daemon=True
+        )
+        cls._listener.start()
+
+    @classmethod
+    def _listen(cls) -> None:
+        while True:
+            try:
+                pubsub = next(RedisStorage.get()).pubsub(
+                    ignore_subscribe_messages=True
+                )
+                pubsub.subscribe(INVALIDATE_CHANNEL)
+                # Messages may have been missed while disconnected.
+                cls.invalidate()
+                cls._listening.set()
+                for message in pubsub.listen():
+                    uid = message["data"]
+                    cls.invalidate(uid.decode() if isinstance(uid, bytes) else uid)
+            except Exception as e:
+                log.warning(f"User cache listener disconnected: {e}")
+            cls._listening.clear()
+            cls.invalidate()
+            time.sleep(1)
+
+
 def get_cookie_token(
     token: Annotated[Union[None, str], Cookie(alias="auth")] = None
 ) -> Optional[str]:
     return token
 
 
-def auth(
+async def auth(
     request: Request,
     *,
     strict: bool = False,
-    jwt_handler: JWTHandler = Depends(JWTHandler),
-    user_repo: UserRepository = Depends(UserRepository),
+    jwt_handler: AsyncJWTHandler = Depends(AsyncJWTHandler),
+    user_repo: AsyncUserRepository = Depends(AsyncUserRepository),
     token: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False)),
     cookie_token: str = Depends(get_cookie_token),
 ):
-    log.debug(f"{request.headers}")
     cred = None
     if not token:
         cred = cookie_token
@@ -121,18 +295,22 @@ def auth(
     try:
         if cred == config["BOT_TOKEN"]:
             return User(id="bot", email="bot@game")
-        payload, _ = jwt_handler.verify(cred)
+        cache_key = UserCache.key(cred)
+        cached = UserCache.get(cache_key) if cache_key else None
+        if cached:
+            return cached
+        payload, _ = await jwt_handler.verify(cred)
         if not payload:
             return None
-        exist_user = user_repo.find_one(
+        exist_user = await user_repo.find_one(
             query=QueryUserModel(id=payload.get("uid", None))
         )
         if strict and not exist_user:
             raise Exception("Please login first")
+        if exist_user:
+            UserCache.put(cache_key, exist_user)
         log.debug(
-            "request from user: {}".format(
-                exist_user.display_name if exist_user else "Guest"
-            )
+            "request from user: %s", exist_user.display_name if exist_user else "Guest"
         )
         return exist_user
     except Exception as e:
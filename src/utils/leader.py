@@ -0,0 +1,68 @@
+from functools import wraps
+from redis import Redis, RedisError
+from uuid import uuid4
+import logging
+
+log = logging.getLogger(__name__)
+
+# KEYS: lease; ARGV: token, ttl in ms
+ACQUIRE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+# KEYS: lease; ARGV: token
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderLease:
+    """A renewable Redis lease naming the one process allowed to act.
+
+    Whoever holds the lease keeps it by renewing before ``ttl`` seconds run
+    out; if it dies, another process takes over once the lease expires.
+    """
+
+    def __init__(self, store: Redis, name: str, ttl: int):
+        self._store = store
+        self._key = f"leader:{name}"
+        self._ttl_ms = int(ttl * 1000)
+        self._token = uuid4().hex
+        self._acquire = store.register_script(ACQUIRE_SCRIPT)
+        self._release = store.register_script(RELEASE_SCRIPT)
+
+    def acquire(self) -> bool:
+        """Take or renew the lease; ``True`` while this process holds it."""
+        try:
+            return self._acquire(keys=[self._key], args=[self._token, self._ttl_ms]) == 1
+        except RedisError as e:
+            log.warning(f"Failed to renew {self._key}: {e}")
+            return False
+
+    def release(self) -> None:
+        try:
+            self._release(keys=[self._key], args=[self._token])
+        except RedisError:
+            pass
+
+    def only(self, fn):
+        """Run ``fn`` only in the process currently holding the lease."""
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.acquire():
+                log.debug(f"Skipping {fn.__name__}: not the leader")
+                return None
+            return fn(*args, **kwargs)
+
+        return wrapper
@@ -0,0 +1,105 @@
+from typing import Optional, Union
+from config import config
+
+# KEYS: start lock, delete lock; ARGV: task id, lease
+# Returns the task now holding the start lock, or nil while a delete runs.
+ACQUIRE_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return false
+end
+redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2])
+return redis.call('GET', KEYS[1])
+"""
+
+# KEYS: start lock; ARGV: task id, lease
+CLAIM_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+# KEYS: start lock; ARGV: task id
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class _StartLockBase:
+    """Keys and scripts shared by the sync and async start locks.
+
+    ``start:{owner}`` names the one task allowed to start an instance. The
+    API takes the lock with the id of the task it is about to publish, so
+    concurrent requests find that id and follow the same job instead of
+    publishing their own. The worker then claims the lock for its task id
+    and skips the start when another task holds it. The lock expires after
+    ``LOCKS.START_LEASE`` seconds in case nobody releases it. Owners are a
+    challenge id or ``player:{id}``.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._lease = int(config["LOCKS"]["START_LEASE"])
+        self._acquire = store.register_script(ACQUIRE_SCRIPT)
+        self._claim = store.register_script(CLAIM_SCRIPT)
+        self._release = store.register_script(RELEASE_SCRIPT)
+
+    @staticmethod
+    def key(owner: Union[int, str]) -> str:
+        return f"start:{owner}"
+
+    @staticmethod
+    def delete_key(owner: Union[int, str]) -> str:
+        return f"delete:{owner}"
+
+    def _acquire_call(self, owner: Union[int, str], task_id: str) -> dict:
+        return dict(
+            keys=[self.key(owner), self.delete_key(owner)], args=[task_id, self._lease]
+        )
+
+    def _claim_call(self, owner: Union[int, str], task_id: str) -> dict:
+        return dict(keys=[self.key(owner)], args=[task_id, self._lease])
+
+    def _release_call(self, owner: Union[int, str], task_id: str) -> dict:
+        return dict(keys=[self.key(owner)], args=[task_id])
+
+
+class StartLock(_StartLockBase):
+    """The start lock over a synchronous client."""
+
+    def acquire(self, owner: Union[int, str], task_id: str) -> Optional[str]:
+        """The task holding the lock after trying to take it for ``task_id``.
+
+        ``None`` means a delete is running and nothing may start.
+        """
+        return _decode(self._acquire(**self._acquire_call(owner, task_id)))
+
+    def claim(self, owner: Union[int, str], task_id: str) -> bool:
+        """Hold the lock for ``task_id`` unless another task holds it."""
+        return bool(self._claim(**self._claim_call(owner, task_id)))
+
+    def holder(self, owner: Union[int, str]) -> Optional[str]:
+        return _decode(self._store.get(self.key(owner)))
+
+    def release(self, owner: Union[int, str], task_id: str) -> bool:
+        """Drop the lock if ``task_id`` still holds it."""
+        return bool(self._release(**self._release_call(owner, task_id)))
+
+
+class AsyncStartLock(_StartLockBase):
+    """The API's side of :class:`StartLock`: take it, or give it back."""
+
+    async def acquire(self, owner: Union[int, str], task_id: str) -> Optional[str]:
+        return _decode(await self._acquire(**self._acquire_call(owner, task_id)))
+
+    async def release(self, owner: Union[int, str], task_id: str) -> bool:
+        return bool(await self._release(**self._release_call(owner, task_id)))
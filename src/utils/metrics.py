@@ -0,0 +1,175 @@
+from typing import Callable, Optional
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    multiprocess,
+    start_http_server,
+)
+from urllib.parse import urlsplit
+import logging
+import os
+import re
+import shutil
+import time
+
+log = logging.getLogger(__name__)
+
+# Set for services running several processes (prefork Celery workers, the
+# API under several uvicorn workers): each process then writes its samples
+# to files in this directory and /metrics adds them up.
+MULTIPROC_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+# Docker calls and instance lifecycles take from milliseconds to minutes.
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "instance_manager_http_request_seconds",
+    "Time until the API starts answering a request, by route template",
+    ["method", "route", "status"],
+)
+START_SECONDS = Histogram(
+    "instance_manager_start_seconds",
+    "Duration of start tasks",
+    ["kind", "outcome"],
+    buckets=DURATION_BUCKETS,
+)
+START_PHASE_SECONDS = Histogram(
+    "instance_manager_start_phase_seconds",
+    "Duration of every phase of a start task",
+    ["kind", "phase"],
+    buckets=DURATION_BUCKETS,
+)
+TEARDOWN_SECONDS = Histogram(
+    "instance_manager_teardown_seconds",
+    "Duration of teardown tasks",
+    ["kind", "outcome"],
+    buckets=DURATION_BUCKETS,
+)
+DOCKER_CALL_SECONDS = Histogram(
+    "instance_manager_docker_call_seconds",
+    "Latency of Docker Engine API calls until the response headers",
+    ["operation"],
+    buckets=DURATION_BUCKETS,
+)
+DOCKER_ERRORS = Counter(
+    "instance_manager_docker_errors",
+    "Docker Engine API calls answered with an error or never answered",
+    ["operation", "status"],
+)
+
+
+class PhaseTimer:
+    """Times consecutive phases of one start task.
+
+    Call it with the name of each phase as it begins, the way
+    ``spawn_instance`` reports them; the previous phase is observed then.
+    ``done`` observes the last phase and the whole task.
+    """
+
+    def __init__(self, kind: str, on_phase: Callable[[str], None] = None):
+        self._kind = kind
+        self._on_phase = on_phase or (lambda phase: None)
+        self._started = time.monotonic()
+        self._phase: Optional[str] = None
+        self._phase_started = self._started
+
+    def __call__(self, phase: str) -> None:
+        self._close_phase()
+        self._phase, self._phase_started = phase, time.monotonic()
+        self._on_phase(phase)
+
+    def _close_phase(self) -> None:
+        if self._phase:
+            START_PHASE_SECONDS.labels(self._kind, self._phase).observe(
+                time.monotonic() - self._phase_started
+            )
+        self._phase = None
+
+    def done(self, outcome: str) -> None:
+        self._close_phase()
+        START_SECONDS.labels(self._kind, outcome).observe(
+            time.monotonic() - self._started
+        )
+
+
+def observe_teardown(kind: str, outcome: str, started: float) -> None:
+    """Observe a teardown that began at ``time.monotonic()`` ``started``."""
+    TEARDOWN_SECONDS.labels(kind, outcome).observe(time.monotonic() - started)
+
+
+def docker_operation(method: str, url: str) -> str:
+    """``POST /containers/{id}/start`` for a Docker API call.
+
+    Names and ids become ``{id}``, so the label stays bounded.
+    """
+    path = re.sub(r"^/v[0-9.]+/", "/", urlsplit(url).path).strip("/")
+    parts = path.split("/")
+    if len(parts) == 1:
+        name = parts[0]
+    elif parts[1] in ("create", "json", "prune", "load", "search"):
+        name = f"{parts[0]}/{parts[1]}"
+    elif len(parts) > 2 and re.fullmatch(r"[a-z]+", parts[-1]):
+        # Image names may contain slashes: the action is always last.
+        name = f"{parts[0]}/{{id}}/{parts[-1]}"
+    else:
+        name = f"{parts[0]}/{{id}}"
+    return f"{method.upper()} /{name}"
+
+
+def instrument_docker(client) -> None:
+    """Time every call ``client`` (a ``DockerClient``) makes to its daemon.
+
+    Containers and networks it returns share its API client, so their own
+    calls (``container.start()``...) are timed as well.
+    """
+    api = client.api
+    request = api.request
+
+    def timed_request(method, url, *args, **kwargs):
+        operation = docker_operation(method, url)
+        started = time.monotonic()
+        try:
+            response = request(method, url, *args, **kwargs)
+        except Exception:
+            DOCKER_ERRORS.labels(operation, "connection").inc()
+            raise
+        finally:
+            DOCKER_CALL_SECONDS.labels(operation).observe(time.monotonic() - started)
+        if response.status_code >= 400:
+            DOCKER_ERRORS.labels(operation, str(response.status_code)).inc()
+        return response
+
+    api.request = timed_request
+
+
+def registry() -> CollectorRegistry:
+    """The metrics of every process of this service, or of this process alone."""
+    if not os.getenv(MULTIPROC_ENV):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def reset_multiprocess_dir() -> None:
+    """Forget samples of a previous run; call before any process records one."""
+    path = os.getenv(MULTIPROC_ENV)
+    if not path:
+        return
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def process_exited(pid: int) -> None:
+    if os.getenv(MULTIPROC_ENV):
+        multiprocess.mark_process_dead(pid)
+
+
+def serve(port: int) -> None:
+    """Serve /metrics on ``port`` from a background thread."""
+    try:
+        start_http_server(port, registry=registry())
+    except OSError as e:
+        log.warning(f"Cannot serve metrics on port {port}: {e}")
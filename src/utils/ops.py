@@ -1,13 +1,48 @@
 from base64 import b64decode
+from typing import Dict, List
 from models.challenge import ChallengeConfig
 from .docker import DockerHandler
+from .pull import PullEngine
+from redis import Redis
 from yaml import safe_load
 
 
+def service_waves(services: list, depends_on: Dict[str, List[str]]) -> List[list]:
+    """Group services into start waves.
+
+    Every service of a wave only depends on services of earlier waves, so the
+    members of one wave can be brought up concurrently.
+    """
+    names = {x.name for x in services}
+    pending = {}
+    for service in services:
+        deps = set(depends_on.get(service.name) or [])
+        unknown = deps - names
+        if unknown:
+            raise Exception(
+                f"Service {service.name} depends on unknown services: {sorted(unknown)}"
+            )
+        pending[service.name] = deps
+    waves = []
+    while pending:
+        wave = [x for x in services if x.name in pending and not pending[x.name]]
+        if not wave:
+            raise Exception(f"Circular dependency between services: {sorted(pending)}")
+        for service in wave:
+            pending.pop(service.name)
+        for deps in pending.values():
+            deps.difference_update(x.name for x in wave)
+        waves.append(wave)
+    return waves
+
+
 class ChallOpsHandler:
     def __init__(self, enc_config: str, creds: dict = None):
         self.raw_cfg = b64decode(enc_config.encode()).decode("utf-8")
         self.cfg = ChallengeConfig.model_validate(safe_load(self.raw_cfg))
+        service_waves(
+            self.cfg.services, {x.name: x.depends_on for x in self.cfg.services}
+        )
         self._docker = DockerHandler(creds)
 
     def verify_images(self):
@@ -15,10 +50,8 @@ class ChallOpsHandler:
             if not self._docker.verify_image(ser.image):
                 raise Exception(f"Image {ser.image} not found")
 
-    def pull_images(self):
-        for ser in self.cfg.services:
-            if not self._docker.pull_image(ser.image):
-                raise Exception(f"Failed to pull image {ser.image}")
+    def pull_images(self, store: Redis):
+        PullEngine(self._docker, store).pull(self.images)
 
     @property
     def config(self):
@@ -0,0 +1,280 @@
+from typing import Iterable, List, Union
+from config import config
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+FREE_PORTS_KEY = "ports:free"
+SEEDED_KEY = "ports:seeded"
+REBUILD_LOCK_KEY = "ports:rebuild"
+LEASES_KEY = "ports:leases"
+LEASE_KEY_PREFIX = "ports:lease:"
+# Every port held by any lease, so a rebuild can leave them out atomically.
+LEASED_PORTS_KEY = "ports:leased"
+
+# Expired leases a reservation reclaims at most, oldest first.
+RECLAIM_BATCH = 100
+
+# KEYS: free set, lease set, leases zset, seeded flag, leased ports, then
+#       the lease sets of the owners in ARGV[7..]
+# ARGV: count, owner, deadline, now, min port, max port, owners the caller
+#       found expired...
+# Expired leases give their ports back first; a lease committed since the
+# caller looked is left alone. Returns the reserved ports, -1 if the owner
+# already holds a lease or -2 if the pool cannot cover the whole request.
+RESERVE_SCRIPT = """
+local due = {}
+for _, owner in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[4])) do
+    due[owner] = true
+end
+for i = 6, #KEYS do
+    local owner = ARGV[i + 1]
+    if due[owner] then
+        local ports = redis.call('SMEMBERS', KEYS[i])
+        if #ports > 0 then
+            redis.call('SADD', KEYS[1], unpack(ports))
+            redis.call('SREM', KEYS[5], unpack(ports))
+        end
+        redis.call('DEL', KEYS[i])
+        redis.call('ZREM', KEYS[3], owner)
+    end
+end
+if redis.call('SETNX', KEYS[4], 1) == 1 then
+    for port = tonumber(ARGV[5]), tonumber(ARGV[6]) - 1 do
+        redis.call('SADD', KEYS[1], port)
+    end
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return -1
+end
+local count = tonumber(ARGV[1])
+if redis.call('SCARD', KEYS[1]) < count then
+    return -2
+end
+local ports = redis.call('SPOP', KEYS[1], count)
+redis.call('SADD', KEYS[2], unpack(ports))
+redis.call('SADD', KEYS[5], unpack(ports))
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[2])
+return ports
+"""
+
+# KEYS: free set, lease set, leases zset, leased ports
+# ARGV: owner
+RELEASE_SCRIPT = """
+local ports = redis.call('SMEMBERS', KEYS[2])
+if #ports > 0 then
+    redis.call('SADD', KEYS[1], unpack(ports))
+    redis.call('SREM', KEYS[4], unpack(ports))
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return #ports
+"""
+
+# KEYS: old lease set, new lease set, leases zset
+# ARGV: old owner, new owner
+TRANSFER_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return -1
+end
+local score = redis.call('ZSCORE', KEYS[3], ARGV[1])
+if not score then
+    return 0
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZADD', KEYS[3], score, ARGV[2])
+return 1
+"""
+
+# KEYS: free set, seeded flag, leased ports
+# ARGV: min port, max port, ports Docker has published...
+# Leased ports are read inside the script: a reservation made while the
+# caller listed Docker's ports belongs to a container that does not exist
+# yet, and must not be handed out again.
+REBUILD_SCRIPT = """
+local used = {}
+for i = 3, #ARGV do
+    used[ARGV[i]] = true
+end
+for _, port in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+    used[port] = true
+end
+redis.call('DEL', KEYS[1])
+local free, batch = 0, {}
+for port = tonumber(ARGV[1]), tonumber(ARGV[2]) - 1 do
+    if not used[tostring(port)] then
+        free = free + 1
+        batch[#batch + 1] = port
+        if #batch == 1000 then
+            redis.call('SADD', KEYS[1], unpack(batch))
+            batch = {}
+        end
+    end
+end
+if #batch > 0 then
+    redis.call('SADD', KEYS[1], unpack(batch))
+end
+redis.call('SET', KEYS[2], 1)
+return free
+"""
+
+
+class _PortAllocatorBase:
+    """Keys, scripts and replies shared by the sync and async allocators.
+
+    The free-port set is seeded from ``DOCKER.MIN_PORT`` (inclusive) to
+    ``DOCKER.MAX_PORT`` (exclusive), so taking or giving back a port is a
+    single ``SPOP``/``SADD`` no matter how full the range is.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._min_port = int(config["DOCKER"]["MIN_PORT"])
+        self._max_port = int(config["DOCKER"]["MAX_PORT"])
+        self._lease_ttl = int(config["DOCKER"]["PORT_LEASE_TTL"])
+        self._reserve = store.register_script(RESERVE_SCRIPT)
+        self._release = store.register_script(RELEASE_SCRIPT)
+        self._transfer = store.register_script(TRANSFER_SCRIPT)
+        self._rebuild = store.register_script(REBUILD_SCRIPT)
+
+    @property
+    def total(self) -> int:
+        return self._max_port - self._min_port
+
+    @staticmethod
+    def _lease_key(owner: Union[int, str]) -> str:
+        return f"{LEASE_KEY_PREFIX}{owner}"
+
+    def _reserve_call(
+        self, owner: Union[int, str], count: int, now: float, expired: list
+    ) -> dict:
+        expired = [x.decode() if isinstance(x, bytes) else x for x in expired]
+        return dict(
+            keys=[
+                FREE_PORTS_KEY,
+                self._lease_key(owner),
+                LEASES_KEY,
+                SEEDED_KEY,
+                LEASED_PORTS_KEY,
+                *[self._lease_key(x) for x in expired],
+            ],
+            args=[
+                count,
+                owner,
+                now + self._lease_ttl,
+                now,
+                self._min_port,
+                self._max_port,
+                *expired,
+            ],
+        )
+
+    @staticmethod
+    def _reserved(owner: Union[int, str], reply) -> List[int]:
+        if reply == -1:
+            raise IOError(f"ports already reserved for {owner}")
+        if reply == -2:
+            raise IOError("no free ports")
+        return [int(x) for x in reply]
+
+    def _release_call(self, owner: Union[int, str]) -> dict:
+        return dict(
+            keys=[FREE_PORTS_KEY, self._lease_key(owner), LEASES_KEY, LEASED_PORTS_KEY],
+            args=[owner],
+        )
+
+    def _transfer_call(self, owner: Union[int, str], new_owner: Union[int, str]) -> dict:
+        return dict(
+            keys=[self._lease_key(owner), self._lease_key(new_owner), LEASES_KEY],
+            args=[owner, new_owner],
+        )
+
+    def _rebuild_call(self, used_ports: Iterable[int]) -> dict:
+        return dict(
+            keys=[FREE_PORTS_KEY, SEEDED_KEY, LEASED_PORTS_KEY],
+            args=[self._min_port, self._max_port, *sorted({int(x) for x in used_ports})],
+        )
+
+    @staticmethod
+    def _transferred(moved: int, new_owner: Union[int, str]) -> bool:
+        if moved == -1:
+            raise IOError(f"ports already reserved for {new_owner}")
+        return moved == 1
+
+    def _stats_pipeline(self):
+        pipe = self._store.pipeline(transaction=False)
+        pipe.scard(FREE_PORTS_KEY)
+        pipe.zcard(LEASES_KEY)
+        pipe.zcount(LEASES_KEY, "-inf", "(+inf")
+        return pipe
+
+    def _stats(self, free: int, leases: int, pending: int) -> dict:
+        return {
+            "total": self.total,
+            "free": free,
+            "used": self.total - free,
+            "leases": leases,
+            "pending_leases": pending,
+        }
+
+
+class PortAllocator(_PortAllocatorBase):
+    """Hands out host ports from a Redis set of free ports."""
+
+    def reserve(self, owner: Union[int, str], count: int) -> List[int]:
+        """Atomically take ``count`` ports for ``owner`` or none at all.
+
+        The reservation is a lease: unless :meth:`commit` is called before
+        ``DOCKER.PORT_LEASE_TTL`` seconds pass, the next reservation hands
+        its ports back to the pool.
+        """
+        if count <= 0:
+            return []
+        now = time.time()
+        expired = self._store.zrangebyscore(
+            LEASES_KEY, "-inf", now, start=0, num=RECLAIM_BATCH
+        )
+        return self._reserved(
+            owner, self._reserve(**self._reserve_call(owner, count, now, expired))
+        )
+
+    def commit(self, owner: Union[int, str]) -> None:
+        """Keep the lease of ``owner`` until it is released explicitly."""
+        self._store.zadd(LEASES_KEY, {str(owner): "+inf"}, xx=True)
+
+    def release_reservation(self, owner: Union[int, str]) -> int:
+        return self._release(**self._release_call(owner))
+
+    def rebuild(self, used_ports: Iterable[int]) -> int:
+        """Reset the free set to the configured range minus ``used_ports``.
+
+        Meant to run at worker startup with the ports Docker actually has
+        published, which drops any reservation leaked by a crashed worker.
+        Ports leased meanwhile stay out of the free set.
+        """
+        if not self._store.set(REBUILD_LOCK_KEY, 1, nx=True, ex=60):
+            return self._store.scard(FREE_PORTS_KEY)
+        free = self._rebuild(**self._rebuild_call(used_ports))
+        log.info(f"Port pool rebuilt: {free} free, {self.total - free} in use")
+        return free
+
+    def stats(self) -> dict:
+        return self._stats(*self._stats_pipeline().execute())
+
+
+class AsyncPortAllocator(_PortAllocatorBase):
+    """The part of :class:`PortAllocator` the API needs, over ``redis.asyncio``."""
+
+    async def transfer(
+        self, owner: Union[int, str], new_owner: Union[int, str]
+    ) -> bool:
+        """Hand the lease of ``owner`` over to ``new_owner`` as a unit."""
+        moved = await self._transfer(**self._transfer_call(owner, new_owner))
+        return self._transferred(moved, new_owner)
+
+    async def stats(self) -> dict:
+        return self._stats(*await self._stats_pipeline().execute())
@@ -0,0 +1,186 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, List
+from redis import Redis
+from config import config
+from .docker import DockerHandler
+import json
+import time
+
+PROGRESS_TTL = 3600
+PROGRESS_FLUSH_INTERVAL = 0.5
+DONE_STATUSES = (
+    "Verifying Checksum",
+    "Download complete",
+    "Extracting",
+    "Pull complete",
+    "Already exists",
+)
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class PullProgress:
+    """Buffers per-layer pull events and flushes them to ``pull:{image}``."""
+
+    def __init__(self, store: Redis, image: str):
+        self._store = store
+        self._key = f"pull:{image}"
+        self._layers = {}
+        self._dirty = set()
+        self._flushed_at = 0.0
+
+    def start(self):
+        pipe = self._store.pipeline()
+        pipe.delete(self._key)
+        pipe.hset(self._key, mapping={"state": "pulling", "started_at": time.time()})
+        pipe.execute()
+
+    def update(self, event: dict):
+        layer_id = event.get("id")
+        if not layer_id or "progressDetail" not in event:
+            return
+        detail = event.get("progressDetail") or {}
+        layer = self._layers.setdefault(layer_id, {"current": 0, "total": 0})
+        layer["status"] = event.get("status", "")
+        if detail.get("total"):
+            layer["total"] = max(layer["total"], detail["total"])
+        if layer["status"] == "Downloading":
+            layer["current"] = detail.get("current", layer["current"])
+        elif layer["status"] in DONE_STATUSES:
+            layer["current"] = layer["total"]
+        self._dirty.add(layer_id)
+        if time.monotonic() - self._flushed_at >= PROGRESS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self._dirty:
+            self._store.hset(
+                self._key,
+                mapping={
+                    f"layer:{x}": json.dumps(self._layers[x]) for x in self._dirty
+                },
+            )
+            self._dirty = set()
+        self._flushed_at = time.monotonic()
+
+    def finish(self, error: str = None):
+        self.flush()
+        pipe = self._store.pipeline()
+        pipe.hset(
+            self._key,
+            mapping={
+                "state": "failed" if error else "done",
+                "error": error or "",
+                "finished_at": time.time(),
+            },
+        )
+        pipe.expire(self._key, PROGRESS_TTL)
+        pipe.execute()
+
+
+class PullEngine:
+    """Pulls images concurrently, at most once at a time per reference.
+
+    A reference that is already being pulled by another job (in this process
+    or any other worker) is not fetched again; the caller waits for that pull
+    to finish instead.
+    """
+
+    def __init__(self, docker: DockerHandler, store: Redis):
+        self._docker = docker
+        self._store = store
+        self._concurrency = int(config["DOCKER"]["PULL_CONCURRENCY"])
+        self._timeout = int(config["DOCKER"]["PULL_TIMEOUT"])
+
+    def pull(self, images: Iterable[str]) -> None:
+        images = list(dict.fromkeys(images))
+        if not images:
+            return
+        errors = []
+        with ThreadPoolExecutor(
+            max_workers=min(self._concurrency, len(images))
+        ) as executor:
+            futures = {executor.submit(self._pull_one, x): x for x in images}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(f"{futures[future]}: {e}")
+        if errors:
+            raise Exception(f"Failed to pull images ({'; '.join(errors)})")
+
+    def _pull_one(self, image: str) -> None:
+        lock = f"pull:{image}:lock"
+        if not self._store.set(lock, 1, nx=True, ex=self._timeout):
+            self._wait(image)
+            return
+        progress = PullProgress(self._store, image)
+        progress.start()
+        try:
+            self._docker.pull_image(image, progress=progress.update)
+        except Exception as e:
+            progress.finish(error=str(e))
+            raise
+        else:
+            progress.finish()
+        finally:
+            self._store.delete(lock)
+
+    def _wait(self, image: str) -> None:
+        deadline = time.monotonic() + self._timeout
+        while self._store.exists(f"pull:{image}:lock"):
+            if time.monotonic() > deadline:
+                raise Exception(f"Timed out waiting for pull of {image}")
+            time.sleep(1)
+        state = PullEngine.read_progress(self._store, [image])
+        if state["state"] == "failed":
+            raise Exception(state["error"] or f"Failed to pull image {image}")
+
+    @staticmethod
+    def read_progress(store: Redis, images: List[str]) -> dict:
+        """Aggregate the recorded pull progress of ``images``."""
+        pipe = PullEngine._progress_pipeline(store, images)
+        return PullEngine._aggregate(pipe.execute())
+
+    @staticmethod
+    async def read_progress_async(store, images: List[str]) -> dict:
+        """:meth:`read_progress` for a ``redis.asyncio`` client."""
+        pipe = PullEngine._progress_pipeline(store, images)
+        return PullEngine._aggregate(await pipe.execute())
+
+    @staticmethod
+    def _progress_pipeline(store, images: List[str]):
+        pipe = store.pipeline()
+        for image in images:
+            pipe.hgetall(f"pull:{image}")
+        return pipe
+
+    @staticmethod
+    def _aggregate(raws: list) -> dict:
+        states, current, total, errors = [], 0, 0, []
+        for raw in raws:
+            raw = {_decode(k): _decode(v) for k, v in raw.items()}
+            states.append(raw.get("state", "pending"))
+            if raw.get("error"):
+                errors.append(raw["error"])
+            for field, value in raw.items():
+                if not field.startswith("layer:"):
+                    continue
+                layer = json.loads(value)
+                total += layer["total"]
+                current += layer["current"]
+        if "failed" in states:
+            state = "failed"
+        elif states and all(x == "done" for x in states):
+            state = "done"
+        else:
+            state = "pulling"
+        return {
+            "state": state,
+            "current": current,
+            "total": total,
+            "percent": round(current * 100 / total, 1) if total else None,
+            "error": "; ".join(errors),
+        }
@@ -0,0 +1,126 @@
+from typing import Dict, List, Optional
+from redis import Redis
+from config import config
+import time
+
+_broker = None
+
+WAIT_KEY = "celery:wait:{queue}"
+PUBLISHED_HEADER = "published_at"
+
+# Upper bounds in seconds of the wait-time histogram kept per queue.
+WAIT_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900)
+
+ROUTES = {
+    "worker.start_challenge": "start",
+    "worker.start_instance": "start",
+    "worker.admit_queued": "start",
+    "worker.clean_challenge": "teardown",
+    "worker.clean_challenges": "teardown",
+    "worker.clean_instance": "teardown",
+    "worker.release_instances": "teardown",
+    "worker.drain_warm_pool": "teardown",
+    "worker.pull_images": "pull",
+}
+
+
+def queue_names() -> List[str]:
+    """Every queue, highest priority first."""
+    return list(config["CELERY"]["QUEUES"])
+
+
+def queue_of(task_name: str) -> str:
+    return ROUTES.get(task_name, "default")
+
+
+def settings(queue: str) -> dict:
+    return {k: int(v) for k, v in config["CELERY"]["QUEUES"][queue].items()}
+
+
+def task_routes() -> Dict[str, dict]:
+    return {task: {"queue": queue} for task, queue in ROUTES.items()}
+
+
+class QueueTimeLimits:
+    """Celery task annotation: our tasks get the time limits of their queue."""
+
+    def annotate(self, task):
+        if not task.name.startswith("worker."):
+            return None
+        limits = settings(queue_of(task.name))
+        return {
+            "soft_time_limit": limits["SOFT_TIME_LIMIT"],
+            "time_limit": limits["TIME_LIMIT"],
+        }
+
+
+def consumed_queue(queues) -> Optional[str]:
+    """The queue a worker started with ``-Q`` serves, if it serves only one."""
+    if isinstance(queues, str):
+        queues = queues.split(",")
+    queues = [x.strip() for x in queues or [] if x.strip()]
+    if len(queues) == 1 and queues[0] in config["CELERY"]["QUEUES"]:
+        return queues[0]
+    return None
+
+
+def record_wait(store: Redis, queue: str, seconds: float):
+    """Count one task that waited ``seconds`` in ``queue`` before it started."""
+    key = WAIT_KEY.format(queue=queue)
+    bucket = next((x for x in WAIT_BUCKETS if seconds <= x), "inf")
+    pipe = store.pipeline(transaction=False)
+    pipe.hincrby(key, "count", 1)
+    pipe.hincrbyfloat(key, "sum", seconds)
+    pipe.hincrby(key, f"le:{bucket}", 1)
+    pipe.hset(key, "last", seconds)
+    return pipe.execute()
+
+
+def waited(published_at) -> float:
+    return max(0.0, time.time() - float(published_at))
+
+
+def broker_client() -> Redis:
+    """A client for the broker database, where every queue is a list."""
+    global _broker
+    if _broker is None:
+        _broker = Redis.from_url(config["CELERY"]["BROKER_URL"])
+    return _broker
+
+
+def queue_stats(store: Redis, broker: Redis) -> List[dict]:
+    """Depth of every queue in the broker and how long its tasks waited.
+
+    ``wait_buckets`` is cumulative, Prometheus style: tasks that waited at
+    most that many seconds.
+    """
+    names = queue_names()
+    pipe = broker.pipeline(transaction=False)
+    for queue in names:
+        pipe.llen(queue)
+    depths = pipe.execute()
+    pipe = store.pipeline(transaction=False)
+    for queue in names:
+        pipe.hgetall(WAIT_KEY.format(queue=queue))
+    stats = []
+    for queue, depth, raw in zip(names, depths, pipe.execute()):
+        raw = {
+            (k.decode() if isinstance(k, bytes) else k): float(v) for k, v in raw.items()
+        }
+        count = int(raw.get("count", 0))
+        buckets, total = {}, 0
+        for bound in (*WAIT_BUCKETS, "inf"):
+            total += int(raw.get(f"le:{bound}", 0))
+            buckets[str(bound)] = total
+        stats.append(
+            {
+                "queue": queue,
+                "depth": depth,
+                "tasks": count,
+                "wait_sum": raw.get("sum", 0.0),
+                "wait_avg": raw.get("sum", 0.0) / count if count else 0.0,
+                "wait_last": raw.get("last"),
+                "wait_buckets": buckets,
+            }
+        )
+    return stats
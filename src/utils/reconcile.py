@@ -0,0 +1,300 @@
+from typing import Dict
+from redis import Redis
+from config import config
+from repository.challenge import ChallengeRepository
+from repository.instance import InstanceRepository
+from utils.docker import DockerHandler, LABEL_CHALLENGE, LABEL_INSTANCE
+from utils.ports import LEASES_KEY, PortAllocator
+from utils.scheduler import Scheduler
+from utils.admission import AdmissionQueue
+from utils.state import InstanceState
+from utils.teardown import teardown_instance
+from utils.warm_pool import WarmPool
+import json
+import logging
+import math
+import time
+
+log = logging.getLogger(__name__)
+
+REPORT_KEY = "reconcile:report"
+LOCK_KEY = "reconcile:lock"
+
+# The states an instance may be in while its lock is legitimately held.
+LOCKS = {"start": ("queued", "creating"), "delete": ("deleting",)}
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def warm_token(instance: str):
+    """The token of an instance created for a warm pool, else ``None``."""
+    _, sep, token = instance.rpartition("-warm-")
+    return token if sep else None
+
+
+class Reconciler:
+    """Repairs drift between the database, Redis and what Docker runs.
+
+    Every Docker node in ``dockers`` is read once (one labelled
+    ``containers.list`` and one ``networks.list``) and compared with
+    ``Challenge.status`` and ``connection_info``, per-player instances, the
+    ``start:``/``delete:`` locks, instance states, warm pools, port leases
+    and node placements. Instances on a node that cannot be reached are
+    left alone. Every difference lands in the report; unless ``dry_run`` is
+    set it is repaired as well. The last report is kept in
+    ``reconcile:report``.
+    """
+
+    def __init__(
+        self,
+        dockers: Dict[str, DockerHandler],
+        store: Redis,
+        repo: ChallengeRepository,
+        instance_repo: InstanceRepository,
+        dry_run: bool = False,
+    ):
+        self._dockers = dockers
+        self._unreachable = set()
+        self._store = store
+        self._repo = repo
+        self._instance_repo = instance_repo
+        self._dry_run = dry_run
+        self._state = InstanceState(store)
+        self._ports = PortAllocator(store)
+        self._scheduler = Scheduler(store)
+        self._lock_timeout = float(config["RECONCILE"]["LOCK_TIMEOUT"])
+        self._fixes = []
+
+    def run(self) -> dict:
+        started_at = time.time()
+        instances = self._instances()
+        challenges = {x.id: x for x in self._repo.list_all()}
+        players = {x.id: x.name for x in self._instance_repo.list_all()}
+        ids = list(challenges)
+        states = self._state.states(ids)
+        locks = self._locks()
+        pool = WarmPool(self._store)
+        warm = {
+            entry["instance"] for entries in pool.peek(ids).values() for entry in entries
+        }
+
+        self._release_stale_locks(locks, states)
+        locked = {chall_id for _, chall_id in locks}
+        dead = self._stop_dead_instances(challenges, instances, locked)
+        running = {
+            x.id: x.connection_info["instance"]
+            for x in challenges.values()
+            if x.status == "running" and x.connection_info and x.id not in dead
+        }
+        owned = set(running.values()) | warm | set(players.values())
+        busy = locked | pool.refilling(ids)
+        self._remove_orphans(instances, owned, busy)
+        queued = {int(x) for x in AdmissionQueue(self._store).owners() if x.isdigit()}
+        self._fix_states(challenges, states, running, locked | dead | queued)
+        live = dict(
+            running=running,
+            locked=locked,
+            warm_tokens={warm_token(x) for x in warm | set(instances)},
+            players=players,
+        )
+        self._release_leaked_leases(live)
+        self._release_leaked_placements(live)
+
+        report = {
+            "dry_run": self._dry_run,
+            "started_at": started_at,
+            "duration": time.time() - started_at,
+            "challenges": len(challenges),
+            "instances": len(instances),
+            "containers": sum(len(x["containers"]) for x in instances.values()),
+            "unreachable_nodes": sorted(self._unreachable),
+            "fixes": self._fixes,
+        }
+        self._store.set(REPORT_KEY, json.dumps(report))
+        return report
+
+    def _fix(self, kind: str, repair, **detail) -> None:
+        fix = dict(kind=kind, **detail)
+        if not self._dry_run:
+            try:
+                repair()
+                fix["repaired"] = True
+            except Exception as e:
+                log.warning(f"Reconciler failed to repair {fix}: {e}")
+                fix["error"] = str(e)
+        self._fixes.append(fix)
+
+    def _instances(self) -> Dict[str, dict]:
+        """Labelled containers and networks grouped by instance name."""
+        instances = {}
+
+        def entry(labels: dict, node: str) -> dict:
+            chall_id = labels.get(LABEL_CHALLENGE)
+            return instances.setdefault(
+                labels[LABEL_INSTANCE],
+                {
+                    "challenge": int(chall_id) if chall_id else None,
+                    "node": node,
+                    "containers": [],
+                    "networks": [],
+                    "running": 0,
+                },
+            )
+
+        for node, docker in self._dockers.items():
+            try:
+                containers = docker.managed_containers()
+                networks = docker.managed_networks()
+            except Exception as e:
+                log.warning(f"Reconciler cannot reach node {node}: {e}")
+                self._unreachable.add(node)
+                continue
+            for container in containers:
+                item = entry(container.attrs.get("Labels") or {}, node)
+                item["containers"].append(container.id)
+                item["running"] += container.attrs.get("State") == "running"
+            for network in networks:
+                entry(network.attrs.get("Labels") or {}, node)["networks"].append(
+                    network.name
+                )
+        return instances
+
+    def _locks(self) -> set:
+        locks = set()
+        for kind in LOCKS:
+            for key in self._store.scan_iter(f"{kind}:*", count=500):
+                _, _, chall_id = _decode(key).partition(":")
+                if chall_id.isdigit():
+                    locks.add((kind, int(chall_id)))
+        return locks
+
+    def _release_stale_locks(self, locks: set, states: dict) -> None:
+        """Drop locks whose task is gone: wrong state or no progress for too long."""
+        now = time.time()
+        for kind, chall_id in sorted(locks):
+            state, updated_at = states.get(chall_id, (None, 0))
+            if state in LOCKS[kind] and now - updated_at < self._lock_timeout:
+                continue
+            locks.discard((kind, chall_id))
+            self._fix(
+                "stale_lock",
+                lambda: self._store.delete(f"{kind}:{chall_id}"),
+                challenge=chall_id,
+                lock=kind,
+                state=state,
+            )
+
+    def _stop_dead_instances(self, challenges: dict, instances: dict, locked: set) -> set:
+        """Mark challenges stopped whose instance has no running container."""
+        dead = set()
+        for challenge in challenges.values():
+            if challenge.status != "running" or challenge.id in locked:
+                continue
+            connection_info = challenge.connection_info or {}
+            instance = connection_info.get("instance")
+            if instances.get(instance, {}).get("running"):
+                continue
+            if self._node(connection_info.get("node")) in self._unreachable:
+                continue
+            dead.add(challenge.id)
+            self._fix(
+                "dead_instance",
+                lambda: self._stop(challenge),
+                challenge=challenge.id,
+                instance=instance,
+            )
+        return dead
+
+    def _node(self, name: str = None) -> str:
+        """``name``, or the first node for instances placed before there were nodes."""
+        return name or next(iter(self._dockers))
+
+    def _stop(self, challenge) -> None:
+        self._repo.change_status(challenge, connection_info=None)
+        self._ports.release_reservation(challenge.id)
+        self._state.transition(challenge.id, "stopped", players=0)
+
+    def _remove_orphans(self, instances: dict, owned: set, busy: set) -> None:
+        """Tear down instances no challenge, warm pool or running task claims."""
+        for instance, item in instances.items():
+            if instance in owned or item["challenge"] in busy:
+                continue
+            self._fix(
+                "orphan_instance",
+                lambda: self._remove_orphan(instance, item["node"]),
+                challenge=item["challenge"],
+                instance=instance,
+                node=item["node"],
+                containers=len(item["containers"]),
+                networks=len(item["networks"]),
+            )
+
+    def _remove_orphan(self, instance: str, node: str) -> None:
+        teardown_instance(self._dockers[node], instance, grace=0)
+        token = warm_token(instance)
+        if token:
+            self._ports.release_reservation(f"warm:{token}")
+            self._scheduler.release(f"warm:{token}")
+
+    def _fix_states(self, challenges: dict, states: dict, running: dict, skip: set) -> None:
+        """Align ``instance:{id}`` with the database where no task owns it."""
+        for chall_id in challenges:
+            if chall_id in skip:
+                continue
+            current, _ = states.get(chall_id, (None, 0))
+            expected = "running" if chall_id in running else "stopped"
+            if current == expected or (
+                expected == "stopped" and current in (None, "pulling", "failed")
+            ):
+                continue
+            self._fix(
+                "stale_state",
+                lambda: self._state.transition(chall_id, expected),
+                challenge=chall_id,
+                state=current,
+                expected=expected,
+            )
+
+    @staticmethod
+    def _alive(owner: str, running: dict, locked: set, warm_tokens: set, players: dict):
+        """Whether the owner of a lease or placement still exists."""
+        if owner.startswith("warm:"):
+            return owner[len("warm:"):] in warm_tokens
+        if owner.startswith("player:"):
+            return int(owner[len("player:"):]) in players
+        return not owner.isdigit() or int(owner) in running or int(owner) in locked
+
+    def _release_leaked_leases(self, live: dict) -> None:
+        """Free committed port leases whose owner no longer exists."""
+        for owner, deadline in self._store.zrange(LEASES_KEY, 0, -1, withscores=True):
+            owner = _decode(owner)
+            # Pending leases expire on their own; claimed or orphaned warm
+            # instances are handled above.
+            if self._alive(owner, **live) or not math.isinf(deadline):
+                continue
+            self._fix(
+                "leaked_lease",
+                lambda: self._ports.release_reservation(owner),
+                owner=owner,
+            )
+
+    def _release_leaked_placements(self, live: dict) -> None:
+        """Give back node capacity reserved for owners that no longer exist.
+
+        Placements younger than ``RECONCILE.LOCK_TIMEOUT`` may belong to a
+        task that is still creating the instance and are kept.
+        """
+        now = time.time()
+        for owner, placement in self._scheduler.placements().items():
+            if self._alive(owner, **live):
+                continue
+            if now - placement.get("placed_at", 0) < self._lock_timeout:
+                continue
+            self._fix(
+                "leaked_placement",
+                lambda: self._scheduler.release(owner),
+                owner=owner,
+                node=placement["node"],
+            )
@@ -0,0 +1,328 @@
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+from redis import Redis
+from config import config
+from utils.docker import DockerHandler
+import json
+import time
+
+RESERVED_KEY = "nodes:reserved"
+PLACEMENTS_KEY = "nodes:placements"
+
+MEMORY_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+# KEYS: reserved, placements
+# ARGV: owner, node, cpu, memory, node cpu, node memory, now
+# Returns the owner's placement, or nil if the node no longer has room.
+PLACE_SCRIPT = """
+local placed = redis.call('HGET', KEYS[2], ARGV[1])
+if placed then
+    return placed
+end
+local cpu = tonumber(redis.call('HGET', KEYS[1], ARGV[2] .. ':cpu') or 0)
+local memory = tonumber(redis.call('HGET', KEYS[1], ARGV[2] .. ':memory') or 0)
+if tonumber(ARGV[5]) > 0 and cpu + tonumber(ARGV[3]) > tonumber(ARGV[5]) then
+    return false
+end
+if tonumber(ARGV[6]) > 0 and memory + tonumber(ARGV[4]) > tonumber(ARGV[6]) then
+    return false
+end
+redis.call('HINCRBY', KEYS[1], ARGV[2] .. ':cpu', ARGV[3])
+redis.call('HINCRBY', KEYS[1], ARGV[2] .. ':memory', ARGV[4])
+placed = cjson.encode({
+    node = ARGV[2],
+    cpu = tonumber(ARGV[3]),
+    memory = tonumber(ARGV[4]),
+    placed_at = tonumber(ARGV[7]),
+})
+redis.call('HSET', KEYS[2], ARGV[1], placed)
+return placed
+"""
+
+# KEYS: reserved, placements; ARGV: owner
+RELEASE_SCRIPT = """
+local placed = redis.call('HGET', KEYS[2], ARGV[1])
+if not placed then
+    return 0
+end
+placed = cjson.decode(placed)
+redis.call('HINCRBY', KEYS[1], placed.node .. ':cpu', string.format('%d', -placed.cpu))
+redis.call('HINCRBY', KEYS[1], placed.node .. ':memory', string.format('%d', -placed.memory))
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS: placements; ARGV: owner, new owner
+TRANSFER_SCRIPT = """
+local placed = redis.call('HGET', KEYS[1], ARGV[1])
+if not placed then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[2], placed)
+redis.call('HDEL', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+class NoNodeFits(Exception):
+    """A demand larger than what any node has, even with nothing on it."""
+
+
+class Node(NamedTuple):
+    """A Docker endpoint instances can be placed on.
+
+    ``cpu`` is in millicores and ``memory`` in bytes; ``0`` means unbounded.
+    ``host`` is what players connect to.
+    """
+
+    name: str
+    url: str
+    host: str
+    cpu: int
+    memory: int
+
+
+def parse_memory(value) -> int:
+    """Bytes in a Docker memory limit such as ``512M``, ``1g`` or ``1024``."""
+    value = str(value or 0).strip().lower()
+    if value.endswith("b"):
+        value = value[:-1]
+    unit = value[-1] if value and value[-1] in MEMORY_UNITS else ""
+    return int(float(value[: len(value) - len(unit)] or 0) * MEMORY_UNITS[unit])
+
+
+def millicores(cpu) -> int:
+    return int(round(float(cpu or 0) * 1000))
+
+
+def load_nodes() -> List[Node]:
+    """The nodes in ``DOCKER.NODES``, or ``DOCKER.HOST`` as the only one."""
+    raw = config["DOCKER"]["NODES"]
+    if not raw:
+        return [
+            Node(
+                "default",
+                config["DOCKER"]["HOST"],
+                config["CHALLENGE_HOST"]["HOST"],
+                millicores(config["DOCKER"]["NODE_CPU"]),
+                parse_memory(config["DOCKER"]["NODE_MEMORY"]),
+            )
+        ]
+    return [
+        Node(
+            x["name"],
+            x["url"],
+            x.get("host") or config["CHALLENGE_HOST"]["HOST"],
+            millicores(x.get("cpu")),
+            parse_memory(x.get("memory")),
+        )
+        for x in (json.loads(raw) if isinstance(raw, str) else raw)
+    ]
+
+
+def demand(challenge) -> Tuple[int, int]:
+    """Summed ``(millicores, bytes)`` of every service of ``challenge``."""
+    return (
+        sum(millicores(x.cpu) for x in challenge.services),
+        sum(parse_memory(x.memory) for x in challenge.services),
+    )
+
+
+def best_fit(
+    nodes: List[Node], reserved: Dict[str, Tuple[int, int]], cpu: int, memory: int
+) -> Optional[Node]:
+    """The node that fits the demand with the least capacity to spare.
+
+    Spare CPU and memory are compared as fractions of each node's capacity;
+    an unbounded dimension counts as entirely spare. Ties go to the node
+    listed first.
+    """
+    best, best_spare = None, None
+    for node in nodes:
+        used_cpu, used_memory = reserved.get(node.name, (0, 0))
+        spare = 0.0
+        for capacity, used, wanted in (
+            (node.cpu, used_cpu, cpu),
+            (node.memory, used_memory, memory),
+        ):
+            if not capacity:
+                spare += 1
+                continue
+            left = capacity - used - wanted
+            if left < 0:
+                break
+            spare += left / capacity
+        else:
+            if best_spare is None or spare < best_spare:
+                best, best_spare = node, spare
+    return best
+
+
+class _SchedulerBase:
+    """Nodes, keys, scripts and replies shared by the sync and async schedulers.
+
+    Capacity reserved on each node is kept in the ``nodes:reserved`` hash
+    and every owner's placement in ``nodes:placements``. Owners are the same
+    strings that own port leases: a challenge id, ``warm:{token}`` or
+    ``player:{id}``. The scripts re-check capacity before reserving, so
+    concurrent workers never overcommit a node.
+    """
+
+    def __init__(self, store, nodes: List[Node] = None):
+        self._store = store
+        self._nodes = nodes or load_nodes()
+        self._place = store.register_script(PLACE_SCRIPT)
+        self._release = store.register_script(RELEASE_SCRIPT)
+        self._transfer = store.register_script(TRANSFER_SCRIPT)
+
+    @property
+    def nodes(self) -> List[Node]:
+        return self._nodes
+
+    def node(self, name: str) -> Optional[Node]:
+        return next((x for x in self._nodes if x.name == name), None)
+
+    def check_fits(self, owner: Union[int, str], cpu: int, memory: int) -> None:
+        """Raise :class:`NoNodeFits` unless an empty node could hold the demand.
+
+        Such a start would wait for room forever, and block everyone queued
+        behind it.
+        """
+        if best_fit(self._nodes, {}, cpu, memory) is None:
+            raise NoNodeFits(
+                f"No node has {cpu}m CPU and {memory} bytes in total for {owner}"
+            )
+
+    def _place_call(self, owner: Union[int, str], node: Node, cpu: int, memory: int) -> dict:
+        return dict(
+            keys=[RESERVED_KEY, PLACEMENTS_KEY],
+            args=[owner, node.name, cpu, memory, node.cpu, node.memory, time.time()],
+        )
+
+    def _placed(self, owner: Union[int, str], placed) -> Node:
+        name = json.loads(placed)["node"]
+        if not self.node(name):
+            raise IOError(f"{owner} is placed on unknown node {name}")
+        return self.node(name)
+
+    @staticmethod
+    def _no_room(owner: Union[int, str], cpu: int, memory: int) -> IOError:
+        return IOError(f"No node has {cpu}m CPU and {memory} bytes free for {owner}")
+
+    @staticmethod
+    def _release_call(owner: Union[int, str]) -> dict:
+        return dict(keys=[RESERVED_KEY, PLACEMENTS_KEY], args=[owner])
+
+    @staticmethod
+    def _transfer_call(owner: Union[int, str], new_owner: Union[int, str]) -> dict:
+        return dict(keys=[PLACEMENTS_KEY], args=[owner, new_owner])
+
+    @staticmethod
+    def _reserved(raw: dict) -> Dict[str, Tuple[int, int]]:
+        reserved = {}
+        for field, value in raw.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            name, _, kind = field.rpartition(":")
+            cpu, memory = reserved.get(name, (0, 0))
+            if kind == "cpu":
+                reserved[name] = (int(value), memory)
+            else:
+                reserved[name] = (cpu, int(value))
+        return reserved
+
+    def _usage(self, raw: dict) -> List[dict]:
+        reserved = self._reserved(raw)
+        return [
+            {
+                "name": x.name,
+                "host": x.host,
+                "cpu": x.cpu,
+                "memory": x.memory,
+                "reserved_cpu": reserved.get(x.name, (0, 0))[0],
+                "reserved_memory": reserved.get(x.name, (0, 0))[1],
+            }
+            for x in self._nodes
+        ]
+
+
+class Scheduler(_SchedulerBase):
+    """Places instances on Docker nodes, best fit first."""
+
+    def place(self, owner: Union[int, str], cpu: int, memory: int) -> Node:
+        """Reserve ``cpu``/``memory`` for ``owner`` on the best-fitting node.
+
+        Placing an owner twice returns its existing node.
+        """
+        # Another worker may fill the chosen node first; pick again then.
+        for _ in range(len(self._nodes) + 1):
+            node = best_fit(self._nodes, self.reserved(), cpu, memory)
+            if node is None:
+                break
+            placed = self._place(**self._place_call(owner, node, cpu, memory))
+            if placed:
+                return self._placed(owner, placed)
+        raise self._no_room(owner, cpu, memory)
+
+    def release(self, owner: Union[int, str]) -> bool:
+        return bool(self._release(**self._release_call(owner)))
+
+    def placement(self, owner: Union[int, str]) -> Optional[dict]:
+        placed = self._store.hget(PLACEMENTS_KEY, owner)
+        return json.loads(placed) if placed else None
+
+    def placements(self) -> Dict[str, dict]:
+        return {
+            (k.decode() if isinstance(k, bytes) else k): json.loads(v)
+            for k, v in self._store.hgetall(PLACEMENTS_KEY).items()
+        }
+
+    def node_of(self, owner: Union[int, str]) -> Optional[Node]:
+        placed = self.placement(owner)
+        return self.node(placed["node"]) if placed else None
+
+    def reserved(self) -> Dict[str, Tuple[int, int]]:
+        return self._reserved(self._store.hgetall(RESERVED_KEY))
+
+    def usage(self) -> List[dict]:
+        return self._usage(self._store.hgetall(RESERVED_KEY))
+
+
+class AsyncScheduler(_SchedulerBase):
+    """Placement from the API, over ``redis.asyncio``: it places, releases and
+    hands placements over; the worker and reconciler read them back.
+    """
+
+    async def place(self, owner: Union[int, str], cpu: int, memory: int) -> Node:
+        for _ in range(len(self._nodes) + 1):
+            node = best_fit(self._nodes, await self.reserved(), cpu, memory)
+            if node is None:
+                break
+            placed = await self._place(**self._place_call(owner, node, cpu, memory))
+            if placed:
+                return self._placed(owner, placed)
+        raise self._no_room(owner, cpu, memory)
+
+    async def release(self, owner: Union[int, str]) -> bool:
+        return bool(await self._release(**self._release_call(owner)))
+
+    async def transfer(self, owner: Union[int, str], new_owner: Union[int, str]) -> bool:
+        """Hand the placement of ``owner`` over to ``new_owner``."""
+        return bool(await self._transfer(**self._transfer_call(owner, new_owner)))
+
+    async def reserved(self) -> Dict[str, Tuple[int, int]]:
+        return self._reserved(await self._store.hgetall(RESERVED_KEY))
+
+    async def usage(self) -> List[dict]:
+        return self._usage(await self._store.hgetall(RESERVED_KEY))
+
+
+def docker_for(
+    store: Redis, owner: Union[int, str], node_name: str = None, creds: dict = None
+) -> DockerHandler:
+    """A handler for the node ``owner`` is placed on.
+
+    ``node_name`` (e.g. from ``connection_info``) is used when the placement
+    is already gone; without either, the first node is assumed.
+    """
+    scheduler = Scheduler(store)
+    node = scheduler.node_of(owner) or scheduler.node(node_name) or scheduler.nodes[0]
+    return DockerHandler(creds, node=node)
@@ -0,0 +1,182 @@
+from typing import Dict, List, Optional, Tuple
+from config import config
+import json
+import time
+
+EVENTS_KEY = "status:events"
+
+# What of a change goes into ``status:events``; timestamps and images stay
+# in the hash.
+EVENT_FIELDS = ("state", "phase", "error", "players", "task_id")
+
+STATES = (
+    "stopped",
+    "pulling",
+    "queued",
+    "creating",
+    "running",
+    "deleting",
+    "failed",
+)
+
+# States a task is still working through. One that made no progress for
+# RECONCILE.LOCK_TIMEOUT seconds was left behind by a task that died.
+IN_PROGRESS = ("pulling", "queued", "creating", "deleting")
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class _InstanceStateBase:
+    """Keys and replies shared by the sync and async instance states.
+
+    The lifecycle of a challenge instance is kept in one ``instance:{id}``
+    hash; per-player instances use the ``player`` prefix, keyed by instance
+    id. Every transition is a single ``HSET`` of the state, its phase, the
+    error (cleared unless given) and timestamps, so readers never observe a
+    half-applied change and the status endpoint needs one ``HGETALL``.
+    Transitions and phase changes are appended to the ``status:events``
+    stream in the same transaction for :mod:`utils.events` to push.
+    """
+
+    def __init__(self, store, prefix: str = "instance"):
+        self._store = store
+        self._prefix = prefix
+        self._stale_after = float(config["RECONCILE"]["LOCK_TIMEOUT"])
+
+    def _key(self, chall_id: int) -> str:
+        return f"{self._prefix}:{chall_id}"
+
+    @staticmethod
+    def _transition_mapping(state: str, phase: str, error: str, fields: dict) -> dict:
+        if state not in STATES:
+            raise ValueError(f"Unknown instance state {state}")
+        now = time.time()
+        mapping = {
+            "state": state,
+            "phase": phase,
+            "error": error,
+            "updated_at": now,
+            f"{state}_at": now,
+        }
+        mapping.update(
+            {
+                k: json.dumps(v) if isinstance(v, (list, dict)) else v
+                for k, v in fields.items()
+            }
+        )
+        return mapping
+
+    def _write_pipeline(self, chall_id: int, mapping: dict):
+        event = {k: mapping[k] for k in EVENT_FIELDS if k in mapping}
+        pipe = self._store.pipeline(transaction=True)
+        pipe.hset(self._key(chall_id), mapping=mapping)
+        pipe.xadd(
+            EVENTS_KEY,
+            {"scope": self._prefix, "id": chall_id, **event},
+            maxlen=int(config["EVENTS"]["STREAM_MAXLEN"]),
+            approximate=True,
+        )
+        return pipe
+
+    def _states_pipeline(self, chall_ids: List[int]):
+        pipe = self._store.pipeline(transaction=False)
+        for chall_id in chall_ids:
+            pipe.hmget(self._key(chall_id), "state", "updated_at")
+        return pipe
+
+    @staticmethod
+    def _states(chall_ids: List[int], replies: list) -> Dict[int, Tuple[Optional[str], float]]:
+        return {
+            chall_id: (_decode(state), float(updated_at or 0))
+            for chall_id, (state, updated_at) in zip(chall_ids, replies)
+        }
+
+
+class InstanceState(_InstanceStateBase):
+    """Lifecycle of challenge instances as the worker and cron drive it."""
+
+    def transition(
+        self,
+        chall_id: int,
+        state: str,
+        phase: str = "",
+        error: str = "",
+        **fields,
+    ) -> None:
+        mapping = self._transition_mapping(state, phase, error, fields)
+        self._write_pipeline(chall_id, mapping).execute()
+
+    def phase(self, chall_id: int, phase: str) -> None:
+        mapping = {"phase": phase, "updated_at": time.time()}
+        self._write_pipeline(chall_id, mapping).execute()
+
+    def set_players(self, chall_id: int, players: int) -> None:
+        self._store.hset(self._key(chall_id), "players", players)
+
+    def current(self, chall_id: int) -> Optional[str]:
+        return _decode(self._store.hget(self._key(chall_id), "state"))
+
+    def states(self, chall_ids: List[int]) -> Dict[int, Tuple[Optional[str], float]]:
+        """``(state, updated_at)`` of every instance in ``chall_ids``."""
+        return self._states(chall_ids, self._states_pipeline(chall_ids).execute())
+
+    def delete(self, chall_id: int) -> None:
+        self._store.delete(self._key(chall_id))
+
+
+class AsyncInstanceState(_InstanceStateBase):
+    """Lifecycle of challenge instances as the API reads and starts them."""
+
+    async def transition(
+        self,
+        chall_id: int,
+        state: str,
+        phase: str = "",
+        error: str = "",
+        **fields,
+    ) -> None:
+        mapping = self._transition_mapping(state, phase, error, fields)
+        await self._write_pipeline(chall_id, mapping).execute()
+
+    async def set_players(self, chall_id: int, players: int) -> None:
+        await self._store.hset(self._key(chall_id), "players", players)
+
+    async def add_player(self, chall_id: int) -> int:
+        return await self._store.hincrby(self._key(chall_id), "players", 1)
+
+    async def current(self, chall_id: int) -> Optional[str]:
+        return _decode(await self._store.hget(self._key(chall_id), "state"))
+
+    async def live(self, chall_id: int) -> Optional[str]:
+        """The state, with one whose task stopped making progress as ``failed``."""
+        state, updated_at = await self._store.hmget(
+            self._key(chall_id), "state", "updated_at"
+        )
+        state = _decode(state)
+        idle = time.time() - float(updated_at or 0)
+        if state in IN_PROGRESS and idle >= self._stale_after:
+            return "failed"
+        return state
+
+    async def get(self, chall_id: int) -> dict:
+        raw = await self._store.hgetall(self._key(chall_id))
+        raw = {_decode(k): _decode(v) for k, v in raw.items()}
+        result = {
+            "status": raw.pop("state", "stopped"),
+            "phase": raw.pop("phase", ""),
+            "error": raw.pop("error", ""),
+            "players": int(raw.pop("players", 0)),
+        }
+        if "images" in raw:
+            result["images"] = json.loads(raw.pop("images"))
+        if raw.get("task_id"):
+            result["task_id"] = raw.pop("task_id")
+        result.update({k: float(v) for k, v in raw.items() if k.endswith("_at")})
+        return result
+
+    async def states(self, chall_ids: List[int]) -> Dict[int, Tuple[Optional[str], float]]:
+        return self._states(
+            chall_ids, await self._states_pipeline(chall_ids).execute()
+        )
@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+from docker.errors import APIError, NotFound
+from config import config
+from utils.docker import DockerHandler
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TeardownError(Exception):
+    """Some containers or networks of an instance survived every retry."""
+
+
+def stop_grace(challenge=None) -> int:
+    """Seconds a container of ``challenge`` may take to exit on SIGTERM."""
+    grace = getattr(challenge, "stop_grace", None)
+    return int(config["DOCKER"]["STOP_GRACE"] if grace is None else grace)
+
+
+def remove_container(container, grace: int) -> None:
+    """Stop (or kill, without a grace period) and force-remove ``container``."""
+    try:
+        if grace > 0:
+            container.stop(timeout=grace)
+        else:
+            container.kill()
+    except NotFound:
+        return
+    except APIError:
+        # Already stopped or wedged; the forced remove kills it either way.
+        pass
+    try:
+        container.remove(force=True, v=True)
+    except NotFound:
+        pass
+
+
+def remove_network(network) -> None:
+    try:
+        network.remove()
+    except NotFound:
+        pass
+
+
+def _with_retries(items: list, fn, label: str) -> list:
+    """Apply ``fn`` to ``items`` concurrently, retrying only the failures.
+
+    Returns whatever still fails after ``DOCKER.TEARDOWN_RETRIES`` rounds of
+    exponential backoff.
+    """
+    retries = int(config["DOCKER"]["TEARDOWN_RETRIES"])
+    backoff = float(config["DOCKER"]["TEARDOWN_BACKOFF"])
+    workers = int(config["DOCKER"]["TEARDOWN_CONCURRENCY"])
+    for attempt in range(retries + 1):
+        if not items:
+            break
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+            results = list(executor.map(lambda x: _attempt(fn, x, label), items))
+        items = [x for x, ok in zip(items, results) if not ok]
+    return items
+
+
+def _attempt(fn, item, label: str) -> bool:
+    try:
+        fn(item)
+        return True
+    except Exception as e:
+        log.warning(f"Failed to remove {label} {getattr(item, 'name', item)}: {e}")
+        return False
+
+
+def teardown_instance(
+    docker: DockerHandler,
+    instance: str,
+    grace: int = None,
+    containers: list = (),
+    network: str = None,
+) -> None:
+    """Remove every container and the network of ``instance``.
+
+    Containers and networks are found by the instance label; ``containers``
+    and ``network`` name the resources of instances created before labels
+    existed. Containers are stopped concurrently with ``grace`` seconds to
+    exit (``0`` kills them outright) and force-removed; the network goes
+    once they are gone. Raises :class:`TeardownError` if anything survives.
+    """
+    grace = stop_grace() if grace is None else grace
+    found = docker.instance_containers(instance)
+    if not found:
+        found = [x for x in map(docker.get_container, containers) if x]
+    left = _with_retries(found, lambda x: remove_container(x, grace), "container")
+    networks = docker.instance_networks(instance)
+    if not networks and network:
+        networks = [x for x in [docker.get_network(network)] if x]
+    left += _with_retries(networks, remove_network, "network")
+    if left:
+        raise TeardownError(
+            f"{len(left)} resources of {instance} could not be removed"
+        )
@@ -0,0 +1,90 @@
+from typing import Dict, List, Optional
+import json
+
+
+class _WarmPoolBase:
+    """Keys and replies shared by the sync and async warm pools.
+
+    Each challenge keeps a reserve of pre-created instances in Redis. Each
+    entry describes one instance: its name prefix, the containers and
+    network that belong to it, the connection info to hand out and whether
+    its containers are already running.
+    """
+
+    def __init__(self, store):
+        self._store = store
+
+    @staticmethod
+    def _key(chall_id: int) -> str:
+        return f"warm:{chall_id}"
+
+    @staticmethod
+    def _stats_key(chall_id: int) -> str:
+        return f"warm:{chall_id}:stats"
+
+
+class WarmPool(_WarmPoolBase):
+    """The worker's side of the pool: fill it, drain it and look into it."""
+
+    def put(self, chall_id: int, entry: dict) -> int:
+        return self._store.rpush(self._key(chall_id), json.dumps(entry))
+
+    def drain(self, chall_id: int, keep: int = 0) -> List[dict]:
+        """Remove and return every entry beyond the first ``keep`` ones."""
+        pipe = self._store.pipeline(transaction=True)
+        pipe.lrange(self._key(chall_id), keep, -1)
+        if keep > 0:
+            pipe.ltrim(self._key(chall_id), 0, keep - 1)
+        else:
+            pipe.delete(self._key(chall_id))
+        entries, _ = pipe.execute()
+        return [json.loads(x) for x in entries]
+
+    def peek(self, chall_ids: List[int]) -> Dict[int, List[dict]]:
+        """Entries of every pool in ``chall_ids`` without taking them."""
+        pipe = self._store.pipeline(transaction=False)
+        for chall_id in chall_ids:
+            pipe.lrange(self._key(chall_id), 0, -1)
+        return {
+            chall_id: [json.loads(x) for x in entries]
+            for chall_id, entries in zip(chall_ids, pipe.execute())
+        }
+
+    def refilling(self, chall_ids: List[int]) -> set:
+        """The challenges in ``chall_ids`` whose pool is being refilled."""
+        pipe = self._store.pipeline(transaction=False)
+        for chall_id in chall_ids:
+            pipe.exists(f"{self._key(chall_id)}:refill")
+        return {x for x, refilling in zip(chall_ids, pipe.execute()) if refilling}
+
+    def size(self, chall_id: int) -> int:
+        return self._store.llen(self._key(chall_id))
+
+
+class AsyncWarmPool(_WarmPoolBase):
+    """The API's side of the pool: hand out entries and count hits."""
+
+    async def put(self, chall_id: int, entry: dict) -> int:
+        return await self._store.rpush(self._key(chall_id), json.dumps(entry))
+
+    async def take(self, chall_id: int) -> Optional[dict]:
+        entry = await self._store.lpop(self._key(chall_id))
+        await self._store.hincrby(
+            self._stats_key(chall_id), "hits" if entry else "misses"
+        )
+        return json.loads(entry) if entry else None
+
+    async def stats(self, chall_id: int) -> dict:
+        pipe = self._store.pipeline()
+        pipe.llen(self._key(chall_id))
+        pipe.hgetall(self._stats_key(chall_id))
+        ready, counters = await pipe.execute()
+        counters = {
+            (k.decode() if isinstance(k, bytes) else k): int(v)
+            for k, v in counters.items()
+        }
+        return {
+            "ready": ready,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+        }
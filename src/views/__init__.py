@@ -20,7 +20,7 @@ async def index(
         "join": None,
     }
     if service._user:
-        challs = service.list_challenges(page)
+        challs = await service.list_challenges(page)
     return templates.TemplateResponse(
         "index.html",
         {
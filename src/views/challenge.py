@@ -15,8 +15,9 @@ async def index(
 ):
     if not service._user:
         return RedirectResponse("/login")
-    chall = service.get_challenge(id)
-    if not chall["joined"]:
+    chall = await service.get_challenge(id)
+    # Admins manage the players of challenges they have not joined.
+    if not chall or not (chall["joined"] or service._user.is_admin):
         return RedirectResponse("/")
     return templates.TemplateResponse(
         "challenge.html",
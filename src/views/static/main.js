@@ -35,7 +35,9 @@ for (let buttonType of buttonTypes) {
                 `;
                 let buttonId = e.target.id;
                 chall_id = buttonId.split('_')[2];
-                let r = await fetch(`/api/challenge/${buttonType}`, {
+                // Per-player challenges start the caller's own instance
+                let ownInstance = buttonType === 'start' && button.dataset.scope === 'player';
+                let r = await fetch(ownInstance ? '/api/instance/start' : `/api/challenge/${buttonType}`, {
                     "method": "POST",
                     "headers": getAuthHeaders(),
                     "body": JSON.stringify({
@@ -43,15 +45,21 @@ for (let buttonType of buttonTypes) {
                     })
                 }).then(res => res.json());
                 let success = true;
+                // Starts wait for capacity in a queue; show where the player stands
+                let showQueue = (data) => {
+                    if (data?.status === 'queued' && data?.position) {
+                        button.innerHTML = `
+                            <span class="spinner-border spinner-border-sm" role="status" aria-hidden="true"></span>
+                            Queued (#${data.position})
+                        `;
+                    }
+                };
                 await new Promise(r => setTimeout(r, 2000));
-                if (r?.code === 200) {
+                if (ownInstance) {
+                    success = r?.code === 202 && await waitForEvents(`/api/instance/${r.data.id}`, 'running', showQueue);
+                } else if (r?.code === 200) {
                     if (buttonType === 'start') {
-                        if (buttonType === "start") {
-                            success = r?.data;
-                        }
-                        if (!success) {
-                            success = await waitForServer(chall_id, 'running');
-                        }
+                        success = await waitForEvents(`/api/challenge/${chall_id}`, 'running', showQueue);
                     }
                 }
                 if (!success) {
@@ -83,18 +91,54 @@ function hideAlert() {
     alertBanner.classList.remove('show');
 }
 
-async function waitForServer(chall_id, stop_status) {
+async function waitForServer(status_url, stop_status, onStatus) {
     await new Promise(r => setTimeout(r, 2000));
-    let r = await fetch(`/api/challenge/${chall_id}/status`, {
+    let r = await fetch(status_url, {
         headers: getAuthHeaders()
     }).then(res => res.json());
     if (r?.code === 200) {
-        if (r?.data === stop_status) {
+        if (onStatus) {
+            onStatus(r?.data);
+        }
+        if (r?.data?.status === stop_status) {
             return true;
         }
-        if (r?.data === 'stopped' || r?.data === 'pulling') {
+        if (['stopped', 'pulling', 'failed'].includes(r?.data?.status)) {
             return false;
         }
     }
-    return await waitForServer(chall_id, stop_status);
-}
\ No newline at end of file
+    return await waitForServer(status_url, stop_status, onStatus);
+}
+
+// Follows `${base_url}/events` until the instance reaches stop_status; the
+// browser resumes a dropped stream by itself. Falls back to polling
+// `${base_url}/status` when the stream cannot be opened.
+function waitForEvents(base_url, stop_status, onStatus) {
+    if (!window.EventSource) {
+        return waitForServer(`${base_url}/status`, stop_status, onStatus);
+    }
+    return new Promise((resolve) => {
+        let source = new EventSource(`${base_url}/events`);
+        let received = false;
+        source.addEventListener('status', (e) => {
+            received = true;
+            let data = JSON.parse(e.data);
+            if (onStatus) {
+                onStatus(data);
+            }
+            if (data?.status === stop_status) {
+                source.close();
+                resolve(true);
+            } else if (['stopped', 'pulling', 'failed'].includes(data?.status)) {
+                source.close();
+                resolve(false);
+            }
+        });
+        source.onerror = () => {
+            if (!received) {
+                source.close();
+                resolve(waitForServer(`${base_url}/status`, stop_status, onStatus));
+            }
+        };
+    });
+}
@@ -1,18 +1,50 @@
 from celery import Celery
+from celery.signals import (
+    before_task_publish,
+    celeryd_init,
+    task_prerun,
+    worker_process_init,
+    worker_process_shutdown,
+    worker_ready,
+)
+from kombu import Queue
 from config import config
-from utils.ops import ChallOpsHandler
-from utils.docker import DockerHandler
+from utils.ops import ChallOpsHandler, service_waves
+from utils.docker import DockerHandler, init_client_pool, instance_labels
 from repository import Storage, RedisStorage
+from repository.cache import CatalogueCache
 from repository.challenge import ChallengeRepository
 from repository.user import UserRepository
+from repository.instance import InstanceRepository
 from models.challenge import QueryChallengeModel
 from models.user import QueryUserModel
-from utils.io import get_valid_port
-import json
+from utils.ports import PortAllocator
+from utils.warm_pool import WarmPool
+from utils.state import InstanceState
+from utils.expiry import JoinExpiry, lifetimes
+from utils.teardown import stop_grace, teardown_instance
+from utils.reconcile import LOCK_KEY as RECONCILE_LOCK_KEY, Reconciler
+from utils.scheduler import NoNodeFits, Scheduler, demand, docker_for
+from utils.admission import LOCK_KEY as ADMISSION_LOCK_KEY, AdmissionQueue
+from utils.locks import StartLock
+from utils import metrics, queues
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
 import string
+import time
+from uuid import uuid4
+
+log = logging.getLogger(__name__)
 
-worker = Celery(
-    "worker", broker=f"redis://{config['REDIS_HOST']}:{config['REDIS_PORT']}/1"
+worker = Celery("worker", broker=config["CELERY"]["BROKER_URL"])
+worker.conf.update(
+    task_queues=[Queue(x) for x in queues.queue_names()],
+    task_default_queue="default",
+    task_routes=queues.task_routes(),
+    # Consume a worker's queues in the order given instead of round robin,
+    # so a combined worker always serves starts first.
+    broker_transport_options={"queue_order_strategy": "priority"},
+    task_annotations=[queues.QueueTimeLimits()],
 )
 
 
@@ -22,116 +54,613 @@ def normalize(name):
     return name.replace(" ", "_").lower().strip()
 
 
+worker_process_init.connect(init_client_pool)
+
+# The only queue this worker consumes, if it was started for one.
+served_queue = None
+
+
+@celeryd_init.connect
+def configure_queue_worker(conf=None, options=None, **kwargs):
+    """Size a worker started for a single queue (``-Q pull``) from ``CELERY.QUEUES``."""
+    global served_queue
+    queue = served_queue = queues.consumed_queue((options or {}).get("queues"))
+    if queue:
+        settings = queues.settings(queue)
+        conf.worker_concurrency = settings["CONCURRENCY"]
+        conf.worker_prefetch_multiplier = settings["PREFETCH"]
+    metrics.reset_multiprocess_dir()
+
+
+@worker_ready.connect
+def serve_metrics(**kwargs):
+    """Export what every process of this worker recorded on ``METRICS.WORKER_PORT``."""
+    metrics.serve(int(config["METRICS"]["WORKER_PORT"]))
+
+
+@worker_process_shutdown.connect
+def forget_worker_process(pid=None, **kwargs):
+    metrics.process_exited(pid)
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault(queues.PUBLISHED_HEADER, time.time())
+
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    request = task.request
+    published_at = getattr(request, queues.PUBLISHED_HEADER, None) or (
+        request.headers or {}
+    ).get(queues.PUBLISHED_HEADER)
+    if published_at is None:
+        return
+    queue = (request.delivery_info or {}).get("routing_key") or queues.queue_of(
+        task.name
+    )
+    try:
+        queues.record_wait(
+            next(RedisStorage.get()), queue, queues.waited(published_at)
+        )
+    except Exception as e:
+        print(f"Failed to record queue wait of {task.name}: {e}")
+
+
+@worker_ready.connect
+def rebuild_port_pool(**kwargs):
+    if served_queue not in (None, "default"):
+        # Once per deployment is enough: left to the default queue's worker.
+        return
+    lock_store = next(RedisStorage.get())
+    try:
+        # The port range is shared by every node, so is the pool.
+        used_ports = set()
+        for node in Scheduler(lock_store).nodes:
+            used_ports |= DockerHandler(node=node).published_ports()
+        PortAllocator(lock_store).rebuild(used_ports)
+    except Exception as e:
+        print(f"Failed to rebuild port pool: {e}")
+    reconcile.delay()
+
+
 @worker.task(name="worker.pull_images")
-def pull_images(config: str, creds: dict):
+def pull_images(config: str, creds: dict, chall_id: int = None):
     lock_store = next(RedisStorage.get())
+    state = InstanceState(lock_store)
     ops_handler = ChallOpsHandler(config, creds=creds)
-    lock_store.set(f"pulling:{ops_handler.cfg.title}", 1)
+    # Only an idle challenge shows the pull; a running instance keeps its state.
+    tracked = chall_id is not None and state.current(chall_id) in (
+        None,
+        "stopped",
+        "failed",
+    )
+    if tracked:
+        state.transition(chall_id, "pulling", phase="images", images=ops_handler.images)
     try:
-        ops_handler.pull_images()
+        ops_handler.pull_images(lock_store)
+        if tracked and state.current(chall_id) == "pulling":
+            state.transition(chall_id, "stopped")
     except Exception as e:
         print(f"Failed to pull images: {e}")
-    lock_store.delete(f"pulling:{ops_handler.cfg.title}")
+        if tracked and state.current(chall_id) == "pulling":
+            state.transition(chall_id, "failed", phase="images", error=str(e))
 
 
-@worker.task(name="worker.start_challenge")
-def start_challenge(chall_id: int, creator_id: str):
-    storage = next(Storage.get())
-    repo: ChallengeRepository = ChallengeRepository(storage)
-    user_repo = UserRepository(storage)
-    lock_store = next(RedisStorage.get())
-    docker = DockerHandler()
-    challenge = repo.find_one(QueryChallengeModel(id=chall_id))
-    res = None
-    try:
-        lock_store.set(f"start:{chall_id}", 1)
-        containers = []
-        connection_info = {
-            "host": config["CHALLENGE_HOST"]["HOST"],
+def instance_name(challenge, token: str = None):
+    name = f"chall-{normalize(challenge.title)}"
+    return f"{name}-warm-{token}" if token else name
+
+
+def spawn_instance(
+    lock_store,
+    challenge,
+    instance: str,
+    lease_owner,
+    start: bool = True,
+    on_phase=None,
+    timings_key: str = None,
+):
+    """Create (and optionally start) every service of ``challenge``.
+
+    Containers and the network are named after ``instance``; the node they
+    run on and the host ports are reserved under ``lease_owner``.
+    ``on_phase`` is called with the name of each step as it begins, and the
+    seconds every service took are written to the ``timings_key`` hash if
+    one is given. Returns the instance entry with its connection info; on
+    failure the caller is responsible for cleaning up.
+    """
+    on_phase = on_phase or (lambda phase: None)
+    ports_allocator = PortAllocator(lock_store)
+    on_phase("placement")
+    node = Scheduler(lock_store).place(lease_owner, *demand(challenge))
+    docker = DockerHandler(node=node)
+    entry = {
+        "instance": instance,
+        "node": node.name,
+        "network": f"{instance}-network",
+        "containers": [
+            f"{instance}-{normalize(x.name)}" for x in challenge.services
+        ],
+        "started": start,
+        "connection_info": {
+            "host": node.host,
             "ports": {},
-        }
-        chall_net = docker.create_challenge_network(
-            f"chall-{normalize(challenge.title)}-network"
+            "instance": instance,
+            "node": node.name,
+        },
+    }
+    connection_info = entry["connection_info"]
+    on_phase("network")
+    chall_net = docker.create_challenge_network(
+        entry["network"], labels=instance_labels(instance, challenge.id)
+    )
+    if not chall_net:
+        raise Exception("Cannot create network for challenge")
+    service_ports = [service.ports or [] for service in challenge.services]
+    on_phase("ports")
+    reserved_ports = ports_allocator.reserve(
+        lease_owner, sum(len(x) for x in service_ports)
+    )
+    service_configs = {}
+    for service, ports in zip(challenge.services, service_ports):
+        valid_ports = reserved_ports[: len(ports)]
+        reserved_ports = reserved_ports[len(ports) :]
+        connection_info["ports"].update({x: y for x, y in zip(ports, valid_ports)})
+        service_configs[service.name] = dict(
+            name=f"{instance}-{normalize(service.name)}",
+            network=chall_net.name,
+            labels=instance_labels(instance, challenge.id, service.name),
+            cpu_shares=int(float(service.cpu) * 1024),
+            mem_limit=service.memory,
+            privileged=service.privileged,
+            detach=True,
+            cap_add=service.cap_add or [],
+            environment=service.environment or [],
+            ports={f"{x}/tcp": y for x, y in zip(ports, valid_ports)},
+            restart_policy={
+                "Name": "always",
+            },
         )
-        if not chall_net:
-            lock_store.delete(f"chall:{chall_id}")
-            raise Exception("Cannot create network for challenge")
-        for service in challenge.services:
-            valid_ports = []
-            if service.ports:
-                ports = json.loads(service.ports)
-            else:
-                ports = []
-            for _ in range(len(ports)):
-                valid_ports.append(get_valid_port(lock_store))
-            connection_info["ports"].update({x: y for x, y in zip(ports, valid_ports)})
-            cap_add = json.loads(service.cap_add) if service.cap_add else []
-            environment = json.loads(service.environment) if service.environment else []
-            container = docker.create_container(
-                service.image,
-                name=f"chall-{normalize(challenge.title)}-{normalize(service.name)}",
-                network=chall_net.name,
-                cpu_shares=int(float(service.cpu) * 1024),
-                mem_limit=service.memory,
-                privileged=service.privileged,
-                detach=True,
-                cap_add=cap_add,
-                environment=environment,
-                ports={f"{x}/tcp": y for x, y in zip(ports, valid_ports)},
-                restart_policy={
-                    "Name": "always",
-                },
-            )
-            containers.append(container)
-            docker.attach_container(container, chall_net, service.name)
 
-        for container in containers:
+    def bring_up(service):
+        started_at = time.monotonic()
+        container = docker.create_container(
+            service.image, **service_configs[service.name]
+        )
+        docker.attach_container(container, chall_net, service.name)
+        if start:
             container.start()
+        return time.monotonic() - started_at
 
+    waves = service_waves(
+        challenge.services,
+        {x.name: x.depends_on or [] for x in challenge.services},
+    )
+    timings = {}
+    on_phase("containers")
+    with ThreadPoolExecutor(
+        max_workers=int(config["DOCKER"]["START_CONCURRENCY"])
+    ) as executor:
+        for wave in waves:
+            futures = {executor.submit(bring_up, x): x.name for x in wave}
+            errors = []
+            for future in as_completed(futures):
+                try:
+                    timings[futures[future]] = round(future.result(), 3)
+                except Exception as e:
+                    errors.append(f"{futures[future]}: {e}")
+            if errors:
+                raise Exception(f"Failed to start services ({'; '.join(errors)})")
+    if timings and timings_key:
+        pipe = lock_store.pipeline()
+        pipe.delete(timings_key)
+        pipe.hset(timings_key, mapping=timings)
+        pipe.execute()
+    log.info(f"Service start timings for {instance}: {timings}")
+    ports_allocator.commit(lease_owner)
+    return entry
+
+
+@worker.task(name="worker.start_challenge", bind=True)
+def start_challenge(self, chall_id: int, creator_id: str, warm: dict = None):
+    lock_store = next(RedisStorage.get())
+    task_id = self.request.id or uuid4().hex
+    start_lock = StartLock(lock_store)
+    if not start_lock.claim(chall_id, task_id):
+        return f"Challenge {chall_id} is started by task {start_lock.holder(chall_id)}"
+    storage = next(Storage.get())
+    repo: ChallengeRepository = ChallengeRepository(storage, CatalogueCache(lock_store))
+    user_repo = UserRepository(storage)
+    state = InstanceState(lock_store)
+    challenge = repo.find_one(QueryChallengeModel(id=chall_id))
+    if not challenge:
+        # Deleted while the start was queued.
+        try:
+            if warm:
+                node = warm["connection_info"].get("node")
+                teardown_instance(
+                    docker_for(lock_store, chall_id, node), warm["instance"], grace=0
+                )
+            PortAllocator(lock_store).release_reservation(chall_id)
+            release_placement(lock_store, chall_id)
+        except Exception as e:
+            print(f"Failed to release challenge {chall_id}: {e}")
+        start_lock.release(chall_id, task_id)
+        return None
+    instance = warm["instance"] if warm else instance_name(challenge)
+    timer = metrics.PhaseTimer("challenge", lambda phase: state.phase(chall_id, phase))
+    res = None
+    try:
+        state.transition(chall_id, "creating", phase="network", task_id=task_id)
+        if warm:
+            timer("containers")
+            connection_info = warm["connection_info"]
+            docker = docker_for(lock_store, chall_id, connection_info.get("node"))
+            for name in warm["containers"]:
+                docker.get_container(name).start()
+        else:
+            connection_info = spawn_instance(
+                lock_store,
+                challenge,
+                instance,
+                chall_id,
+                on_phase=timer,
+                timings_key=f"chall:{chall_id}:timings",
+            )["connection_info"]
+        timer("database")
         challenge = repo.change_status(challenge, connection_info=connection_info)
         repo.add_user(challenge, user_repo.find_one(QueryUserModel(id=creator_id)))
-        lock_store.set(f"chall:{chall_id}:count", 1)
+        JoinExpiry(lock_store).start(chall_id, creator_id, lifetimes(challenge)[0])
+        state.transition(chall_id, "running", players=1)
+        timer.done("running")
         res = f'Starting challenge "{challenge.title}" successful'
     except Exception as e:
-        clean_challenge(challenge.id)
-        for port in connection_info["ports"].values():
-            lock_store.delete(f"port:{port}")
-        lock_store.delete(f"chall:{chall_id}:count")
+        timer.done("failed")
+        clean_challenge(challenge.id, instance=instance)
+        state.transition(chall_id, "failed", error=str(e), players=0)
         res = f"Failed to start challenge {challenge.title}: {e}"
     finally:
-        lock_store.delete(f"start:{chall_id}")
+        start_lock.release(chall_id, task_id)
         return res
 
 
 @worker.task(name="worker.clean_challenge")
-def clean_challenge(chall_id: int, tries=0):
+def clean_challenge(chall_id: int, instance: str = None):
     storage = next(Storage.get())
-    repo: ChallengeRepository = ChallengeRepository(storage)
     lock_store = next(RedisStorage.get())
-    docker = DockerHandler()
-    if tries > 3:
-        lock_store.delete(f"delete:{chall_id}")
-        print(f"Failed to clean challenge {chall_id}")
-        return
+    repo: ChallengeRepository = ChallengeRepository(storage, CatalogueCache(lock_store))
+    state = InstanceState(lock_store)
+    started = time.monotonic()
     try:
-        lock_store.set(f"delete:{chall_id}", 1)
-        lock_store.delete(f"chall:{chall_id}")
-        lock_store.delete(f"chall:{chall_id}:count")
+        # Expires in case this worker dies before it can delete the lock.
+        lock_store.set(
+            f"delete:{chall_id}", 1, ex=int(config["RECONCILE"]["LOCK_TIMEOUT"])
+        )
+        AdmissionQueue(lock_store).remove(chall_id)
+        state.transition(chall_id, "deleting", phase="ports")
+        PortAllocator(lock_store).release_reservation(chall_id)
         challenge = repo.find_one(QueryChallengeModel(id=chall_id))
-        if challenge.connection_info:
-            connection_info = json.loads(challenge.connection_info)
-            for port in connection_info["ports"].values():
-                lock_store.delete(f"port:{port}")
+        connection_info = challenge.connection_info or {}
+        instance = instance or connection_info.get("instance") or instance_name(challenge)
+        docker = docker_for(lock_store, chall_id, connection_info.get("node"))
+        state.phase(chall_id, "containers")
+        teardown_instance(
+            docker,
+            instance,
+            grace=stop_grace(challenge),
+            containers=[f"{instance}-{normalize(x.name)}" for x in challenge.services],
+            network=f"{instance}-network",
+        )
+        # Only forget the instance once it is gone, so a failed teardown
+        # can be retried from the connection info.
+        state.phase(chall_id, "database")
         challenge = repo.change_status(challenge, connection_info=None)
-        for service in challenge.services:
-            container = docker.get_container(
-                f"chall-{normalize(challenge.title)}-{normalize(service.name)}"
-            )
-            if container:
-                container.stop()
-                container.remove()
-        docker.remove_network(f"chall-{normalize(challenge.title)}-network")
-        lock_store.delete(f"delete:{chall_id}")
+        release_placement(lock_store, chall_id)
+        state.transition(chall_id, "stopped", players=0)
+        metrics.observe_teardown("challenge", "stopped", started)
     except Exception as e:
         print(f"Failed to clean challenge {chall_id}: {e}")
-        clean_challenge(chall_id, tries + 1)
+        state.transition(chall_id, "failed", error="Failed to clean challenge")
+        metrics.observe_teardown("challenge", "failed", started)
+    finally:
+        lock_store.delete(f"delete:{chall_id}")
+
+
+def player_instance_name(challenge, token: str) -> str:
+    return f"{instance_name(challenge)}-player-{token}"
+
+
+@worker.task(name="worker.start_instance", bind=True)
+def start_instance(self, instance_id: int):
+    """Bring up a player's own instance; its row was created by the API."""
+    lock_store = next(RedisStorage.get())
+    owner = f"player:{instance_id}"
+    task_id = self.request.id or uuid4().hex
+    start_lock = StartLock(lock_store)
+    if not start_lock.claim(owner, task_id):
+        return f"Instance {instance_id} is started by task {start_lock.holder(owner)}"
+    storage = next(Storage.get())
+    repo = InstanceRepository(storage)
+    state = InstanceState(lock_store, prefix="player")
+    instance = repo.find_one(instance_id)
+    if not instance:
+        # Deleted after admit_queued placed it.
+        release_placement(lock_store, owner)
+        start_lock.release(owner, task_id)
+        return None
+    timer = metrics.PhaseTimer("instance", lambda phase: state.phase(instance_id, phase))
+    try:
+        state.transition(instance_id, "creating", phase="network", task_id=task_id)
+        connection_info = spawn_instance(
+            lock_store,
+            instance.challenge,
+            instance.name,
+            owner,
+            on_phase=timer,
+        )["connection_info"]
+        timer("database")
+        repo.set_connection_info(instance, connection_info)
+        state.transition(instance_id, "running")
+        timer.done("running")
+        return f"Starting instance {instance.name} successful"
+    except Exception as e:
+        timer.done("failed")
+        # Keep the row so the player sees the failure and can retry or clean.
+        try:
+            teardown_instance(docker_for(lock_store, owner), instance.name, grace=0)
+            PortAllocator(lock_store).release_reservation(owner)
+            release_placement(lock_store, owner)
+        except Exception as cleanup_error:
+            print(f"Failed to tear down instance {instance.name}: {cleanup_error}")
+        state.transition(instance_id, "failed", error=str(e))
+        return f"Failed to start instance {instance.name}: {e}"
+    finally:
+        start_lock.release(owner, task_id)
+
+
+@worker.task(name="worker.clean_instance")
+def clean_instance(instance_id: int, name: str = None, grace: int = None):
+    """Tear a player's instance down and forget it.
+
+    ``name`` and ``grace`` let the caller clean up after a row that is
+    already gone, e.g. when its challenge was deleted.
+    """
+    storage = next(Storage.get())
+    repo = InstanceRepository(storage)
+    lock_store = next(RedisStorage.get())
+    state = InstanceState(lock_store, prefix="player")
+    instance = repo.find_one(instance_id)
+    node = None
+    if instance:
+        name, grace = instance.name, stop_grace(instance.challenge)
+        node = (instance.connection_info or {}).get("node")
+    if not name:
+        return
+    owner = f"player:{instance_id}"
+    started = time.monotonic()
+    try:
+        lock_store.set(
+            f"delete:{owner}", 1, ex=int(config["RECONCILE"]["LOCK_TIMEOUT"])
+        )
+        AdmissionQueue(lock_store).remove(owner)
+        state.transition(instance_id, "deleting", phase="containers")
+        teardown_instance(docker_for(lock_store, owner, node), name, grace=grace)
+        state.phase(instance_id, "ports")
+        PortAllocator(lock_store).release_reservation(owner)
+        release_placement(lock_store, owner)
+        repo.delete(instance_id)
+        state.delete(instance_id)
+        metrics.observe_teardown("instance", "stopped", started)
+    except Exception as e:
+        print(f"Failed to clean instance {instance_id}: {e}")
+        state.transition(instance_id, "failed", error="Failed to clean instance")
+        metrics.observe_teardown("instance", "failed", started)
+    finally:
+        lock_store.delete(f"delete:{owner}")
+
+
+@worker.task(name="worker.release_instances")
+def release_instances(pairs: list):
+    """Clean the instances of ``(challenge_id, user_id)`` pairs whose join ended."""
+    storage = next(Storage.get())
+    for instance in InstanceRepository(storage).find_pairs([tuple(x) for x in pairs]):
+        clean_instance(instance.id)
+
+
+@worker.task(name="worker.clean_challenges")
+def clean_challenges(chall_ids: list):
+    """Tear down several challenges from a single message."""
+    for chall_id in chall_ids:
+        clean_challenge(chall_id)
+
+
+def release_placement(lock_store, owner):
+    """Give the node capacity of ``owner`` back to whoever is queued for it."""
+    Scheduler(lock_store).release(owner)
+    if AdmissionQueue(lock_store).length():
+        admit_queued.delay()
+
+
+def queued_state(lock_store, request: dict) -> InstanceState:
+    if request["kind"] == "instance":
+        return InstanceState(lock_store, prefix="player")
+    return InstanceState(lock_store)
+
+
+def queued_row_exists(storage, lock_store, request: dict) -> bool:
+    """Whether the instance or challenge a queued request starts still exists."""
+    if request["kind"] == "instance":
+        return InstanceRepository(storage).find_one(request["id"]) is not None
+    query = QueryChallengeModel(id=request["id"])
+    repo = ChallengeRepository(storage, CatalogueCache(lock_store))
+    return repo.find_one(query) is not None
+
+
+def drop_queued(lock_store, owner: str, request: dict, error: str = None) -> None:
+    """Forget a queued request that will never start, and its start lock."""
+    AdmissionQueue(lock_store).remove(owner)
+    start_lock = StartLock(lock_store)
+    holder = start_lock.holder(owner)
+    if holder:
+        start_lock.release(owner, holder)
+    if error:
+        queued_state(lock_store, request).transition(request["id"], "failed", error=error)
+
+
+@worker.task(name="worker.admit_queued")
+def admit_queued():
+    """Start queued requests, oldest first, for as long as the oldest fits.
+
+    Requests whose row was deleted while they waited, and requests larger
+    than any node, are dropped instead of blocking the queue.
+    """
+    lock_store = next(RedisStorage.get())
+    if not lock_store.set(ADMISSION_LOCK_KEY, 1, nx=True, ex=60):
+        return 0
+    admitted = 0
+    try:
+        storage = next(Storage.get())
+        queue = AdmissionQueue(lock_store)
+        scheduler = Scheduler(lock_store)
+        start_lock = StartLock(lock_store)
+        while True:
+            head = queue.head()
+            if not head:
+                break
+            owner, request = head
+            if not request:
+                queue.remove(owner)
+                continue
+            if not queued_row_exists(storage, lock_store, request):
+                drop_queued(lock_store, owner, request)
+                continue
+            try:
+                scheduler.check_fits(owner, request["cpu"], request["memory"])
+                scheduler.place(owner, request["cpu"], request["memory"])
+            except NoNodeFits as e:
+                drop_queued(lock_store, owner, request, error=str(e))
+                continue
+            except IOError:
+                # Strict FIFO: nobody overtakes the oldest request.
+                break
+            queue.remove(owner)
+            # Publish under the id the API handed out with the start lock.
+            task_id = start_lock.holder(owner) or uuid4().hex
+            if start_lock.acquire(owner, task_id) != task_id:
+                # Deleted while it waited: give the capacity back.
+                scheduler.release(owner)
+                continue
+            queued_state(lock_store, request).transition(
+                request["id"], "creating", phase="queued", task_id=task_id
+            )
+            if request["kind"] == "instance":
+                start_instance.apply_async((request["id"],), task_id=task_id)
+            else:
+                start_challenge.apply_async(
+                    (request["id"], request["user_id"]), task_id=task_id
+                )
+            admitted += 1
+        return admitted
+    finally:
+        lock_store.delete(ADMISSION_LOCK_KEY)
+
+
+@worker.task(name="worker.reconcile")
+def reconcile(dry_run: bool = None):
+    """Repair drift between the database, Redis and Docker; see :class:`Reconciler`."""
+    lock_store = next(RedisStorage.get())
+    if dry_run is None:
+        dry_run = config["RECONCILE"]["DRY_RUN"]
+    if not lock_store.set(RECONCILE_LOCK_KEY, 1, nx=True, ex=600):
+        return None
+    try:
+        storage = next(Storage.get())
+        report = Reconciler(
+            {x.name: DockerHandler(node=x) for x in Scheduler(lock_store).nodes},
+            lock_store,
+            ChallengeRepository(storage, CatalogueCache(lock_store)),
+            InstanceRepository(storage),
+            dry_run,
+        ).run()
+        log.info(
+            f"Reconciled {report['instances']} instances: "
+            f"{len(report['fixes'])} {'differences' if dry_run else 'fixes'}"
+        )
+        return report
+    finally:
+        lock_store.delete(RECONCILE_LOCK_KEY)
+
+
+@worker.task(name="worker.refill_warm_pool")
+def refill_warm_pool(chall_id: int, reset: bool = False):
+    storage = next(Storage.get())
+    lock_store = next(RedisStorage.get())
+    repo: ChallengeRepository = ChallengeRepository(storage, CatalogueCache(lock_store))
+    if not lock_store.set(f"warm:{chall_id}:refill", 1, nx=True, ex=600):
+        return
+    try:
+        pool = WarmPool(lock_store)
+        challenge = repo.find_one(QueryChallengeModel(id=chall_id))
+        target = (challenge.warm_pool_size or 0) if challenge else 0
+        for entry in pool.drain(chall_id, keep=0 if reset else target):
+            drop_warm_instance(lock_store, entry)
+        while pool.size(chall_id) < target:
+            token = uuid4().hex[:8]
+            instance = instance_name(challenge, token)
+            try:
+                entry = spawn_instance(
+                    lock_store,
+                    challenge,
+                    instance,
+                    f"warm:{token}",
+                    start=bool(config["WARM_POOL"]["START"]),
+                )
+            except Exception as e:
+                print(f"Failed to prepare warm instance {instance}: {e}")
+                drop_warm_instance(
+                    lock_store,
+                    {
+                        "token": token,
+                        "instance": instance,
+                        "network": f"{instance}-network",
+                        "containers": [
+                            f"{instance}-{normalize(x.name)}" for x in challenge.services
+                        ],
+                    },
+                )
+                break
+            entry["token"] = token
+            pool.put(chall_id, entry)
+    finally:
+        lock_store.delete(f"warm:{chall_id}:refill")
+
+
+@worker.task(name="worker.drain_warm_pool")
+def drain_warm_pool(chall_id: int):
+    lock_store = next(RedisStorage.get())
+    for entry in WarmPool(lock_store).drain(chall_id):
+        drop_warm_instance(lock_store, entry)
+
+
+def drop_warm_instance(lock_store, entry: dict):
+    owner = f"warm:{entry['token']}"
+    started = time.monotonic()
+    outcome = "stopped"
+    try:
+        # Nobody has played on a warm instance, so there is nothing to wait for.
+        teardown_instance(
+            docker_for(lock_store, owner, entry.get("node")),
+            entry["instance"],
+            grace=0,
+            containers=entry["containers"],
+            network=entry["network"],
+        )
+    except Exception as e:
+        print(f"Failed to remove warm instance {entry['instance']}: {e}")
+        outcome = "failed"
+    PortAllocator(lock_store).release_reservation(owner)
+    release_placement(lock_store, owner)
+    metrics.observe_teardown("warm", outcome, started)
+